@@ -0,0 +1,40 @@
+import argparse
+import re
+
+from codec import (MAX_FEN_LENGTH, board_to_tokens, convert_torch_to_fen, decode, decode_batch, encode, encode_batch,
+                   encode_fen_buffer, pack_fens, random_boards, random_fens, unpack_fens, unpack_tokens)
+from metrics import timeit
+
+# Per-position cost of the codec; its property checks are in test_codec.py.
+
+def regex_decode(row):
+    return re.sub(r'\.+', lambda run: str(len(run.group())), decode(row))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-position cost of encoding, decoding and packing FENs and code boards.")
+    parser.add_argument('--batch-size', type=int, default=1024)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    fens = random_fens(args.batch_size, seed=args.seed)
+    rows = encode_batch(fens, max_seq_length=MAX_FEN_LENGTH)
+    row_lists = rows.tolist()
+    packed = pack_fens(fens)
+    code_boards = random_boards(args.batch_size, seed=args.seed + 1)
+    buffer = '\n'.join(fens).encode('ascii')
+    timings = [
+        ('encode, one FEN at a time', lambda: [encode(fen) for fen in fens]),
+        ('encode_batch', lambda: encode_batch(fens, max_seq_length=MAX_FEN_LENGTH)),
+        ('encode_fen_buffer', lambda: encode_fen_buffer(buffer, max_seq_length=MAX_FEN_LENGTH)),
+        ('decode + regex per row', lambda: [regex_decode(row) for row in row_lists]),
+        ('decode_batch', lambda: decode_batch(rows)),
+        ('pack_fens', lambda: pack_fens(fens)),
+        ('unpack_tokens', lambda: unpack_tokens(packed, max_seq_length=MAX_FEN_LENGTH)),
+        ('unpack_fens', lambda: unpack_fens(packed)),
+        ('convert_torch_to_fen + encode_batch', lambda: encode_batch([convert_torch_to_fen(board) for board in code_boards])),
+        ('board_to_tokens', lambda: board_to_tokens(code_boards, MAX_FEN_LENGTH)),
+    ]
+    print(f"{'':<38} {'us/position':>12}")
+    for name, fn in timings:
+        print(f"{name:<38} {timeit(fn, args.repeat) / len(fens) * 1e6:>12.2f}")
@@ -0,0 +1,112 @@
+import argparse
+import os
+import time
+from collections import Counter
+from itertools import islice
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+import yaml
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+from bench_shuffle import GameTaggedDataset, batches
+from dataloader import get_chess_position_dataloader
+from model import Model
+
+# the ranks of one world size read disjoint positions that together are exactly the single-process epoch
+def check_rank_slices(pgn_file_path, world_size, chunk_size, num_cursors, num_workers, batch_size):
+    everything = Counter(sample for batch in batches(GameTaggedDataset(pgn_file_path, chunk_size=chunk_size, num_cursors=num_cursors, seed=0),
+                                                     batch_size, num_workers) for sample in batch)
+    games, seen = [], Counter()
+    for rank in range(world_size):
+        dataset = GameTaggedDataset(pgn_file_path, chunk_size=chunk_size, num_cursors=num_cursors, seed=0, rank=rank, world_size=world_size)
+        samples = Counter(sample for batch in batches(dataset, batch_size, num_workers) for sample in batch)
+        games.append({offset for _, offset in samples})
+        seen.update(samples)
+    assert seen == everything, "the ranks together do not read every position exactly once"
+    assert all(not games[i] & games[j] for i in range(world_size) for j in range(i + 1, world_size)), "a game was read by two ranks"
+
+# one rank of a gloo process group: trains for warmup + steps iterations and reports the global throughput
+def run_rank(rank, world_size, args, config, results):
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ['MASTER_PORT'] = str(args.port + world_size)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.set_num_threads(args.threads or max(1, (os.cpu_count() or 1) // world_size))
+    torch.manual_seed(rank)  # different on every rank: DDP must still start them from rank 0's weights
+
+    model = DDP(Model(**config))
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    criterion = nn.MSELoss()
+    loader = get_chess_position_dataloader(args.pgn, batch_size=args.batch_size, chunk_size=args.chunk_size, num_workers=args.num_workers,
+                                           max_seq_length=config['max_seq_length'], num_cursors=args.num_cursors, seed=0,
+                                           rank=rank, world_size=world_size)
+    steps = list(islice(loader, args.warmup + args.steps))
+    # ranks may run out of data at different points; all of them take the same number of steps
+    count = torch.tensor(len(steps))
+    dist.all_reduce(count, op=dist.ReduceOp.MIN)
+    steps = steps[:int(count)]
+
+    for i, (tokens, scores) in enumerate(steps):
+        if i == min(args.warmup, len(steps) - 1):
+            dist.barrier()
+            start = time.perf_counter()
+            positions = 0
+        optimizer.zero_grad(set_to_none=True)
+        criterion(model(tokens), scores).backward()
+        optimizer.step()
+        if i >= args.warmup:
+            positions += len(tokens)
+    dist.barrier()
+    elapsed = time.perf_counter() - start
+
+    total = torch.tensor(positions)
+    dist.all_reduce(total)
+    params = torch.cat([p.detach().flatten() for p in model.parameters()])
+    reference = params.clone()
+    dist.broadcast(reference, 0)
+    assert torch.equal(params, reference), f"rank {rank} parameters differ from rank 0"
+    if rank == 0:
+        results.put((int(total), elapsed))
+    dist.destroy_process_group()
+
+def measure(world_size, args, config):
+    results = mp.get_context('spawn').SimpleQueue()
+    mp.spawn(run_rank, args=(world_size, args, config, results), nprocs=world_size)
+    positions, elapsed = results.get()
+    return positions / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Positions/sec of DDP training on the gloo backend against the number of ranks.")
+    parser.add_argument('pgn')
+    parser.add_argument('--world-sizes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--batch-size', type=int, default=256, help='per rank')
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--num-cursors', type=int, default=4)
+    parser.add_argument('--num-workers', type=int, default=0)
+    parser.add_argument('--num-layers', type=int, default=None, help='defaults to model_config.yaml')
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=None, help='per rank; defaults to the cores divided by the world size')
+    parser.add_argument('--port', type=int, default=29600)
+    args = parser.parse_args()
+
+    with open('model_config.yaml') as f:
+        config = yaml.safe_load(f)
+    if args.num_layers is not None:
+        config['num_layers'] = args.num_layers
+    config.update(test_mode=False)
+
+    for world_size in args.world_sizes:
+        if world_size > 1:
+            check_rank_slices(args.pgn, world_size, args.chunk_size, args.num_cursors, args.num_workers, args.batch_size)
+    print(f"ranks read disjoint slices covering every position once for world sizes {args.world_sizes}")
+
+    print(f"{'ranks':>6} {'positions/sec':>14} {'per rank':>10} {'scaling':>8}")
+    base = None
+    for world_size in args.world_sizes:
+        rate = measure(world_size, args, config)
+        base = base or rate / world_size
+        print(f"{world_size:>6} {rate:>14,.0f} {rate / world_size:>10,.0f} {rate / (base * world_size):>7.0%}")
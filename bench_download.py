@@ -0,0 +1,29 @@
+import argparse
+import os
+import tempfile
+import time
+
+from download_games import ingest_month, stream_games
+from test_download import random_months, serve_directory, write_archives
+
+# Times the download pipeline against a local HTTP server; test_download.py checks it.
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times the Lichess download pipeline against a local HTTP server, in games/sec.")
+    parser.add_argument('--months', nargs='+', default=['2013-01', '2013-02'])
+    parser.add_argument('--games-per-month', type=int, default=300)
+    args = parser.parse_args()
+
+    month_games = random_months(args.months, args.games_per_month)
+    with tempfile.TemporaryDirectory() as directory, serve_directory(directory) as base_url:
+        write_archives(directory, month_games)
+        start = time.perf_counter()
+        streamed = sum(1 for month in args.months for _ in stream_games(base_url.format(month)))
+        print(f"stream_games: {streamed / (time.perf_counter() - start):,.0f} games/sec")
+
+        out_dir = os.path.join(directory, 'out')
+        os.makedirs(out_dir)
+        start = time.perf_counter()
+        for month in args.months:
+            ingest_month(month, out_dir, base_url)
+        print(f"ingest_month: {streamed / (time.perf_counter() - start):,.0f} games/sec read")
@@ -0,0 +1,84 @@
+import argparse
+
+import torch
+import torch.nn as nn
+import yaml
+
+from codec import encode_batch, random_fens
+from metrics import timeit
+from model import Model
+
+# input: Model with pooling='last'
+# output: function running the module as it was before batch_first: seq-first layers with the same weights
+def seq_first_reference(model):
+    layer = model.transformer.layers[0]
+    reference_layer = nn.TransformerEncoderLayer(model.embedding.embedding_dim, layer.self_attn.num_heads, layer.linear1.out_features)
+    transformer = nn.TransformerEncoder(reference_layer, len(model.transformer.layers))
+    transformer.load_state_dict(model.transformer.state_dict())
+    transformer.eval()
+
+    def forward(x):
+        x = model.embedding(x) + model.pos_encoding[:x.size(1), :]
+        x = transformer(x.permute(1, 0, 2))
+        return model.fc(x[-1, :, :])
+    return forward
+
+# the batch-first 'last' module reproduces the seq-first one, and the CLS module ignores how far rows are padded
+@torch.no_grad()
+def check_models(legacy, cls, fens, max_seq_length):
+    dynamic = encode_batch(fens)
+    assert torch.allclose(legacy.forward_tokens(dynamic), seq_first_reference(legacy)(dynamic), atol=1e-5)
+
+    fixed = encode_batch(fens, max_seq_length=max_seq_length)
+    one_by_one = torch.cat([cls.forward_tokens(encode_batch([fen])) for fen in fens])
+    assert torch.allclose(cls.forward_tokens(fixed), one_by_one, atol=1e-4)
+    with torch.enable_grad():
+        # with gradients the encoder skips the nested-tensor fast path and runs masked fused attention
+        assert torch.allclose(cls.forward_tokens(fixed), one_by_one, atol=1e-4)
+
+def train_step(model, tokens, optimizer):
+    optimizer.zero_grad(set_to_none=True)
+    model.forward_tokens(tokens).square().mean().backward()
+    optimizer.step()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency of the seq-first last-token model against the batch-first CLS model.")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 64, 512])
+    parser.add_argument('--num-layers', type=int, default=None, help='defaults to model_config.yaml')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    with open('model_config.yaml') as f:
+        config = yaml.safe_load(f)
+    if args.num_layers is not None:
+        config['num_layers'] = args.num_layers
+    config.update(test_mode=False)
+
+    torch.manual_seed(0)
+    legacy = Model(**dict(config, pooling='last')).eval()
+    cls = Model(**dict(config, pooling='cls')).eval()
+    reference = seq_first_reference(legacy)
+    max_seq_length = config['max_seq_length']
+
+    check_models(legacy, cls, random_fens(16), max_seq_length)
+    print("batch-first 'last' model matches the seq-first module; CLS model output is independent of padding")
+
+    print(f"{'batch':>6} {'seq-first last ms':>18} {'cls + mask ms':>14} {'speedup':>8} {'train seq-first ms':>19} {'train cls ms':>13}")
+    for batch_size in args.batch_sizes:
+        fens = random_fens(batch_size, seed=batch_size)
+        with torch.no_grad():
+            old = timeit(lambda: reference(encode_batch(fens)), args.repeat)
+            new = timeit(lambda: cls.forward_tokens(encode_batch(fens, max_seq_length=max_seq_length)), args.repeat)
+
+        legacy.train()
+        cls.train()
+        old_optimizer = torch.optim.AdamW(legacy.parameters())
+        new_optimizer = torch.optim.AdamW(cls.parameters())
+        old_train = timeit(lambda: train_step(legacy, encode_batch(fens), old_optimizer), args.repeat)
+        new_train = timeit(lambda: train_step(cls, encode_batch(fens, max_seq_length=max_seq_length), new_optimizer), args.repeat)
+        legacy.eval()
+        cls.eval()
+        print(f"{batch_size:>6} {old * 1e3:>18.2f} {new * 1e3:>14.2f} {old / new:>7.2f}x {old_train * 1e3:>19.2f} {new_train * 1e3:>13.2f}")
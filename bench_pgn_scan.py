@@ -0,0 +1,55 @@
+import argparse
+import time
+
+import chess
+import chess.pgn
+
+from codec import normalize_fen
+from dataloader import ChessPositionDataset, read_mainline
+
+# The game-tree path the dataset used before the streaming visitor: read_game builds every
+# GameNode and node.board() replays the game from the root for each position.
+def game_tree_positions(dataset, game):
+    positions = []
+    node = game.variations[0] if game.variations else None
+    while node is not None:
+        b = node.board()
+        positions.append((normalize_fen(b), b.turn, b.is_checkmate(), node.comment))
+        node = node.variations[0] if node.variations else None
+    return dataset.process_positions(positions)
+
+def run_game_tree(dataset, pgn_file_path, max_games):
+    output = []
+    with open(pgn_file_path) as pgn:
+        for _ in range(max_games):
+            game = chess.pgn.read_game(pgn)
+            if game is None:
+                break
+            output.extend(game_tree_positions(dataset, game))
+    return output
+
+def run_streaming(dataset, pgn_file_path, max_games):
+    output = []
+    with open(pgn_file_path) as pgn:
+        for _ in range(max_games):
+            positions = read_mainline(pgn)
+            if positions is None:
+                break
+            output.extend(dataset.process_positions(positions))
+    return output
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Positions/sec of the game-tree and streaming PGN extraction paths.")
+    parser.add_argument('pgn_file_path', nargs='?', default='sample.pgn')
+    parser.add_argument('--max-games', type=int, default=2000)
+    args = parser.parse_args()
+
+    dataset = ChessPositionDataset(args.pgn_file_path)
+    results = {}
+    for name, run in (('game tree', run_game_tree), ('streaming', run_streaming)):
+        start = time.perf_counter()
+        results[name] = run(dataset, args.pgn_file_path, args.max_games)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>10}: {len(results[name])} positions in {elapsed:.2f}s ({len(results[name]) / elapsed:,.0f} positions/sec)")
+
+    assert results['game tree'] == results['streaming'], "streaming path produced different positions"
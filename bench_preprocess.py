@@ -0,0 +1,24 @@
+import argparse
+import os
+import tempfile
+
+from preprocessing import preprocess
+
+# Times the parallel PGN conversion by worker count; test_preprocessing.py checks it.
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times the parallel PGN conversion by worker count.")
+    parser.add_argument('pgn_file_path', nargs='?', default='sample.pgn')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4, 8])
+    parser.add_argument('--games-per-shard', type=int, default=250)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        print(f"{'workers':>8} {'index s':>8} {'total s':>8} {'positions/sec':>14} {'speedup':>8}")
+        baseline = None
+        for workers in args.workers:
+            summary = preprocess([args.pgn_file_path], out_dir, workers=workers, games_per_shard=args.games_per_shard, verbose=False)
+            baseline = baseline or summary['seconds']
+            print(f"{workers:>8} {summary['index_seconds']:>8.2f} {summary['seconds']:>8.2f} "
+                  f"{summary['positions'] / summary['seconds']:>14,.0f} {baseline / summary['seconds']:>8.2f}")
+    print(f"{os.cpu_count()} cores available")
@@ -0,0 +1,100 @@
+import argparse
+import random
+import time
+
+import chess
+import numpy as np
+import torch
+
+from codec import encode_batch, normalize_fen
+from metrics import timeit
+from model import load_model
+from position import TokenPosition
+from search import ModelEvaluator, Searcher
+
+# boards from random playouts, with the position after each move checked against normalize_fen on the way
+def random_positions(n, seed=0):
+    rng = random.Random(seed)
+    boards = []
+    while len(boards) < n:
+        board = chess.Board()
+        position = TokenPosition(board)
+        for _ in range(rng.randint(0, 80)):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            position.push(rng.choice(moves))
+            assert position.fen() == normalize_fen(board)
+        boards.append(board.copy())
+    return boards
+
+# the path the search used before: copy or push, serialize, normalize and tokenize every child
+def fen_children(board, width):
+    fens = []
+    for move in board.legal_moves:
+        board.push(move)
+        fens.append(normalize_fen(board))
+        board.pop()
+    return encode_batch(fens, max_seq_length=width)
+
+def token_children(board, width):
+    return TokenPosition(board, max_seq_length=width).child_tokens(list(board.legal_moves))
+
+def run_search(evaluator, boards, depth, use_tokens):
+    results, nodes, start = [], 0, time.perf_counter()
+    for board in boards:
+        searcher = Searcher(evaluator)
+        searcher.use_tokens = use_tokens
+        result = searcher.search(board, max_depth=depth)
+        results.append(result)
+        nodes += result.stats.nodes
+    return results, nodes / (time.perf_counter() - start)
+
+# a time-limited search ends within about one single-position model call of its limit and still has a move
+def check_time_limit(evaluator, board, time_limit):
+    one_leaf = timeit(lambda: evaluator.evaluate_fens([normalize_fen(board)]), 3)
+    start = time.perf_counter()
+    result = Searcher(evaluator).search(board, max_depth=64, time_limit=time_limit)
+    elapsed = time.perf_counter() - start
+    assert elapsed <= time_limit + 2 * one_leaf + 0.05, f"search took {elapsed:.2f}s with a {time_limit}s limit"
+    assert result.best_move is not None
+    return elapsed, result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Child positions as FEN strings vs. incrementally updated token rows.")
+    parser.add_argument('checkpoint')
+    parser.add_argument('--positions', type=int, default=8)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--time-limit', type=float, default=2.0)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    evaluator = ModelEvaluator(load_model(args.checkpoint), max_batch_size=512)
+    width = evaluator.token_width
+    boards = random_positions(args.positions)
+
+    for board in boards:
+        assert np.array_equal(token_children(board, width), fen_children(board, width).numpy())
+    fens = [normalize_fen(board) for board in boards]
+    tokens = np.stack([TokenPosition(board, max_seq_length=width).tokens() for board in boards])
+    assert np.allclose(evaluator.evaluate_tokens(tokens), evaluator.evaluate_fens(fens), atol=1e-5)
+    print(f"token rows match the FEN path on {len(boards)} positions and their children")
+
+    children = sum(board.legal_moves.count() for board in boards)
+    old = timeit(lambda: [fen_children(board, width) for board in boards], args.repeat)
+    new = timeit(lambda: [token_children(board, width) for board in boards], args.repeat)
+    print(f"children as FENs:       {children / old:>10,.0f} positions/sec")
+    print(f"children as token rows: {children / new:>10,.0f} positions/sec ({old / new:.1f}x)")
+
+    results = {}
+    for use_tokens in (False, True):
+        results[use_tokens], rate = run_search(evaluator, boards, args.depth, use_tokens)
+        print(f"search depth {args.depth} with {'token rows' if use_tokens else 'FENs':<10}: {rate:>8,.0f} nodes/sec")
+    for old_result, new_result in zip(results[False], results[True]):
+        assert old_result.best_move == new_result.best_move and abs(old_result.score - new_result.score) < 1e-4
+
+    elapsed, result = check_time_limit(evaluator, boards[-1], args.time_limit)
+    print(f"search with a {args.time_limit}s limit: {elapsed:.2f}s, depth {result.depth}, {result.stats.batches} batches")
@@ -0,0 +1,69 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from codec import random_fens
+from model import load_model
+from search import ModelEvaluator
+from server import EvalClient
+
+# each simulated game asks for the values of one position's children at a time, like a 1-ply Agent
+def play(client_factory, fens, requests, request_size):
+    client = client_factory()
+    latencies = []
+    for i in range(requests):
+        start = time.perf_counter()
+        client.evaluate_fens(fens[i * request_size:(i + 1) * request_size])
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def wait_for_socket(path, timeout=120):
+    deadline = time.time() + timeout
+    while not os.path.exists(path):
+        if time.time() > deadline:
+            raise TimeoutError(f"server did not create {path}")
+        time.sleep(0.1)
+
+def run_clients(client_factory, clients, requests, request_size):
+    fens = [random_fens(requests * request_size, seed=seed) for seed in range(clients)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as executor:
+        latencies = sum(executor.map(lambda f: play(client_factory, f, requests, request_size), fens), [])
+    elapsed = time.perf_counter() - start
+    return clients * requests * request_size / elapsed, np.percentile(latencies, [50, 99]) * 1e3
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput of concurrent games against one batching server vs. per-caller models.")
+    parser.add_argument('checkpoint')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=20, help='requests per client')
+    parser.add_argument('--request-size', type=int, default=30, help='positions per request')
+    parser.add_argument('--socket', default='/tmp/bench_chess_eval.sock')
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    server = subprocess.Popen([sys.executable, 'server.py', args.checkpoint, '--socket', args.socket, '--threads', '1'])
+    try:
+        wait_for_socket(args.socket)
+        local = ModelEvaluator(load_model(args.checkpoint))
+        client = EvalClient(args.socket)
+        fens = random_fens(64, seed=123)
+        assert np.allclose(client.evaluate_fens(fens), local.evaluate_fens(fens), atol=1e-5)
+        print("server values match the local evaluator")
+
+        # baseline: every game evaluates on its own, one call at a time (one thread, like separate processes sharing a core)
+        rate, (p50, p99) = run_clients(lambda: local, 1, args.requests, args.request_size)
+        print(f"per-caller model, 1 game:     {rate:,.0f} positions/sec, latency p50 {p50:.1f} ms, p99 {p99:.1f} ms")
+        rate, (p50, p99) = run_clients(lambda: EvalClient(args.socket), args.clients, args.requests, args.request_size)
+        print(f"shared server, {args.clients} games:     {rate:,.0f} positions/sec, latency p50 {p50:.1f} ms, p99 {p99:.1f} ms")
+        print(client.stats())
+        client.close()
+    finally:
+        server.terminate()
+        server.wait()
@@ -0,0 +1,84 @@
+import argparse
+import os
+import time
+from collections import Counter
+from itertools import islice
+
+import numpy as np
+from torch.utils.data import DataLoader
+
+from dataloader import ChessPositionDataset
+
+# Dataset that yields (game offset, FEN) instead of (FEN, eval), so a batch tells which games it came from.
+# The eval slot carries the offset of the game in the file, which float32 holds exactly below 2**24.
+class GameTaggedDataset(ChessPositionDataset):
+    def process_positions(self, game):
+        offset, positions = game
+        return [(fen, float(offset)) for fen, _ in super().process_positions(positions)]
+
+    def read_games(self, pgn_file_path, start, end):
+        for offset, positions in super().read_games(pgn_file_path, start, end):
+            yield offset, (offset, positions)
+
+# output: (packed position bytes, game offset) per row of a batch
+def tagged_collate(batch):
+    return [(row[['squares', 'flags', 'ep']].tobytes(), float(row['eval'])) for row in batch]
+
+def batches(dataset, batch_size, num_workers, limit=None):
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=tagged_collate)
+    return list(islice(loader, limit))
+
+# mean number of distinct games per batch, the share of the batch taken by its most common game, and the
+# share of the file between the batch's first and last game (how far apart in the data its games were played)
+def correlation(batch_list, file_size):
+    distinct, top, span = [], [], []
+    for batch in batch_list:
+        games = Counter(offset for _, offset in batch)
+        distinct.append(len(games))
+        top.append(games.most_common(1)[0][1] / len(batch))
+        span.append((max(games) - min(games)) / file_size)
+    return np.mean(distinct), np.mean(top), np.mean(span)
+
+def check_resume(pgn_file_path, chunk_size, num_cursors, num_workers, batch_size, stop_after):
+    dataset = GameTaggedDataset(pgn_file_path, chunk_size=chunk_size, num_cursors=num_cursors, seed=0)
+    loader = iter(DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=tagged_collate))
+    seen = Counter(sample for batch in islice(loader, stop_after) for sample in batch)
+    state = dataset.state_dict()
+    del loader
+
+    resumed = GameTaggedDataset(pgn_file_path, chunk_size=chunk_size, num_cursors=num_cursors)
+    resumed.load_state_dict(state)
+    seen.update(sample for batch in batches(resumed, batch_size, num_workers) for sample in batch)
+    everything = Counter(sample for batch in batches(GameTaggedDataset(pgn_file_path, chunk_size=chunk_size, num_cursors=num_cursors, seed=0), batch_size, num_workers) for sample in batch)
+    assert not everything - seen, "resuming skipped positions"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch correlation, determinism and resumability of the streaming shuffle.")
+    parser.add_argument('pgn')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--num-cursors', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--num-workers', type=int, default=0)
+    parser.add_argument('--batches', type=int, default=50, help='batches per measurement')
+    args = parser.parse_args()
+
+    first = batches(GameTaggedDataset(args.pgn, chunk_size=args.chunk_size, num_cursors=4, seed=7), args.batch_size, args.num_workers, args.batches)
+    second = batches(GameTaggedDataset(args.pgn, chunk_size=args.chunk_size, num_cursors=4, seed=7), args.batch_size, args.num_workers, args.batches)
+    assert first == second, "the same seed gave different batches"
+    other = batches(GameTaggedDataset(args.pgn, chunk_size=args.chunk_size, num_cursors=4, seed=8), args.batch_size, args.num_workers, args.batches)
+    assert first != other
+    print("same seed, same batches")
+
+    check_resume(args.pgn, args.chunk_size, 4, args.num_workers, args.batch_size, stop_after=args.batches)
+    print("resuming from state_dict() skips no positions")
+
+    print(f"{'cursors':>8} {'window':>8} {'games/batch':>12} {'top game share':>15} {'file span':>10} {'positions/sec':>14}")
+    for chunk_size in sorted({args.chunk_size, args.chunk_size * 4}):
+        for num_cursors in args.num_cursors:
+            dataset = GameTaggedDataset(args.pgn, chunk_size=chunk_size, num_cursors=num_cursors, seed=0)
+            start = time.perf_counter()
+            batch_list = batches(dataset, args.batch_size, args.num_workers, args.batches)
+            elapsed = time.perf_counter() - start
+            games, top, span = correlation(batch_list, os.path.getsize(args.pgn))
+            print(f"{num_cursors:>8} {chunk_size:>8} {games:>12.1f} {top:>15.1%} {span:>10.1%} {sum(map(len, batch_list)) / elapsed:>14,.0f}")
@@ -0,0 +1,83 @@
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+# entry points whose parent process has no use for torch
+TORCH_FREE = ['tournaments', 'puzzle_eval', 'server']
+
+# input: module name
+# output: (seconds to import it, whether torch got imported) in a fresh interpreter
+def import_seconds(module):
+    code = (f"import sys, time; start = time.perf_counter(); import {module}; "
+            f"print(time.perf_counter() - start, 'torch' in sys.modules)")
+    seconds, torch_loaded = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout.split()
+    return float(seconds), torch_loaded == 'True'
+
+# load_model as it was: the whole checkpoint, optimizer state included, unpickled into memory
+def legacy_load_model(checkpoint_path, device='cpu'):
+    import torch
+    import yaml
+    from model import Model, upgrade_state_dict
+
+    with open('model_config.yaml') as f:
+        model_config = yaml.safe_load(f)
+    checkpoint = torch.load(checkpoint_path, map_location=torch.device(device), weights_only=False)
+    if 'cls_token' not in checkpoint['model']:
+        model_config['pooling'] = 'last'
+    model = Model(**model_config)
+    model.load_state_dict(upgrade_state_dict(checkpoint))
+    return model.to(device).eval()
+
+# runs in a fresh interpreter: seconds for the imports, the checkpoint load and the first evaluation
+def first_eval(checkpoint_path, legacy):
+    start = time.perf_counter()
+    import chess
+    from codec import normalize_fen
+    from metrics import peak_memory_mb
+    from model import load_model
+    from search import ModelEvaluator
+    imported = time.perf_counter()
+    model = legacy_load_model(checkpoint_path) if legacy else load_model(checkpoint_path)
+    loaded = time.perf_counter()
+    value = ModelEvaluator(model).evaluate_fens([normalize_fen(chess.Board())])[0]
+    evaluated = time.perf_counter()
+    return {'import': imported - start, 'load': loaded - imported, 'first_eval': evaluated - loaded,
+            'total': evaluated - start, 'peak_rss_mb': peak_memory_mb('cpu'), 'value': value}
+
+def measure_first_eval(checkpoint_path, legacy, repeat):
+    command = [sys.executable, __file__, checkpoint_path, '--child'] + (['--legacy'] if legacy else [])
+    runs = [json.loads(subprocess.run(command, capture_output=True, text=True, check=True).stdout) for _ in range(repeat)]
+    return {key: float(np.median([run[key] for run in runs])) for key in runs[0]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import time of the entry points and time to the first evaluation from a checkpoint.")
+    parser.add_argument('checkpoint', help='a checkpoint written by train.py, optimizer state included')
+    parser.add_argument('--modules', nargs='+', default=['torch', 'model', 'search', 'server', 'puzzle_eval', 'tournaments', 'train'])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--legacy', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(first_eval(args.checkpoint, args.legacy)))
+        sys.exit()
+
+    print(f"{'module':<12} {'import ms':>10} {'torch':>6}")
+    for module in args.modules:
+        runs = [import_seconds(module) for _ in range(args.repeat)]
+        torch_loaded = runs[0][1]
+        assert module not in TORCH_FREE or not torch_loaded, f"importing {module} loads torch"
+        print(f"{module:<12} {np.median([seconds for seconds, _ in runs]) * 1e3:>10.0f} {'yes' if torch_loaded else 'no':>6}")
+
+    old = measure_first_eval(args.checkpoint, True, args.repeat)
+    new = measure_first_eval(args.checkpoint, False, args.repeat)
+    assert abs(old['value'] - new['value']) < 1e-6, "the memory-mapped checkpoint evaluates differently"
+    print(f"{'load path':<22} {'import ms':>10} {'load ms':>8} {'first eval ms':>14} {'total ms':>9} {'peak RSS MB':>12}")
+    for name, run in (('full torch.load', old), ('mmap, weights_only', new)):
+        print(f"{name:<22} {run['import'] * 1e3:>10.0f} {run['load'] * 1e3:>8.0f} {run['first_eval'] * 1e3:>14.0f} "
+              f"{run['total'] * 1e3:>9.0f} {run['peak_rss_mb']:>12.0f}")
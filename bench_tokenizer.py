@@ -0,0 +1,87 @@
+import argparse
+import random
+import tracemalloc
+
+import numpy as np
+import torch
+
+from codec import encode, decode, encode_batch, encode_fen_buffer, pack_fens, unpack_fens, unpack_tokens, board_to_tokens, convert_torch_to_fen, random_boards, random_fens, PIECE_TO_TOKEN
+from dataloader import PositionBuffer
+from metrics import timeit
+
+def reference_batch(fens):
+    encoded_fens = [encode(fen) for fen in fens]
+    max_len = max(len(tokens) for tokens in encoded_fens)
+    return torch.tensor([tokens + [PIECE_TO_TOKEN['<PAD>']] * (max_len - len(tokens)) for tokens in encoded_fens])
+
+def check_round_trip(fens, max_seq_length):
+    reference = reference_batch(fens)
+    assert torch.equal(encode_batch(fens), reference)
+    assert torch.equal(encode_fen_buffer('\n'.join(fens).encode('ascii')), reference)
+
+    fixed = encode_batch(fens, max_seq_length=max_seq_length, dtype=torch.uint8)
+    assert fixed.shape == (len(fens), max_seq_length)
+    for fen, row in zip(fens, fixed.tolist()):
+        tokens = encode(fen)
+        assert row[:len(tokens)] == tokens and not any(row[len(tokens):])
+        assert decode(row) == decode(tokens)
+
+def check_packing(fens, max_seq_length):
+    evals = [random.random() for _ in fens]
+    packed = pack_fens(fens, evals)
+    assert unpack_fens(packed) == fens
+    assert np.allclose(packed['eval'], evals)
+    assert torch.equal(unpack_tokens(packed), encode_batch(fens))
+    assert torch.equal(unpack_tokens(packed, max_seq_length), encode_batch(fens, max_seq_length=max_seq_length))
+
+# bytes per buffered position: a list of (FEN, eval) tuples, as the dataset kept its chunk, against a PositionBuffer
+def buffered_bytes(fens):
+    tracemalloc.start()
+    # fresh copies of the strings, so they are counted like FENs read from a file
+    chunk = [(fen.encode('ascii').decode('ascii'), float(i)) for i, fen in enumerate(fens)]
+    as_tuples = tracemalloc.get_traced_memory()[0]
+    del chunk
+    tracemalloc.stop()
+
+    buffer = PositionBuffer(block_size=len(fens))
+    buffer.append(pack_fens(fens, range(len(fens))))
+    return as_tuples / len(fens), sum(block.nbytes for block in buffer.blocks) / len(fens)
+
+def fen_path(boards):
+    return encode_batch([convert_torch_to_fen(boards[i, :]) for i in range(boards.shape[0])])
+
+def check_board_tokens(boards):
+    for start in range(0, boards.shape[0], 16):
+        assert torch.equal(board_to_tokens(boards[start:start + 16]), fen_path(boards[start:start + 16]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the batch tokenizer against encode() and time both.")
+    parser.add_argument('--batch-size', type=int, default=1024)
+    parser.add_argument('--max-seq-length', type=int, default=79)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    fens = random_fens(args.batch_size)
+    check_round_trip(fens, args.max_seq_length)
+    print(f"round trip ok on {len(fens)} FENs")
+
+    reference = timeit(lambda: reference_batch(fens), args.repeat)
+    batched = timeit(lambda: encode_batch(fens, max_seq_length=args.max_seq_length), args.repeat)
+    print(f"encode + torch.tensor: {reference * 1e3:.2f} ms/batch")
+    print(f"encode_batch:          {batched * 1e3:.2f} ms/batch ({reference / batched:.1f}x)")
+
+    check_packing(fens, args.max_seq_length)
+    packed = pack_fens(fens)
+    unpacked = timeit(lambda: unpack_tokens(packed, max_seq_length=args.max_seq_length), args.repeat)
+    print(f"unpack_tokens:         {unpacked * 1e3:.2f} ms/batch")
+    as_tuples, as_packed = buffered_bytes(random_fens(100_000, seed=1))
+    print(f"buffered position: {as_tuples:.0f} bytes as a (str, float) tuple, {as_packed:.0f} bytes packed ({as_tuples / as_packed:.1f}x)")
+
+    boards = random_boards(args.batch_size)
+    check_board_tokens(boards)
+    print(f"board_to_tokens matches the FEN path on {len(boards)} boards")
+
+    reference = timeit(lambda: fen_path(boards), args.repeat)
+    batched = timeit(lambda: board_to_tokens(boards), args.repeat)
+    print(f"convert_torch_to_fen + encode_batch: {reference * 1e3:.2f} ms/batch")
+    print(f"board_to_tokens:                      {batched * 1e3:.2f} ms/batch ({reference / batched:.1f}x)")
@@ -0,0 +1,131 @@
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+import chess
+import chess.polyglot
+
+ZOBRIST = chess.polyglot.POLYGLOT_RANDOM_ARRAY
+ZOBRIST_CASTLING = 768
+ZOBRIST_EN_PASSANT = 772
+ZOBRIST_TURN = 780
+
+# approximate python memory per cached item, used to turn a budget in MB into an entry count
+EVAL_ENTRY_BYTES = 160
+TT_ENTRY_BYTES = 200
+
+# input: python-chess board
+# output: polyglot Zobrist hash of the position as normalize_fen sees it
+# The colors are swapped when black is to move and the side to move is otherwise not hashed, so
+# exactly the positions that the model receives as the same tokens share a key.
+def position_key(board: chess.Board) -> int:
+    swap = board.turn == chess.BLACK
+    key = 0
+    for color in chess.COLORS:
+        # polyglot orders pieces black pawn, white pawn, black knight, ...
+        color_index = int(color != swap)
+        for piece_type in chess.PIECE_TYPES:
+            offset = 64 * (2 * (piece_type - 1) + color_index)
+            for square in chess.scan_forward(board.pieces_mask(piece_type, color)):
+                key ^= ZOBRIST[offset + square]
+
+    rights = board.castling_rights
+    white, black = (chess.BB_H1, chess.BB_A1), (chess.BB_H8, chess.BB_A8)
+    if swap:
+        white, black = black, white
+    for index, mask in enumerate(white + black):
+        if rights & mask:
+            key ^= ZOBRIST[ZOBRIST_CASTLING + index]
+    # swapcase turns "KQkq" into "kqKQ", so with both sides able to castle the token order depends on the turn
+    if swap and rights & (chess.BB_H1 | chess.BB_A1) and rights & (chess.BB_H8 | chess.BB_A8):
+        key ^= ZOBRIST[ZOBRIST_TURN]
+
+    if board.ep_square is not None and board.has_legal_en_passant():
+        key ^= ZOBRIST[ZOBRIST_EN_PASSANT + chess.square_file(board.ep_square)]
+    return key
+
+
+# Bounded LRU cache of network evaluations keyed by position_key.
+class EvalCache:
+    def __init__(self, max_mb: float = 64):
+        self.capacity = max(1, int(max_mb * 2 ** 20) // EVAL_ENTRY_BYTES)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: int) -> bool:
+        return key in self.entries
+
+    def get(self, key: int) -> Optional[float]:
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    # lookup that neither counts towards the hit rate nor refreshes the entry
+    def peek(self, key: int, default: Optional[float] = None) -> Optional[float]:
+        return self.entries.get(key, default)
+
+    def put(self, key: int, value: float):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def __str__(self) -> str:
+        return f"eval cache {len(self)}/{self.capacity} entries, {self.hit_rate:.1%} hit rate ({self.hits} hits, {self.misses} misses)"
+
+
+EXACT, LOWER_BOUND, UPPER_BOUND = 0, 1, 2
+
+class TTEntry(NamedTuple):
+    key: int
+    depth: int
+    score: float
+    flag: int
+    move: Optional[chess.Move]
+    generation: int
+
+
+# Fixed-size transposition table for the search, one entry per slot. A slot keeps the deeper
+# result unless the stored one comes from an earlier search (generation), which is always replaced.
+class TranspositionTable:
+    def __init__(self, max_mb: float = 64):
+        self.num_slots = max(1, int(max_mb * 2 ** 20) // TT_ENTRY_BYTES)
+        self.slots = [None] * self.num_slots
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def new_search(self):
+        self.generation += 1
+
+    def probe(self, key: int) -> Optional[TTEntry]:
+        entry = self.slots[key % self.num_slots]
+        if entry is None or entry.key != key:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def store(self, key: int, depth: int, score: float, flag: int, move: Optional[chess.Move]):
+        index = key % self.num_slots
+        entry = self.slots[index]
+        if entry is None or entry.key == key or entry.generation != self.generation or depth >= entry.depth:
+            self.slots[index] = TTEntry(key, depth, score, flag, move, self.generation)
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def __str__(self) -> str:
+        return f"transposition table {self.num_slots} slots, {self.hit_rate:.1%} hit rate ({self.hits} hits, {self.misses} misses)"
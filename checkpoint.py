@@ -0,0 +1,87 @@
+import os
+import re
+import threading
+from typing import List, Optional, Tuple
+
+import torch
+
+CHECKPOINT_PATTERN = re.compile(r'^checkpoint_(\d+)\.pt$')
+
+# input: nested dicts/lists of tensors and plain values (state_dicts)
+# output: the same structure with every tensor copied to the CPU, so training can keep updating the originals
+def to_cpu(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+# output: (iter_num, path) of every checkpoint_<iter>.pt in out_dir, oldest first
+def list_checkpoints(out_dir: str) -> List[Tuple[int, str]]:
+    if not os.path.isdir(out_dir):
+        return []
+    checkpoints = []
+    for name in os.listdir(out_dir):
+        match = CHECKPOINT_PATTERN.match(name)
+        if match:
+            checkpoints.append((int(match.group(1)), os.path.join(out_dir, name)))
+    return sorted(checkpoints)
+
+def latest_checkpoint(out_dir: str) -> Optional[str]:
+    checkpoints = list_checkpoints(out_dir)
+    return checkpoints[-1][1] if checkpoints else None
+
+
+# Writes checkpoints from a background thread. save() only takes a CPU snapshot of the state and returns;
+# torch.save goes to a temporary file that is renamed over checkpoint_<iter>.pt once complete, so a crash
+# never leaves a truncated checkpoint under the real name. After each write, checkpoints that are neither
+# among the keep_last newest nor at a multiple of keep_every iterations are deleted (None keeps everything).
+class AsyncCheckpointer:
+    def __init__(self, out_dir: str, keep_last: Optional[int] = None, keep_every: Optional[int] = None):
+        self.out_dir = out_dir
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.thread = None
+        self.error = None
+        os.makedirs(out_dir, exist_ok=True)
+
+    def save(self, checkpoint: dict, iter_num: int) -> str:
+        # one write in flight at a time; a save that comes before the previous one finished waits for it
+        self.wait()
+        path = os.path.join(self.out_dir, f'checkpoint_{iter_num}.pt')
+        self.thread = threading.Thread(target=self.write, args=(to_cpu(checkpoint), path))
+        self.thread.start()
+        return path
+
+    def write(self, snapshot: dict, path: str):
+        try:
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                torch.save(snapshot, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            self.prune()
+            print(f"Checkpoint saved to {path}")
+        except Exception as e:
+            self.error = e
+
+    # blocks until the pending write is on disk and re-raises its error, if any
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def prune(self):
+        if self.keep_last is None:
+            return
+        checkpoints = list_checkpoints(self.out_dir)
+        newest = {iter_num for iter_num, _ in checkpoints[-self.keep_last:]} if self.keep_last > 0 else set()
+        for iter_num, path in checkpoints:
+            if iter_num not in newest and not (self.keep_every and iter_num % self.keep_every == 0):
+                os.remove(path)
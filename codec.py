@@ -0,0 +1,359 @@
+import random
+
+import chess
+import numpy as np
+import torch
+import torch.nn.functional as F
+from typing import List, Optional, Union
+
+from fen import FILE_TO_TOKEN, MAX_FEN_LENGTH, PIECE_TO_TOKEN, TAIL_TO_TOKEN, encode, is_normalized_fen, normalize_fen
+
+# Every conversion between boards, normalized FENs, token rows and packed positions lives here; the
+# dataloader, model, search, server and preprocessing all go through these functions and tables.
+# The part that needs no torch is in fen.py, which server clients import without loading torch; it is re-exported here.
+
+TOKEN_TO_PIECE = {v: k for k, v in TAIL_TO_TOKEN.items()}
+TOKEN_TO_PIECE[PIECE_TO_TOKEN['b']] = 'b'
+
+# Until version 2 the vocabulary listed 'b' twice, so the black bishop was read as token 15 like file b.
+# Checkpoints record the version they were trained with; see model.upgrade_state_dict.
+TOKENIZER_VERSION = 2
+
+# byte value -> token id, so a whole batch of FEN characters is tokenized with one numpy gather;
+# row 0 reads the board, row 1 the castling and en passant fields after it
+CHAR_TO_TOKEN = np.zeros((2, 256), dtype=np.int64)
+for row, vocabulary in enumerate((PIECE_TO_TOKEN, TAIL_TO_TOKEN)):
+    for piece, token in vocabulary.items():
+        if len(piece) == 1:
+            CHAR_TO_TOKEN[row, ord(piece)] = token
+BOARD_LOOKUP, TAIL_LOOKUP = CHAR_TO_TOKEN
+
+# token id -> byte value; <PAD> becomes a NUL byte, which numpy drops from the end of a fixed-width string
+TOKEN_TO_CHAR = np.zeros(256, dtype=np.uint8)
+for token, piece in TOKEN_TO_PIECE.items():
+    if len(piece) == 1:
+        TOKEN_TO_CHAR[token] = ord(piece)
+
+# the expanded board takes the same 72 tokens in every normalized FEN: 8 ranks of 8 squares, '/' between
+# ranks and the space before the castling field; only the castling and en passant tail varies in length
+BOARD_LENGTH = 72
+# token columns of the 64 squares, rank 8 first as in a FEN
+SQUARE_COLUMNS = (np.arange(8)[:, None] * 9 + np.arange(8)).ravel()
+
+def decode(tokens: List[int]) -> str:
+    return ''.join(TOKEN_TO_PIECE[token] for token in tokens if token != PIECE_TO_TOKEN['<PAD>'])
+
+# input: (number of FENs, width) token rows, tensor or array
+# output: the FENs, with runs of empty squares written as digits again
+def decode_batch(tokens: Union[torch.Tensor, np.ndarray]) -> List[str]:
+    tokens = np.asarray(tokens)
+    if len(tokens) == 0:
+        return []
+    chars = np.ascontiguousarray(TOKEN_TO_CHAR[tokens])
+    buffer = b'\n'.join(chars.view(f'S{chars.shape[1]}').ravel().tolist())
+    # a rank has at most 8 empty squares, so replacing the longest runs first never splits one
+    for run in range(8, 0, -1):
+        buffer = buffer.replace(b'.' * run, b'%d' % run)
+    return buffer.decode('ascii').split('\n')
+
+# input: token row of a FEN
+# output: the FEN, with runs of empty squares written as digits again
+def decode_fen(tokens: List[int]) -> str:
+    return decode_batch(np.asarray([tokens]))[0]
+
+# input: newline separated FENs, e.g. a block read straight from a file
+# output: (number of FENs, width) token tensor, identical row by row to encode() padded with <PAD>
+# width is max_seq_length when given, so every batch has the same static shape, else the longest FEN.
+# Fields must be separated by single spaces, as normalize_fen writes them.
+def encode_fen_buffer(buffer: bytes, max_seq_length: Optional[int] = None, dtype: torch.dtype = torch.int64,
+                      out: Optional[torch.Tensor] = None) -> torch.Tensor:
+    if not buffer:
+        return torch.empty((0, max_seq_length or 0), dtype=dtype)
+    if not buffer.endswith(b'\n'):
+        buffer += b'\n'
+    chars = np.frombuffer(buffer, dtype=np.uint8)
+    newline = chars == ord('\n')
+    space = chars == ord(' ')
+    line_ids = np.cumsum(newline) - newline
+    line_starts = np.flatnonzero(np.concatenate(([True], newline[:-1])))
+    num_lines = line_starts.size
+
+    # the board part is everything before the first space of a line; its digits expand to that many '.'
+    spaces_before = np.cumsum(space) - space
+    spaces_in_line = spaces_before - spaces_before[line_starts][line_ids]
+    in_board = (spaces_in_line == 0) & ~space & ~newline
+    empty_squares = in_board & (chars >= ord('0')) & (chars <= ord('9'))
+    counts = np.where(empty_squares, chars.astype(np.int64) - ord('0'), 1)
+    values = np.where(empty_squares, ord('.'), chars)
+
+    # encode() always puts a space after the board, so a FEN without other fields turns its newline into one
+    line_has_space = np.bincount(line_ids, weights=space, minlength=num_lines) > 0
+    counts[newline] = ~line_has_space
+    values[newline] = ord(' ')
+
+    expanded = np.repeat(values, counts)
+    in_tail = np.repeat(~in_board, counts)
+    rows = np.repeat(line_ids, counts)
+    lengths = np.bincount(rows, minlength=num_lines)
+    cols = np.arange(expanded.size) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+    width = max_seq_length if max_seq_length is not None else int(lengths.max(initial=0))
+    if lengths.size and lengths.max() > width:
+        raise ValueError(f"FEN encodes to {lengths.max()} tokens, more than max_seq_length={width}")
+
+    if out is None:
+        out = torch.empty((num_lines, width), dtype=dtype)
+    out.fill_(PIECE_TO_TOKEN['<PAD>'])
+    out.numpy()[rows, cols] = CHAR_TO_TOKEN[in_tail.view(np.uint8), expanded]
+    return out
+
+# input: list of FEN strings
+# output: same as encode_fen_buffer
+def encode_batch(fens: List[str], max_seq_length: Optional[int] = None, dtype: torch.dtype = torch.int64,
+                 out: Optional[torch.Tensor] = None) -> torch.Tensor:
+    return encode_fen_buffer('\n'.join(fens).encode('ascii'), max_seq_length=max_seq_length, dtype=dtype, out=out)
+
+
+# Packed position: the 64 squares of a normalized FEN as 4-bit piece codes, two squares per byte, a byte of
+# castling rights, a byte for the en passant file and the float32 eval; 38 bytes and no Python objects,
+# against roughly 200 for a (FEN str, float) tuple in a list.
+PACKED_POSITION = np.dtype([('squares', np.uint8, 32), ('flags', np.uint8), ('ep', np.uint8), ('eval', np.float32)])
+# 4-bit code -> board character; 0 is an empty square
+NIBBLE_PIECES = '.PNBRQKpnbrqk'
+NIBBLE_TO_TOKEN = BOARD_LOOKUP[np.frombuffer(NIBBLE_PIECES.encode('ascii'), dtype=np.uint8)]
+TOKEN_TO_NIBBLE = np.zeros(256, dtype=np.uint8)
+TOKEN_TO_NIBBLE[NIBBLE_TO_TOKEN] = np.arange(len(NIBBLE_PIECES))
+# flags bits 0-3: which of these castling rights the FEN lists
+CASTLING_RIGHTS = 'KQkq'
+CASTLING_TOKENS = BOARD_LOOKUP[np.frombuffer(CASTLING_RIGHTS.encode('ascii'), dtype=np.uint8)]
+# flags bit 4: the rights are listed lowercase first, which normalize_fen writes when black is to move
+BLACK_TO_MOVE = 1 << 4
+# ep: 0 without an en passant square, else the file plus one; the rank of a normalized FEN is always 6
+FILE_TOKENS = TAIL_LOOKUP[np.frombuffer(b'abcdefgh', dtype=np.uint8)]
+TOKEN_TO_FILE = np.zeros(256, dtype=np.uint8)
+TOKEN_TO_FILE[FILE_TOKENS] = np.arange(1, 9)
+
+# input: normalized FENs and their evals
+# output: PACKED_POSITION array, one row per FEN
+def pack_fens(fens: List[str], evals: Optional[List[float]] = None) -> np.ndarray:
+    tokens = encode_batch(fens, max_seq_length=MAX_FEN_LENGTH, dtype=torch.uint8).numpy()
+    packed = np.zeros(len(tokens), dtype=PACKED_POSITION)
+    nibbles = TOKEN_TO_NIBBLE[tokens[:, SQUARE_COLUMNS]]
+    packed['squares'] = nibbles[:, 0::2] | (nibbles[:, 1::2] << 4)
+
+    # after the board: castling rights (or '-'), a space, then the en passant square (or '-')
+    tail = tokens[:, BOARD_LENGTH:]
+    rights = (tail[:, :len(CASTLING_RIGHTS), None] == CASTLING_TOKENS).any(1)
+    packed['flags'] = rights @ (1 << np.arange(len(CASTLING_RIGHTS))) | np.where(np.isin(tail[:, 0], CASTLING_TOKENS[2:]), BLACK_TO_MOVE, 0)
+    rights_length = np.argmax(tail == PIECE_TO_TOKEN[' '], axis=1)
+    packed['ep'] = TOKEN_TO_FILE[tail[np.arange(len(tail)), rights_length + 1]]
+    if evals is not None:
+        packed['eval'] = evals
+    return packed
+
+# input: PACKED_POSITION array
+# output: (number of positions, width) token tensor, identical to encode_batch() of the FENs that were packed
+def unpack_tokens(packed: np.ndarray, max_seq_length: Optional[int] = None, dtype: torch.dtype = torch.int64) -> torch.Tensor:
+    n = len(packed)
+    nibbles = np.empty((n, 64), dtype=np.uint8)
+    nibbles[:, 0::2] = packed['squares'] & 15
+    nibbles[:, 1::2] = packed['squares'] >> 4
+    tokens = np.full((n, MAX_FEN_LENGTH), PIECE_TO_TOKEN['<PAD>'], dtype=np.int64)
+    tokens[:, SQUARE_COLUMNS] = NIBBLE_TO_TOKEN[nibbles]
+    tokens[:, 8:BOARD_LENGTH - 1:9] = PIECE_TO_TOKEN['/']
+    tokens[:, BOARD_LENGTH - 1] = PIECE_TO_TOKEN[' ']
+
+    # candidate tail tokens (four rights, '-' when there are none, space, en passant file and rank),
+    # then the ones that apply are moved to the front in order
+    flags, ep = packed['flags'].astype(np.int64), packed['ep'].astype(np.int64)
+    order = np.where((flags & BLACK_TO_MOVE)[:, None] > 0, [2, 3, 0, 1], [0, 1, 2, 3])
+    rights = (flags[:, None] >> order) & 1 > 0
+    candidates = np.empty((n, 8), dtype=np.int64)
+    candidates[:, :4] = CASTLING_TOKENS[order]
+    candidates[:, 4] = PIECE_TO_TOKEN['-']
+    candidates[:, 5] = PIECE_TO_TOKEN[' ']
+    candidates[:, 6] = np.where(ep > 0, FILE_TOKENS[np.maximum(ep - 1, 0)], PIECE_TO_TOKEN['-'])
+    candidates[:, 7] = PIECE_TO_TOKEN['6']
+    valid = np.concatenate((rights, ~rights.any(1, keepdims=True), np.ones((n, 2), dtype=bool), (ep > 0)[:, None]), axis=1)
+    front = np.argsort(~valid, axis=1, kind='stable')
+    tail = np.where(np.take_along_axis(valid, front, 1), np.take_along_axis(candidates, front, 1), PIECE_TO_TOKEN['<PAD>'])
+    tokens[:, BOARD_LENGTH:] = tail[:, :MAX_FEN_LENGTH - BOARD_LENGTH]
+
+    lengths = BOARD_LENGTH + valid.sum(1)
+    width = max_seq_length if max_seq_length is not None else int(lengths.max(initial=0))
+    if lengths.size and lengths.max() > width:
+        raise ValueError(f"FEN encodes to {lengths.max()} tokens, more than max_seq_length={width}")
+    if width > MAX_FEN_LENGTH:
+        tokens = np.pad(tokens, ((0, 0), (0, width - MAX_FEN_LENGTH)))
+    return torch.from_numpy(tokens[:, :width]).to(dtype)
+
+# input: PACKED_POSITION array
+# output: the normalized FENs that were packed
+def unpack_fens(packed: np.ndarray) -> List[str]:
+    return decode_batch(unpack_tokens(packed))
+
+
+PIECE_MAP = {1: "P", 2: "P", 3: "R", 4: "R", 5: "N", 6: "B", 7: "B", 8: "Q", 9: "K", 10: "K",
+             11: "p", 12: "p", 13: "r", 14: "r", 15: "n", 16: "b", 17: "b", 18: "q", 19: "k", 20: "k"}
+
+# input: 8x8 Torch tensor
+# output: FEN string
+def convert_torch_to_fen(tensor):
+    board = tensor.tolist()
+    fen = ""
+
+    en_passant_str = "-"
+    empty_count = 0
+    for row in range(8):
+        for col in range(8):
+            if board[row][col] == 0:
+                empty_count += 1
+                if col == 7:
+                    fen += str(empty_count)
+                    empty_count = 0
+            else:
+                if empty_count > 0:
+                    fen += str(empty_count)
+                    empty_count = 0
+                fen += PIECE_MAP[board[row][col]]
+            if board[row][col] == 12:
+                if col > 0 and board[row][col - 1] == 1:
+                    en_passant_str = chr(ord("a") + col) + "6"
+                elif col < 7 and board[row][col + 1] == 1:
+                    en_passant_str = chr(ord("a") + col) + "6"
+        if row != 7:
+            fen += "/"
+        else:
+            fen += " "
+
+    castling_is_legal = False
+    if board[7][3] == 9:
+        # checking if "black" can castle
+        if board[7][0] == 3:
+            castling_is_legal = True
+            fen += "K"
+        if board[7][7] == 3:
+            castling_is_legal = True
+            fen += "Q"
+
+    if board[7][4] == 9:
+        # checking if white can castle
+        if board[7][7] == 3:
+            castling_is_legal = True
+            fen += "K"
+        if board[7][0] == 3:
+            castling_is_legal = True
+            fen += "Q"
+
+    if board[0][3] == 9:
+        # checking if "white" can castle
+        if board[0][0] == 3:
+            castling_is_legal = True
+            fen += "k"
+        if board[0][7] == 3:
+            castling_is_legal = True
+            fen += "q"
+
+    if board[0][4] == 9:
+        # checking if black can castle
+        if board[0][7] == 3:
+            castling_is_legal = True
+            fen += "k"
+        if board[0][0] == 3:
+            castling_is_legal = True
+            fen += "q"
+
+    if not castling_is_legal:
+        fen += "-"
+
+    fen += " "
+    fen += en_passant_str
+    return fen
+
+# PIECE_MAP code -> token id, code 0 is an empty square
+BOARD_CODE_TO_TOKEN = torch.tensor([PIECE_TO_TOKEN['.']] + [PIECE_TO_TOKEN[PIECE_MAP[code]] for code in range(1, 21)])
+
+# (row, col) of the king and rook squares checked by convert_torch_to_fen, in the order it appends castling letters
+CASTLING_CHECKS = [((7, 3), (7, 0), 'K'), ((7, 3), (7, 7), 'Q'),
+                   ((7, 4), (7, 7), 'K'), ((7, 4), (7, 0), 'Q'),
+                   ((0, 3), (0, 0), 'k'), ((0, 3), (0, 7), 'q'),
+                   ((0, 4), (0, 7), 'k'), ((0, 4), (0, 0), 'q')]
+BOARD_CASTLING_TOKENS = torch.tensor([PIECE_TO_TOKEN[letter] for _, _, letter in CASTLING_CHECKS])
+
+# input: (batch, 8, 8) tensor of PIECE_MAP codes
+# output: token tensor on the same device, identical to encode_batch([convert_torch_to_fen(b) for b in boards])
+# With max_seq_length the rows are padded (or cut) to that fixed width instead, which needs no device sync.
+def board_to_tokens(boards, max_seq_length=None):
+    boards = boards.long()
+    batch_size, device = boards.shape[0], boards.device
+
+    # ranks joined by '/' give the fixed 71-token board part
+    squares = BOARD_CODE_TO_TOKEN.to(device)[boards]
+    slashes = torch.full((batch_size, 8, 1), PIECE_TO_TOKEN['/'], dtype=torch.long, device=device)
+    board_tokens = torch.cat([squares, slashes], dim=2).reshape(batch_size, 72)[:, :71]
+
+    castling = torch.stack([(boards[:, kr, kc] == 9) & (boards[:, rr, rc] == 3)
+                            for (kr, kc), (rr, rc), _ in CASTLING_CHECKS], dim=1)
+    no_castling = ~castling.any(dim=1, keepdim=True)
+
+    # en passant: the last pawn (code 12) in row-major order with a code 1 pawn next to it
+    left = torch.zeros_like(boards, dtype=torch.bool)
+    right = torch.zeros_like(boards, dtype=torch.bool)
+    left[:, :, 1:] = boards[:, :, :-1] == 1
+    right[:, :, :-1] = boards[:, :, 1:] == 1
+    en_passant = ((boards == 12) & (left | right)).reshape(batch_size, 64)
+    last_square = torch.where(en_passant, torch.arange(64, device=device), -1).max(dim=1, keepdim=True).values
+    has_en_passant = last_square >= 0
+    en_passant_file = torch.where(has_en_passant, FILE_TO_TOKEN['a'] + last_square % 8, PIECE_TO_TOKEN['-'])
+
+    # variable-length tail: castling letters or '-', ' ', en passant file or '-', '6' if there is an en passant square
+    def column(token):
+        return torch.full((batch_size, 1), token, dtype=torch.long, device=device)
+
+    tail = torch.cat([BOARD_CASTLING_TOKENS.to(device).expand(batch_size, -1), column(PIECE_TO_TOKEN['-']),
+                      column(PIECE_TO_TOKEN[' ']), en_passant_file, column(PIECE_TO_TOKEN['6'])], dim=1)
+    keep = torch.cat([castling, no_castling, torch.ones_like(no_castling), torch.ones_like(no_castling), has_en_passant], dim=1)
+
+    # pack the kept tail tokens to the left; dropped ones go to a scratch column that is cut off
+    target = torch.where(keep, keep.cumsum(dim=1) - 1, tail.shape[1])
+    packed = torch.zeros((batch_size, tail.shape[1] + 1), dtype=torch.long, device=device)
+    packed.scatter_(1, target, torch.where(keep, tail, 0))
+
+    if max_seq_length is not None:
+        tokens = torch.cat([board_tokens, column(PIECE_TO_TOKEN[' ']), packed[:, :-1]], dim=1)
+        # a negative pad crops; the longest tail convert_torch_to_fen writes for a legal position still fits in 79
+        return F.pad(tokens, (0, max_seq_length - tokens.shape[1]), value=PIECE_TO_TOKEN['<PAD>'])
+
+    # encode_batch pads to the longest FEN in the batch, so the width is the one value read back from the device
+    width = int(keep.sum(dim=1).max())
+    return torch.cat([board_tokens, column(PIECE_TO_TOKEN[' ']), packed[:, :width]], dim=1)
+
+# input: number of boards, seed
+# output: (n, 8, 8) PIECE_MAP code tensor with unmoved kings/rooks and double-stepped pawns sprinkled in,
+# e.g. example inputs for tracing a model in test_mode
+def random_boards(n, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    boards = torch.randint(0, 21, (n, 8, 8), generator=generator)
+    boards[torch.rand(n, 8, 8, generator=generator) < 0.6] = 0
+    for row, col, code in ((7, 3, 9), (7, 4, 9), (0, 3, 9), (7, 0, 3), (7, 7, 3), (0, 0, 3), (0, 7, 3), (3, 4, 12), (3, 5, 1)):
+        boards[torch.rand(n, generator=generator) < 0.5, row, col] = code
+    return boards
+
+# input: number of boards, seed
+# output: boards from random playouts, covering castling rights, en passant squares and both sides to move
+def random_playout_boards(n, seed=0):
+    rng = random.Random(seed)
+    boards = []
+    while len(boards) < n:
+        board = chess.Board()
+        for _ in range(rng.randint(0, 120)):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            board.push(rng.choice(moves))
+            boards.append(board.copy(stack=False))
+    return boards[:n]
+
+# normalized FENs of random_playout_boards
+def random_fens(n, seed=0):
+    return [normalize_fen(board) for board in random_playout_boards(n, seed)]
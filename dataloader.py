@@ -1,136 +1,370 @@
+import os
 import chess
 import chess.pgn
 import re
 import numpy as np
 import torch
-from torch.utils.data import IterableDataset, DataLoader
-from typing import Tuple, List, Iterator
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+from typing import Tuple, List, Iterator, Optional, Union
 import random
+import time
+from functools import partial
 
+from codec import PACKED_POSITION, normalize_fen, pack_fens, unpack_tokens
 
-PIECE_TO_TOKEN = {
-    '<PAD>': 0, 'P': 1, 'N': 2, 'B': 3, 'R': 4, 'Q': 5, 'K': 6,
-    'p': 7, 'n': 8, 'b': 9, 'r': 10, 'q': 11, 'k': 12,
-    '-': 13, 'a': 14, 'b': 15, 'c': 16, 'd': 17, 
-    'e': 18, 'f': 19, 'g': 20, 'h': 21,
-    '0': 22, '1': 23, '2': 24, '3': 25, '4': 26, '5': 27, '6': 28, '7': 29, '8': 30, '9': 31,
-    ' ': 32, '/': 33, '.': 34
-}
 
-TOKEN_TO_PIECE = {v: k for k, v in PIECE_TO_TOKEN.items()}
+def pgn_has_headers(pgn_file_path: str) -> bool:
+    with open(pgn_file_path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                return line.startswith(b'[')
+    return False
 
+# input: pgn file path, byte offset
+# output: byte offset of the first game that starts at or after `offset`
+# A game starts on a non-blank line that follows a blank line (or the start of the file). Files written
+# with headers only count lines that open a header block, so the movetext after the headers is not a new game.
+def align_to_game_start(pgn_file_path: str, offset: int, has_headers: bool) -> int:
+    size = os.path.getsize(pgn_file_path)
+    if offset <= 0:
+        return 0
+    if offset >= size:
+        return size
+
+    with open(pgn_file_path, 'rb') as f:
+        f.seek(offset - 1)
+        if f.read(1) != b'\n':
+            f.readline()
+        pos = f.tell()
+        f.seek(max(0, pos - 4))
+        before = f.read(pos - max(0, pos - 4))
+        prev_blank = pos <= 1 or before.endswith(b'\n\n') or before.endswith(b'\n\r\n')
+
+        for line in f:
+            blank = not line.strip()
+            if prev_blank and not blank and (not has_headers or line.startswith(b'[')):
+                return pos
+            prev_blank = blank
+            pos += len(line)
+    return size
+
+# (normalized fen, side to move, is checkmate, comment) for one mainline move
+MainlinePosition = Tuple[str, bool, bool, str]
+
+# Collects the mainline positions of a game while the parser pushes moves onto a single board.
+# Variations are skipped and no GameNode tree is built, so a game costs O(length) instead of
+# replaying it from the root for every node.
+class MainlineVisitor(chess.pgn.BaseVisitor):
+    def begin_game(self):
+        self.positions = []
+        self.moved = False
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def visit_move(self, board: chess.Board, move: chess.Move):
+        self.moved = True
+
+    def visit_board(self, board: chess.Board):
+        if self.moved:
+            self.positions.append((normalize_fen(board), board.turn, board.is_checkmate(), ""))
+            self.moved = False
+
+    def visit_comment(self, comment: str):
+        # comments before the first move belong to the game, not to a position
+        if self.positions:
+            fen, turn, is_checkmate, previous = self.positions[-1]
+            self.positions[-1] = (fen, turn, is_checkmate, " ".join(filter(None, [previous, comment])))
+
+    def handle_error(self, error: Exception):
+        # like GameBuilder, an illegal move ends the mainline instead of aborting the whole file
+        pass
+
+    def result(self) -> List[MainlinePosition]:
+        return self.positions
+
+# input: open PGN text handle
+# output: mainline positions of the next game, or None at the end of the file
+def read_mainline(pgn) -> Optional[List[MainlinePosition]]:
+    return chess.pgn.read_game(pgn, Visitor=MainlineVisitor)
+
+# input: side to move, whether it is checkmate, comment on the move that led to the position, alpha
+# output: eval for the side to move in [-alpha, 1 + alpha], or None for a position without an eval comment, which is skipped
+def position_eval(turn: chess.Color, is_checkmate: bool, comment: str, alpha: float = 0.1) -> Optional[float]:
+    if is_checkmate:
+        eval = -alpha
+    elif not comment:
+        return None
+    else:
+        score = comment.split(" ")[1][:-1]
+        if "#" in score:
+            winning_color = chess.BLACK if '-' in score else chess.WHITE
+            moves_left = int(re.findall(r'\d+', score)[0])
+            eval = (1 + alpha / (moves_left + 1)) if winning_color == turn else (-alpha / (moves_left + 1))
+        else:
+            eval = 1 / (1 + np.exp(-0.00368208 * float(score) * 100))
+            if turn == chess.BLACK:
+                eval = 1 - eval
+
+    assert -alpha <= eval <= 1 + alpha
+    return float(eval)
+
+# upper bound on DataLoader workers per dataset, the number of rows of the shared counters and cursors
+MAX_WORKERS = 256
+# upper bound on file cursors interleaved by one worker
+MAX_CURSORS = 64
+# range index of a cursor that has no games left
+EXHAUSTED = 1 << 30
+
+# Growable PACKED_POSITION storage. Rows go into preallocated blocks of block_size; a full block is never
+# copied or reallocated, and clear() keeps the blocks for reuse.
+class PositionBuffer:
+    def __init__(self, block_size: int = 1 << 16):
+        self.block_size = block_size
+        self.blocks = []
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def append(self, packed: np.ndarray):
+        start = 0
+        while start < len(packed):
+            block, offset = divmod(self.size, self.block_size)
+            if block == len(self.blocks):
+                self.blocks.append(np.empty(self.block_size, dtype=PACKED_POSITION))
+            count = min(len(packed) - start, self.block_size - offset)
+            self.blocks[block][offset:offset + count] = packed[start:start + count]
+            start += count
+            self.size += count
+
+    def clear(self):
+        self.size = 0
+
+    # output: the rows appended since the last clear(), copied into one contiguous array
+    def array(self) -> np.ndarray:
+        full, rest = divmod(self.size, self.block_size)
+        parts = self.blocks[:full] + ([self.blocks[full][:rest]] if rest else [])
+        return np.concatenate(parts) if parts else np.empty(0, dtype=PACKED_POSITION)
+
+# output: (DataLoader worker id, number of workers), (0, 1) when loading in the main process
+def current_worker() -> Tuple[int, int]:
+    worker_info = get_worker_info()
+    return (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+
+# (cursor index, range index, byte offset of the game, mainline positions)
+CursorGame = Tuple[int, int, int, List[MainlinePosition]]
+
+# Streams packed (position, eval) training rows out of PGN files.
+# Each worker reads num_cursors disjoint parts of the data at once and takes one game from every cursor in
+# turn, so consecutive games come from far-apart places in the files. Positions are collected into a
+# shuffle window of at least chunk_size positions, kept packed (PACKED_POSITION, 38 bytes each), which is
+# permuted and emitted whole; collate_fn turns the packed rows into tokens one batch at a time. The
+# permutation of window w in epoch e of worker k is drawn from the seed, so a run is reproducible, and a
+# window is resumable from its cursor offsets alone. Under distributed training every rank builds its own
+# dataset with its rank and the world size, and the ranks read disjoint parts of the data.
 class ChessPositionDataset(IterableDataset):
-    def __init__(self, pgn_file_path: str = 'sample.pgn', alpha: float = 0.1, chunk_size: int = 10000):
-        self.pgn_file_path = pgn_file_path
+    def __init__(self, pgn_file_paths: Union[str, List[str]] = 'sample.pgn', alpha: float = 0.1, chunk_size: int = 10000,
+                 num_cursors: int = 1, seed: Optional[int] = None, rank: int = 0, world_size: int = 1):
+        if not 1 <= num_cursors <= MAX_CURSORS:
+            raise ValueError(f"num_cursors must be between 1 and {MAX_CURSORS}")
+        self.pgn_file_paths = [pgn_file_paths] if isinstance(pgn_file_paths, str) else list(pgn_file_paths)
         self.alpha = alpha
         self.chunk_size = chunk_size
-        self.current_chunk = []
-        self.pgn = open(self.pgn_file_path)
-        self.game = chess.pgn.read_game(self.pgn)
-
-    def __iter__(self) -> Iterator[Tuple[str, float]]:
-        return self
-
-    def __next__(self) -> Tuple[str, float]:
-        if not self.current_chunk:
-            self.load_chunk()
-        
-        if not self.current_chunk:
-            raise StopIteration
-
-        return self.current_chunk.pop()
-
-    def load_chunk(self):
-        self.current_chunk = []
-        while len(self.current_chunk) < self.chunk_size:
-            if self.game is None:
-                break
-            self.current_chunk.extend(self.process_game(self.game))
-            self.game = chess.pgn.read_game(self.pgn)
-        
-        random.shuffle(self.current_chunk)
-
-    def process_game(self, game) -> List[Tuple[str, float]]:
-        positions = []
-        node = game.variations[0] if game.variations else None
-        while node is not None:
-            b = node.board()
-            ### START FEN SECTION
-            fen = b.fen()
-            if b.turn == chess.BLACK:
-                fen = fen.swapcase()
-            temp = fen.split(' ')[:-2]
-            del temp[-3]
-            if temp[-1] != "-" and b.turn == chess.BLACK:
-                temp[-1] = temp[-1][:1].swapcase() + str(6)
-            fen = ' '.join(temp)
-            ### END FEN SECTION
-            
-            if b.is_checkmate():
-                eval = -self.alpha
-            elif not node.comment:
-                node = node.variations[0] if node.variations else None
+        self.num_cursors = num_cursors
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = random.randrange(2 ** 32) if seed is None else seed
+        self.epoch = 0
+        # (games, positions) produced by each DataLoader worker, in shared memory so the training
+        # process sees the counts of worker processes; read through throughput()
+        self.counters = torch.zeros(MAX_WORKERS, 2, dtype=torch.int64).share_memory_()
+        self.last_counts = (0, 0, time.perf_counter())
+        # per worker, the index of its previous and its current window and where each cursor stood at their
+        # start as (range index, byte offset); read through state_dict()
+        self.windows = torch.full((MAX_WORKERS, 2), -1, dtype=torch.int64).share_memory_()
+        self.cursors = torch.full((MAX_WORKERS, 2, MAX_CURSORS, 2), -1, dtype=torch.int64).share_memory_()
+        self.num_workers = torch.ones(1, dtype=torch.int64).share_memory_()
+        self.resume_state = None
+
+    def throughput(self) -> Tuple[float, float]:
+        games, positions = self.counters.sum(0).tolist()
+        last_games, last_positions, last_time = self.last_counts
+        now = time.perf_counter()
+        self.last_counts = (games, positions, now)
+        elapsed = max(now - last_time, 1e-9)
+        return (games - last_games) / elapsed, (positions - last_positions) / elapsed
+
+    # Windows are reshuffled differently every epoch; call before iterating over the data again.
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    # Position in the data to resume from: for every worker, the start of the window before the one it is
+    # yielding. Batches still in the DataLoader queue may come from that window, so resuming there re-reads
+    # at most two windows per worker but skips nothing, as long as chunk_size exceeds what a worker prefetches.
+    def state_dict(self) -> dict:
+        num_workers = int(self.num_workers[0])
+        workers = []
+        for worker_id in range(num_workers):
+            slot = 0 if self.windows[worker_id, 0] >= 0 else 1
+            workers.append({'window': int(self.windows[worker_id, slot]),
+                            'cursors': self.cursors[worker_id, slot, :self.num_cursors].tolist()})
+        return {'pgn_file_paths': self.pgn_file_paths, 'num_workers': num_workers, 'num_cursors': self.num_cursors,
+                'rank': self.rank, 'world_size': self.world_size, 'seed': self.seed, 'epoch': self.epoch, 'workers': workers}
+
+    # applies to the next pass over the data only; the caller clears resume_state before starting another epoch
+    def load_state_dict(self, state: Optional[dict]):
+        self.resume_state = state
+        if state is not None:
+            self.seed = state['seed']
+            self.epoch = state['epoch']
+
+    # Every (rank, worker, cursor) slot gets a disjoint set of (file, start, end) byte ranges: whole files when
+    # there are at least as many files as slots, otherwise an equal byte slice of every file
+    # aligned to game boundaries. Together the ranges cover each game exactly once per epoch.
+    def worker_ranges(self, slot: int, num_slots: int) -> List[Tuple[str, int, int]]:
+        if len(self.pgn_file_paths) >= num_slots:
+            return [(path, 0, os.path.getsize(path)) for path in self.pgn_file_paths[slot::num_slots]]
+
+        ranges = []
+        for path in self.pgn_file_paths:
+            size = os.path.getsize(path)
+            has_headers = pgn_has_headers(path)
+            start = align_to_game_start(path, size * slot // num_slots, has_headers)
+            end = align_to_game_start(path, size * (slot + 1) // num_slots, has_headers)
+            if start < end:
+                ranges.append((path, start, end))
+        return ranges
+
+    # output: (byte offset where the game starts, mainline positions) for each game in [start, end)
+    def read_games(self, pgn_file_path: str, start: int, end: int) -> Iterator[Tuple[int, List[MainlinePosition]]]:
+        with open(pgn_file_path) as pgn:
+            pgn.seek(start)
+            while True:
+                # skip the blank lines between games so the range check sees where the next game begins
+                pos = pgn.tell()
+                line = pgn.readline()
+                while line and not line.strip():
+                    pos = pgn.tell()
+                    line = pgn.readline()
+                if not line or pos >= end:
+                    return
+                pgn.seek(pos)
+
+                positions = read_mainline(pgn)
+                if positions is None:
+                    return
+                yield pos, positions
+
+    # output: (range index, byte offset, positions) for the games of one cursor, starting at the given game
+    def read_cursor(self, ranges: List[Tuple[str, int, int]], first_range: int = 0, first_offset: int = -1) -> Iterator[Tuple[int, int, List[MainlinePosition]]]:
+        for range_index, (pgn_file_path, start, end) in enumerate(ranges):
+            if range_index < first_range:
                 continue
-            else:
-                score = node.comment.split(" ")[1][:-1]
-                if "#" in score:
-                    winning_color = chess.BLACK if '-' in score else chess.WHITE
-                    moves_left = int(re.findall(r'\d+', score)[0])
-                    eval = (1 + self.alpha / (moves_left + 1)) if winning_color == b.turn else (-self.alpha / (moves_left + 1))
+            if range_index == first_range and first_offset >= 0:
+                start = first_offset
+            for offset, positions in self.read_games(pgn_file_path, start, end):
+                yield range_index, offset, positions
+
+    # output: rounds of one game from every cursor that still has games, in cursor order
+    def read_rounds(self, cursors: List[Iterator]) -> Iterator[List[CursorGame]]:
+        active = list(enumerate(cursors))
+        while active:
+            games = []
+            for index, cursor in list(active):
+                game = next(cursor, None)
+                if game is None:
+                    active.remove((index, cursor))
                 else:
-                    eval = 1 / (1 + np.exp(-0.00368208 * float(score) * 100))
-                    if b.turn == chess.BLACK:
-                        eval = 1 - eval
-            
-            assert -self.alpha <= eval <= 1 + self.alpha
-            positions.append((fen, eval))
-            
-            node = node.variations[0] if node.variations else None
-        
-        return positions
-
-    def __del__(self):
-        self.pgn.close()
-
-def encode(fen: str) -> List[int]:
-    tokens = []
-    parts = fen.split()
-    board = parts[0]
-    
-    # Encode the board part
-    for char in board:
-        if char.isdigit():
-            tokens.extend([PIECE_TO_TOKEN['.']] * int(char))
-        else:
-            tokens.append(PIECE_TO_TOKEN[char])
-
-    tokens.append(PIECE_TO_TOKEN[' '])
-    # Encode the rest of the FEN
-    for char in ' '.join(parts[1:]):
-        tokens.append(PIECE_TO_TOKEN[char])
-    
-    return tokens
-
-def decode(tokens: List[int]) -> str:
-    return ''.join(TOKEN_TO_PIECE[token] for token in tokens if token != PIECE_TO_TOKEN['<PAD>'])
-
-def collate_fn(batch: List[Tuple[str, float]]) -> Tuple[torch.Tensor, torch.Tensor]:
-    fens, evals = zip(*batch)
-    encoded_fens = [encode(fen) for fen in fens]
-    
-    # Find the maximum length of encoded FENs
-    max_len = max(len(tokens) for tokens in encoded_fens)
-    
-    # Pad all encoded FENs to the maximum length
-    padded_fens = [tokens + [PIECE_TO_TOKEN['<PAD>']] * (max_len - len(tokens)) for tokens in encoded_fens]
-    
-    return torch.tensor(padded_fens), torch.tensor(evals)
-
-def get_chess_position_dataloader(pgn_file_path: str = 'overnight_training.pgn', batch_size: int = 32, alpha: float = 0.1, chunk_size: int = 10000) -> DataLoader:
-    dataset = ChessPositionDataset(pgn_file_path, alpha=alpha, chunk_size=chunk_size)
-    return DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn, pin_memory=True)
+                    games.append((index,) + game)
+            if games:
+                yield games
+
+    def __iter__(self) -> Iterator[np.void]:
+        worker_id, num_workers = current_worker()
+        self.num_workers[0] = num_workers
+        windows, cursors = self.windows[worker_id].numpy(), self.cursors[worker_id].numpy()
+        windows[:] = -1
+        cursors[:] = -1
+
+        # cursor i of worker k on rank r reads slot (i * num_workers + k) * world_size + r, so the cursors of
+        # one worker, and the workers of one rank, are spread over the data
+        num_slots = self.world_size * num_workers * self.num_cursors
+        cursor_ranges = [self.worker_ranges((index * num_workers + worker_id) * self.world_size + self.rank, num_slots)
+                         for index in range(self.num_cursors)]
+        window, starts = 0, [(0, -1)] * self.num_cursors
+        state = self.resume_state
+        if state is not None:
+            layout = (self.pgn_file_paths, num_workers, self.num_cursors, self.rank, self.world_size)
+            if (state['pgn_file_paths'], state['num_workers'], state['num_cursors'], state.get('rank', 0), state.get('world_size', 1)) == layout:
+                if state['workers'][worker_id]['window'] >= 0:
+                    window, starts = state['workers'][worker_id]['window'], state['workers'][worker_id]['cursors']
+            elif worker_id == 0:
+                print("dataset state is for different files, workers, cursors or ranks, starting from the beginning")
+
+        rounds = self.read_rounds([self.read_cursor(ranges, *start) for ranges, start in zip(cursor_ranges, starts)])
+        for window, window_starts, positions in self.load_windows(rounds, window):
+            windows[0], windows[1] = windows[1], window
+            cursors[0] = cursors[1]
+            cursors[1, :self.num_cursors] = window_starts
+            yield from positions
+
+    # output: (window index, (range index, offset) of every cursor's first game, shuffled PACKED_POSITION rows) per window
+    # A window only ends after a full round, so it holds at least one game of every cursor that has games left.
+    def load_windows(self, rounds: Iterator[List[CursorGame]], window: int = 0) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        worker_id = current_worker()[0]
+        counts = self.counters[worker_id].numpy()
+        buffer, starts = PositionBuffer(), None
+        for games in rounds:
+            if starts is None:
+                starts = np.full((self.num_cursors, 2), (EXHAUSTED, -1), dtype=np.int64)
+                for index, range_index, offset, _ in games:
+                    starts[index] = range_index, offset
+            samples = []
+            for _, _, _, positions in games:
+                game_samples = self.process_positions(positions)
+                counts += (1, len(game_samples))
+                samples.extend(game_samples)
+            if samples:
+                fens, evals = zip(*samples)
+                buffer.append(pack_fens(fens, evals))
+            if len(buffer) >= self.chunk_size:
+                yield self.shuffle_window(worker_id, window, starts, buffer)
+                window += 1
+                buffer.clear()
+                starts = None
+
+        if len(buffer):
+            yield self.shuffle_window(worker_id, window, starts, buffer)
+
+    def shuffle_window(self, worker_id: int, window: int, starts: np.ndarray, buffer: PositionBuffer) -> Tuple[int, np.ndarray, np.ndarray]:
+        permutation = np.random.default_rng([self.seed, self.epoch, worker_id, window]).permutation(len(buffer))
+        return window, starts, buffer.array()[permutation]
+
+    def process_game(self, game: chess.pgn.Game) -> List[Tuple[str, float]]:
+        return self.process_positions(game.accept(MainlineVisitor()))
+
+    def process_positions(self, positions: List[MainlinePosition]) -> List[Tuple[str, float]]:
+        output = []
+        for fen, turn, is_checkmate, comment in positions:
+            eval = position_eval(turn, is_checkmate, comment, self.alpha)
+            if eval is not None:
+                output.append((fen, eval))
+        return output
+
+# input: PACKED_POSITION rows as yielded by ChessPositionDataset
+# output: (tokens, evals); positions are turned into tokens only here, one batch at a time
+def collate_fn(batch: List[np.void], max_seq_length: Optional[int] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+    packed = np.array(batch, dtype=PACKED_POSITION)
+    return unpack_tokens(packed, max_seq_length=max_seq_length), torch.from_numpy(np.ascontiguousarray(packed['eval']))
+
+def get_chess_position_dataloader(pgn_file_path: Union[str, List[str]] = 'overnight_training.pgn', batch_size: int = 32, alpha: float = 0.1, chunk_size: int = 10000, num_workers: int = 0, max_seq_length: Optional[int] = None,
+                                  num_cursors: int = 1, seed: Optional[int] = None, rank: int = 0, world_size: int = 1) -> DataLoader:
+    dataset = ChessPositionDataset(pgn_file_path, alpha=alpha, chunk_size=chunk_size, num_cursors=num_cursors, seed=seed,
+                                   rank=rank, world_size=world_size)
+    return DataLoader(dataset, batch_size=batch_size, collate_fn=partial(collate_fn, max_seq_length=max_seq_length), pin_memory=True, num_workers=num_workers)
 
 # Example usage:
-# dataloader = get_chess_position_dataloader('chinchilla_optimal.pgn', batch_size=1024, alpha=0.1, chunk_size=1000)
+# dataloader = get_chess_position_dataloader(['lichess_2013-01.pgn', 'lichess_2013-02.pgn'], batch_size=1024, alpha=0.1, chunk_size=1000, num_workers=8)
 # for tokens, evaluations in dataloader:
 #    break
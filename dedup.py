@@ -0,0 +1,224 @@
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+import torch
+import yaml
+from torch.utils.data import Dataset, DataLoader, DistributedSampler
+from typing import List, Optional, Tuple, Union
+
+from codec import PACKED_POSITION, pack_fens, unpack_fens, unpack_tokens
+from dataloader import PositionBuffer, position_eval, read_mainline
+from shards import shard_collate_fn
+
+# a position is identified by its packed bytes before the eval: squares, castling flags and en passant file
+KEY_SIZE = PACKED_POSITION.fields['eval'][1]
+# running aggregate of one position while the index is built; the eval sum stays float64 so means are exact
+ACCUMULATED = np.dtype([('key', f'V{KEY_SIZE}'), ('eval_sum', np.float64), ('count', np.int64)])
+# one row of the finished index: the packed position with its mean eval, and how often it was seen
+DEDUP_POSITION = np.dtype(PACKED_POSITION.descr + [('count', np.uint32)])
+POSITIONS_PATTERN = 'positions_*.npy'
+
+# input: PACKED_POSITION array
+# output: the key bytes of every row as one void scalar each
+def position_keys(packed: np.ndarray) -> np.ndarray:
+    rows = np.ascontiguousarray(packed).view(np.uint8).reshape(len(packed), PACKED_POSITION.itemsize)
+    return np.ascontiguousarray(rows[:, :KEY_SIZE]).view(f'V{KEY_SIZE}').ravel()
+
+# input: ACCUMULATED rows, possibly with repeated keys
+# output: one ACCUMULATED row per key, sorted by key
+def merge(rows: np.ndarray) -> np.ndarray:
+    keys, inverse = np.unique(rows['key'], return_inverse=True)
+    merged = np.empty(len(keys), dtype=ACCUMULATED)
+    merged['key'] = keys
+    merged['eval_sum'] = np.bincount(inverse, weights=rows['eval_sum'], minlength=len(keys))
+    merged['count'] = np.bincount(inverse, weights=rows['count'], minlength=len(keys))
+    return merged
+
+# input: keys, number of buckets
+# output: bucket of every key, from a multiplicative hash of its bytes
+def bucket_of(keys: np.ndarray, num_buckets: int) -> np.ndarray:
+    words = np.zeros((len(keys), -(-KEY_SIZE // 8) * 8), dtype=np.uint8)
+    words[:, :KEY_SIZE] = np.ascontiguousarray(keys).view(np.uint8).reshape(len(keys), KEY_SIZE)
+    h = np.zeros(len(keys), dtype=np.uint64)
+    for word in words.view(np.uint64).T:
+        h = (h ^ word) * np.uint64(0x9E3779B97F4A7C15)
+    return ((h >> np.uint64(32)) % np.uint64(num_buckets)).astype(np.int64)
+
+
+# Hash index of every distinct position, with the number of times it was seen and the sum of its evals.
+# Positions are added in batches; they wait in a PositionBuffer and are folded into a key-sorted table once
+# there are at least as many as the table holds (so each position is re-sorted only O(log n) times). When
+# the table grows past max_positions it is spilled to disk, split into num_buckets files by key hash; since
+# equal keys always land in the same bucket, finish() can merge every bucket on its own in memory.
+class PositionIndex:
+    def __init__(self, out_dir: str, max_positions: int = 10_000_000, num_buckets: int = 64, flush_size: int = 1 << 20):
+        self.out_dir = out_dir
+        self.spill_dir = os.path.join(out_dir, 'spill')
+        self.max_positions = max_positions
+        self.num_buckets = num_buckets
+        self.flush_size = flush_size
+        self.table = np.empty(0, dtype=ACCUMULATED)
+        self.pending = PositionBuffer()
+        self.positions = 0
+        self.spills = 0
+        os.makedirs(out_dir, exist_ok=True)
+        # buckets left behind by an interrupted build would be merged into this one
+        for path in glob.glob(os.path.join(self.spill_dir, 'bucket_*.bin')):
+            os.remove(path)
+
+    def add(self, packed: np.ndarray):
+        self.pending.append(packed)
+        self.positions += len(packed)
+        if len(self.pending) >= max(self.flush_size, len(self.table)):
+            self.fold()
+
+    def fold(self):
+        packed = self.pending.array()
+        self.pending.clear()
+        rows = np.empty(len(packed), dtype=ACCUMULATED)
+        rows['key'] = position_keys(packed)
+        rows['eval_sum'] = packed['eval']
+        rows['count'] = 1
+        self.table = merge(np.concatenate((self.table, rows)))
+        if len(self.table) > self.max_positions:
+            self.spill()
+
+    def spill(self):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        buckets = bucket_of(self.table['key'], self.num_buckets)
+        order = np.argsort(buckets, kind='stable')
+        bounds = np.searchsorted(buckets[order], np.arange(self.num_buckets + 1))
+        for bucket in range(self.num_buckets):
+            with open(os.path.join(self.spill_dir, f'bucket_{bucket:05d}.bin'), 'ab') as f:
+                self.table[order[bounds[bucket]:bounds[bucket + 1]]].tofile(f)
+        self.table = np.empty(0, dtype=ACCUMULATED)
+        self.spills += 1
+
+    # output: summary of the index, also written to out_dir/index.json
+    # Writes the index as positions_<n>.npy files of DEDUP_POSITION rows, one per bucket if it spilled.
+    def finish(self) -> dict:
+        self.fold()
+        for path in glob.glob(os.path.join(self.out_dir, POSITIONS_PATTERN)):
+            os.remove(path)
+
+        if self.spills:
+            self.spill()
+            paths = sorted(glob.glob(os.path.join(self.spill_dir, 'bucket_*.bin')))
+            parts = (merge(np.fromfile(path, dtype=ACCUMULATED)) for path in paths)
+        else:
+            paths, parts = [], [self.table]
+
+        unique = 0
+        for part_id, part in enumerate(parts):
+            positions = np.zeros(len(part), dtype=DEDUP_POSITION)
+            keys = positions.view(np.uint8).reshape(len(part), DEDUP_POSITION.itemsize)
+            keys[:, :KEY_SIZE] = np.ascontiguousarray(part['key']).view(np.uint8).reshape(len(part), KEY_SIZE)
+            positions['eval'] = part['eval_sum'] / part['count']
+            positions['count'] = np.minimum(part['count'], np.iinfo(np.uint32).max)
+            np.save(os.path.join(self.out_dir, f'positions_{part_id:05d}.npy'), positions)
+            unique += len(part)
+        for path in paths:
+            os.remove(path)
+        if paths:
+            os.rmdir(self.spill_dir)
+
+        summary = {'positions': self.positions, 'unique_positions': unique, 'spills': self.spills}
+        with open(os.path.join(self.out_dir, 'index.json'), 'w') as f:
+            json.dump(summary, f)
+        return summary
+
+# input: PGN file paths, output directory
+# output: summary of the index (see PositionIndex.finish)
+# Positions and evals are exactly those of ChessPositionDataset.process_positions (dataloader.position_eval); duplicates get the mean eval.
+def build_position_index(pgn_file_paths: Union[str, List[str]], out_dir: str, alpha: float = 0.1,
+                         max_positions: int = 10_000_000, num_buckets: int = 64, pack_size: int = 4096) -> dict:
+    pgn_file_paths = [pgn_file_paths] if isinstance(pgn_file_paths, str) else pgn_file_paths
+    index = PositionIndex(out_dir, max_positions=max_positions, num_buckets=num_buckets)
+    for pgn_file_path in pgn_file_paths:
+        samples = []
+        with open(pgn_file_path) as pgn:
+            while (positions := read_mainline(pgn)) is not None:
+                for fen, turn, is_checkmate, comment in positions:
+                    eval = position_eval(turn, is_checkmate, comment, alpha)
+                    if eval is not None:
+                        samples.append((fen, eval))
+                if len(samples) >= pack_size:
+                    index.add(pack_fens(*zip(*samples)))
+                    samples = []
+        if samples:
+            index.add(pack_fens(*zip(*samples)))
+    return index.finish()
+
+def load_position_index(index_dir: str) -> List[np.ndarray]:
+    paths = sorted(glob.glob(os.path.join(index_dir, POSITIONS_PATTERN)))
+    if not paths:
+        raise FileNotFoundError(f"No position index found in {index_dir}")
+    return [np.load(path, mmap_mode='r') for path in paths]
+
+
+# Samples from a deduplicated index. A position seen n times counts min(n, frequency_cap) times per epoch,
+# so rare positions keep their weight while the few thousand opening positions that dominate the raw stream
+# are capped; frequency_cap=1 is uniform over distinct positions and None keeps the raw frequencies.
+class DedupPositionDataset(Dataset):
+    def __init__(self, index_dir: str, frequency_cap: Optional[int] = 8, max_seq_length: Optional[int] = None):
+        self.positions = load_position_index(index_dir)
+        self.max_seq_length = max_seq_length
+        self.offsets = np.cumsum([0] + [len(part) for part in self.positions])
+        counts = np.concatenate([part['count'] for part in self.positions]).astype(np.int64)
+        # ends[i] is one past the last sample index of position i
+        self.ends = np.cumsum(counts if frequency_cap is None else np.minimum(counts, frequency_cap))
+
+    def __len__(self) -> int:
+        return int(self.ends[-1]) if len(self.ends) else 0
+
+    def __getitem__(self, idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        tokens, evals = self.__getitems__([idx])
+        return tokens[0], evals[0]
+
+    def __getitems__(self, indices: List[int]) -> Tuple[torch.Tensor, torch.Tensor]:
+        rows = np.searchsorted(self.ends, np.asarray(indices, dtype=np.int64), side='right')
+        part_ids = np.searchsorted(self.offsets, rows, side='right') - 1
+        packed = np.empty(len(rows), dtype=DEDUP_POSITION)
+        for part_id in np.unique(part_ids):
+            mask = part_ids == part_id
+            packed[mask] = self.positions[part_id][rows[mask] - self.offsets[part_id]]
+        return unpack_tokens(packed, max_seq_length=self.max_seq_length), torch.from_numpy(np.ascontiguousarray(packed['eval']))
+
+# rank and world_size split the samples between distributed ranks, as in shards.get_shard_dataloader
+def get_dedup_dataloader(index_dir: str, batch_size: int = 32, frequency_cap: Optional[int] = 8, shuffle: bool = True,
+                         num_workers: int = 0, max_seq_length: Optional[int] = None, rank: int = 0, world_size: int = 1,
+                         seed: int = 0) -> DataLoader:
+    dataset = DedupPositionDataset(index_dir, frequency_cap=frequency_cap, max_seq_length=max_seq_length)
+    sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=shuffle, seed=seed) if world_size > 1 else None
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle and sampler is None, sampler=sampler, num_workers=num_workers,
+                      collate_fn=shard_collate_fn, pin_memory=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a deduplicated position index with mean evals and frequency counts.")
+    parser.add_argument('out_dir')
+    parser.add_argument('pgn_file_paths', nargs='+')
+    parser.add_argument('--alpha', type=float, default=0.1)
+    parser.add_argument('--max-positions', type=int, default=10_000_000, help='distinct positions held in memory before spilling to disk')
+    parser.add_argument('--num-buckets', type=int, default=64)
+    parser.add_argument('--frequency-caps', type=int, nargs='+', default=[1, 8, 64])
+    parser.add_argument('--top', type=int, default=10, help='print the most frequent positions')
+    args = parser.parse_args()
+
+    with open('model_config.yaml', 'r') as f:
+        config = yaml.safe_load(f)
+
+    summary = build_position_index(args.pgn_file_paths, args.out_dir, alpha=args.alpha,
+                                   max_positions=args.max_positions, num_buckets=args.num_buckets)
+    print(f"{summary['positions']:,} positions, {summary['unique_positions']:,} distinct ({summary['spills']} spills)")
+
+    positions = np.concatenate(load_position_index(args.out_dir))
+    for cap in args.frequency_caps:
+        samples = len(DedupPositionDataset(args.out_dir, frequency_cap=cap, max_seq_length=config['max_seq_length']))
+        print(f"frequency cap {cap}: {samples:,} samples per epoch ({samples / summary['positions']:.1%} of the raw stream)")
+    top = positions[np.argsort(positions['count'])[::-1][:args.top]]
+    for fen, row in zip(unpack_fens(top), top):
+        print(f"{int(row['count']):>10,}  {row['eval']:.3f}  {fen}")
@@ -1,19 +1,63 @@
 import requests
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime, timedelta
+import argparse
+import codecs
+import io
+import json
 import os
-import subprocess
-import tempfile
+import re
+import shutil
+import time
+import zstandard
 from tqdm import tqdm
+from typing import Iterable, Iterator, Optional, Tuple
 
-def process_lichess_pgns(start_date, output_dir, game_limit=230000, single_output=None):
-    base_url = "https://database.lichess.org/standard/lichess_db_standard_rated_{}.pgn.zst"
+LICHESS_URL = "https://database.lichess.org/standard/lichess_db_standard_rated_{}.pgn.zst"
+MANIFEST_NAME = "manifest.json"
+
+# input: lines of a PGN
+# output: (game text, whether the movetext has [%eval] comments) for each game, one at a time
+# A game is its header block plus its movetext; the next header line after movetext starts a new game.
+def split_games(lines: Iterable[str]) -> Iterator[Tuple[str, bool]]:
+    game, in_movetext, has_eval = [], False, False
+    for line in lines:
+        if line.startswith('['):
+            if in_movetext:
+                yield ''.join(game).rstrip('\n') + '\n\n', has_eval
+                game, in_movetext, has_eval = [], False, False
+        elif line.strip():
+            in_movetext = True
+            has_eval = has_eval or "[%eval" in line
+        game.append(line)
+
+    if in_movetext:
+        yield ''.join(game).rstrip('\n') + '\n\n', has_eval
+
+# input: URL of a .pgn.zst file
+# output: games as they are decompressed from the HTTP stream; nothing is written to disk
+def stream_games(url: str, read_size: int = 1 << 16) -> Iterator[Tuple[str, bool]]:
+    with requests.get(url, stream=True) as response:
+        if not response.ok:
+            print(f"Failed to download {url}, status code: {response.status_code}")
+            return
+        reader = zstandard.ZstdDecompressor().stream_reader(response.raw, read_size=read_size)
+        yield from split_games(io.TextIOWrapper(reader, encoding='utf-8'))
+
+def next_month(date: datetime) -> datetime:
+    return (date + timedelta(days=32)).replace(day=1)
+
+def process_lichess_pgns(start_date, output_dir, game_limit=230000, single_output=None, base_url=LICHESS_URL, end_date=None):
     current_date = datetime.strptime(start_date, "%Y-%m")
-    end_date = datetime.now().replace(day=1)  # First day of current month
+    end_date = datetime.strptime(end_date, "%Y-%m") if end_date else datetime.now().replace(day=1)  # First day of current month
     processed_games = 0
-    
+
     if output_dir:
         os.makedirs(output_dir, exist_ok=True)
-    
+
+    # one handle for the whole run, so with single_output every month is appended instead of overwriting the last
+    out_f = open(single_output, 'w') if single_output is not None else None
+
     with tqdm(total=game_limit, unit="game") as pbar:
         while current_date <= end_date and processed_games < game_limit:
             month_str = current_date.strftime("%Y-%m")
@@ -21,59 +65,332 @@ def process_lichess_pgns(start_date, output_dir, game_limit=230000, single_outpu
             print(f"\nProcessing file for date: {month_str}")
             if single_output is not None:
                 output_file = single_output
+                month_f = out_f
             else:
                 output_file = os.path.join(output_dir, f"lichess_{month_str}.pgn")
-            
-            with tempfile.TemporaryDirectory() as tmpdir:
-                compressed_file = os.path.join(tmpdir, 'compressed.pgn.zst')
-                decompressed_file = os.path.join(tmpdir, 'decompressed.pgn')
-                
-                response = requests.get(url, stream=True)
-                if response.ok:
-                    with open(compressed_file, 'wb') as f:
-                        for chunk in response.iter_content(chunk_size=8192):
-                            f.write(chunk)
-                    print(f"Downloaded file size: {os.path.getsize(compressed_file)} bytes")
-                    
-                    try:
-                        subprocess.run(['zstd', '-d', '-q', compressed_file, '-o', decompressed_file], check=True)
-                        print(f"Decompressed file size: {os.path.getsize(decompressed_file)} bytes")
-                    except subprocess.CalledProcessError as e:
-                        print(f"Error decompressing file: {e}")
-                        print("Attempting manual decompression for more info:")
-                        result = subprocess.run(['zstd', '-d', '-v', compressed_file, '-o', decompressed_file], capture_output=True, text=True)
-                        print(f"STDOUT: {result.stdout}")
-                        print(f"STDERR: {result.stderr}")
-                        current_date += timedelta(days=32)
-                        current_date = current_date.replace(day=1)
+                month_f = open(output_file, 'w')
+
+            try:
+                for game, has_eval in stream_games(url):
+                    if not has_eval:
                         continue
-                    
-                    with open(decompressed_file, 'r') as f, open(output_file, 'w') as out_f:
-                        pgn = []
-                        for line in f:
-                            if line.strip(): pgn.append(line)
-                            elif pgn and "[%eval" in ''.join(pgn):
-                                out_f.write(''.join(pgn) + "\n\n")
-                                processed_games += 1
-                                pbar.update(1)
-                                if processed_games >= game_limit:
-                                    break
-                                pgn = []
-                            else: pgn = []
-                        
-                        if processed_games >= game_limit:
-                            break
-                else:
-                    print(f"Failed to download {url}, status code: {response.status_code}")
-            
+                    month_f.write(game)
+                    processed_games += 1
+                    pbar.update(1)
+                    if processed_games >= game_limit:
+                        break
+            except zstandard.ZstdError as e:
+                print(f"Error decompressing {url}: {e}")
+            finally:
+                month_f.flush()
+                if month_f is not out_f:
+                    month_f.close()
+
             print(f"Total processed games so far: {processed_games}")
             print(f"Output file for {month_str}: {output_file}")
             print(f"File size: {os.path.getsize(output_file)} bytes")
-            
-            current_date += timedelta(days=32)
-            current_date = current_date.replace(day=1)
-    
+
+            current_date = next_month(current_date)
+
+    if out_f is not None:
+        out_f.close()
     print(f"\nFinal number of processed games: {processed_games}")
 
+# input: compressed chunks of a .pgn.zst starting at byte `offset` of the archive, text of the game in progress there,
+# callback taking (offset, text of the game in progress)
+# output: lines of the archive, decompressed as the chunks arrive. Once the lines of a zstd frame have been consumed,
+# `checkpoint` is called with the offset of the next frame; a stream restarted there with that text continues exactly.
+def archive_lines(chunks: Iterable[bytes], offset: int = 0, carry: str = '', checkpoint=None) -> Iterator[str]:
+    dctx = zstandard.ZstdDecompressor()
+    frame, decoder = dctx.decompressobj(), codecs.getincrementaldecoder('utf-8')()
+    game, in_movetext, text, frame_started = [], False, carry, False
+    for chunk in chunks:
+        while chunk:
+            frame_started = True
+            text += decoder.decode(frame.decompress(chunk))
+            if frame.eof:
+                offset += len(chunk) - len(frame.unused_data)
+                chunk = frame.unused_data
+            else:
+                offset += len(chunk)
+                chunk = b''
+            *lines, text = text.split('\n')
+            for line in lines:
+                line += '\n'
+                # the same game boundaries as split_games, so `game` is the text the next split_games call still needs
+                if line.startswith('['):
+                    if in_movetext:
+                        game, in_movetext = [], False
+                elif line.strip():
+                    in_movetext = True
+                game.append(line)
+                yield line
+            if frame.eof:
+                if checkpoint is not None and not decoder.getstate()[0]:
+                    checkpoint(offset, ''.join(game) + text)
+                frame, frame_started = dctx.decompressobj(), False
+    if frame_started:
+        raise EOFError(f"archive ends in the middle of a zstd frame at byte {offset}")
+    text += decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+# input: 206 response
+# output: first byte of the range it carries, or None without a valid Content-Range header
+def content_range_start(response: requests.Response) -> Optional[int]:
+    match = re.match(r'bytes (\d+)-', response.headers.get('Content-Range', ''))
+    return int(match.group(1)) if match else None
+
+# a download that has not started: archive offset, games and bytes written, text of the game in progress
+RESUME_START = {"offset": 0, "games": 0, "bytes": 0, "carry": ""}
+
+def copy_chunks(chunks: Iterable[bytes], f) -> Iterator[bytes]:
+    for chunk in chunks:
+        f.write(chunk)
+        yield chunk
+
+def load_resume_point(path: str) -> dict:
+    if not os.path.exists(path):
+        return dict(RESUME_START)
+    with open(path) as f:
+        return json.load(f)
+
+def save_resume_point(path: str, resume: dict):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(resume, f)
+    os.replace(path + '.tmp', path)
+
+# input: month, output directory
+# output: (month, games written, shard size in bytes), or None if the month is not available
+# The archive is decompressed and filtered into lichess_<month>.pgn as it downloads, and the transfer stops once
+# month_game_limit games are written. At every zstd frame boundary, lichess_<month>.pgn.resume records the archive
+# offset, the games and bytes written and the game in progress, so after a dropped connection or a restart the
+# download continues from there with an HTTP Range request. Only with keep_compressed is the archive also saved,
+# as lichess_<month>.pgn.zst, and only if the disk has room for it.
+# The shard is written under a temporary name and renamed at the end, so it either exists complete or not at all.
+def ingest_month(month_str: str, output_dir: str, base_url: str = LICHESS_URL, month_game_limit: int = None,
+                 keep_compressed: bool = False, max_retries: int = 5, chunk_size: int = 1 << 20):
+    url = base_url.format(month_str)
+    compressed_file = os.path.join(output_dir, f"lichess_{month_str}.pgn.zst")
+    shard_file = os.path.join(output_dir, f"lichess_{month_str}.pgn")
+    resume_file = shard_file + '.resume'
+    resume = load_resume_point(resume_file)
+    if not os.path.exists(shard_file + '.tmp') or (keep_compressed and (not os.path.exists(compressed_file + '.part') or
+                                                                        os.path.getsize(compressed_file + '.part') < resume["offset"])):
+        # the shard, or the copy of the archive, does not reach the resume point
+        resume = dict(RESUME_START)
+    if keep_compressed and os.path.exists(compressed_file):
+        os.remove(compressed_file)
+
+    def restart():
+        resume.update(RESUME_START)
+        if os.path.exists(resume_file):
+            os.remove(resume_file)
+
+    def checkpoint(offset, carry):
+        out_f.flush()
+        if keep_f is not None:
+            keep_f.flush()
+        resume.update(offset=offset, games=games, bytes=out_f.tell(), carry=carry)
+        save_resume_point(resume_file, resume)
+
+    for attempt in range(max_retries):
+        offset = resume["offset"]
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        keep_f = None
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=60) as response:
+                if response.status_code == 416 and offset:
+                    # the last resume point is the end of the archive: only the game in progress is left
+                    chunks = iter(())
+                elif response.status_code == 206 and content_range_start(response) != offset:
+                    # a range the server did not honor, or an archive that changed, would corrupt the shard
+                    print(f"{url} answered a request from byte {offset} with {response.headers.get('Content-Range')}, restarting")
+                    restart()
+                    continue
+                elif response.status_code in (200, 206):
+                    if response.status_code == 200 and offset:
+                        # the server ignored the range and is sending the whole archive again
+                        restart()
+                        offset = 0
+                    chunks = response.iter_content(chunk_size=chunk_size)
+                else:
+                    print(f"Failed to download {url}, status code: {response.status_code}")
+                    return None
+
+                if keep_compressed:
+                    needed = int(response.headers.get('Content-Length', 0))
+                    free = shutil.disk_usage(output_dir).free
+                    if needed > free:
+                        raise OSError(f"{compressed_file} needs {needed} bytes, {free} are free in {output_dir}")
+                    keep_f = open(compressed_file + '.part', 'r+b' if offset else 'wb')
+                    keep_f.truncate(offset)
+                    keep_f.seek(offset)
+                    chunks = copy_chunks(chunks, keep_f)
+
+                games = resume["games"]
+                with open(shard_file + '.tmp', 'r+b' if offset else 'wb') as out_f:
+                    out_f.truncate(resume["bytes"])
+                    out_f.seek(resume["bytes"])
+                    lines = archive_lines(chunks, offset, resume["carry"], checkpoint)
+                    for game, has_eval in split_games(lines):
+                        if not has_eval:
+                            continue
+                        out_f.write(game.encode('utf-8'))
+                        games += 1
+                        if month_game_limit is not None and games >= month_game_limit:
+                            # leaving the request closes the response, which stops the transfer
+                            break
+            break
+        except (requests.RequestException, EOFError) as e:
+            print(f"Download of {url} interrupted after byte {resume['offset']} ({e}), retrying")
+            time.sleep(2 ** attempt)
+        except zstandard.ZstdError:
+            # a corrupt archive is downloaded again on the next run instead of being resumed
+            restart()
+            raise
+        finally:
+            if keep_f is not None:
+                keep_f.close()
+    else:
+        return None
+
+    os.replace(shard_file + '.tmp', shard_file)
+    if keep_compressed:
+        if month_game_limit is not None and games >= month_game_limit:
+            # the transfer stopped early, so the copy is not the whole archive
+            os.remove(compressed_file + '.part')
+        else:
+            os.replace(compressed_file + '.part', compressed_file)
+    if os.path.exists(resume_file):
+        os.remove(resume_file)
+    return month_str, games, os.path.getsize(shard_file)
+
+def load_manifest(output_dir: str) -> dict:
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {"months": {}, "single_output": None}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(output_dir: str, manifest: dict):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+# append_shards truncates single_output to the size the manifest recorded, so a non-empty file the manifest does not
+# know about, e.g. a corpus from an earlier run or from process_lichess_pgns, is refused instead of wiped
+def check_single_output(output_dir: str, manifest: dict, single_output: str):
+    state = manifest["single_output"]
+    if (state is None or state["path"] != single_output) and os.path.exists(single_output) and os.path.getsize(single_output) > 0:
+        raise FileExistsError(f"{single_output} exists but is not in the manifest of {output_dir}; "
+                              f"move it away or choose another single output")
+
+# Appends finished month shards to single_output in month order, stopping at the first month that is
+# not done yet. The manifest records the output size and the offset of every month appended, and the
+# output is truncated back to that size before appending, so an append cut short by a crash is redone.
+def append_shards(output_dir: str, manifest: dict, months: list, single_output: str, game_limit: int = None):
+    check_single_output(output_dir, manifest, single_output)
+    state = manifest["single_output"]
+    if state is None or state["path"] != single_output:
+        state = manifest["single_output"] = {"path": single_output, "bytes": 0, "games": 0, "months": {}}
+
+    with open(single_output, 'a+') as out_f:
+        out_f.truncate(state["bytes"])
+        for month_str in months:
+            if month_str in state["months"]:
+                continue
+            if month_str not in manifest["months"] or (game_limit is not None and state["games"] >= game_limit):
+                break
+            games = 0
+            with open(os.path.join(output_dir, manifest["months"][month_str]["shard"])) as shard:
+                for game, _ in split_games(shard):
+                    if game_limit is not None and state["games"] + games >= game_limit:
+                        break
+                    out_f.write(game)
+                    games += 1
+            out_f.flush()
+            os.fsync(out_f.fileno())
+            state["months"][month_str] = {"offset": state["bytes"], "bytes": out_f.tell() - state["bytes"], "games": games}
+            state["bytes"] = out_f.tell()
+            state["games"] += games
+            save_manifest(output_dir, manifest)
+
+# Resumable multi-month ingest: up to `workers` months are downloaded and filtered at the same time.
+# Months listed in the manifest are skipped on restart, so a failure only costs the month in progress.
+def ingest_lichess_pgns(start_date: str, output_dir: str, end_date: str = None, workers: int = 4, game_limit: int = None,
+                        month_game_limit: int = None, single_output: str = None, base_url: str = LICHESS_URL,
+                        keep_compressed: bool = False):
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(output_dir)
+    if single_output is not None:
+        check_single_output(output_dir, manifest, single_output)
+
+    months = []
+    current_date = datetime.strptime(start_date, "%Y-%m")
+    last_date = datetime.strptime(end_date, "%Y-%m") if end_date else datetime.now().replace(day=1)
+    while current_date <= last_date:
+        months.append(current_date.strftime("%Y-%m"))
+        current_date = next_month(current_date)
+
+    def total_games():
+        return sum(entry["games"] for entry in manifest["months"].values())
+
+    todo = iter([month_str for month_str in months if month_str not in manifest["months"]])
+    with ProcessPoolExecutor(workers) as executor, tqdm(total=game_limit, initial=total_games(), unit="game") as pbar:
+        pending, futures, failed = set(), {}, []
+        while True:
+            while len(pending) < workers and (game_limit is None or total_games() < game_limit):
+                month_str = next(todo, None)
+                if month_str is None:
+                    break
+                future = executor.submit(ingest_month, month_str, output_dir, base_url, month_game_limit, keep_compressed)
+                futures[future] = month_str
+                pending.add(future)
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # the month stays out of the manifest, so the next run tries it again
+                    print(f"\n{futures[future]} failed ({type(e).__name__}: {e}), skipping it")
+                    failed.append(futures[future])
+                    continue
+                if result is None:
+                    continue
+                month_str, games, size = result
+                manifest["months"][month_str] = {"games": games, "bytes": size, "shard": f"lichess_{month_str}.pgn"}
+                save_manifest(output_dir, manifest)
+                pbar.update(games)
+                print(f"\n{month_str}: {games} games, {size} bytes")
+            if single_output is not None:
+                append_shards(output_dir, manifest, months, single_output, game_limit)
+
+    print(f"\nFinal number of processed games: {total_games()}")
+    if failed:
+        print(f"Failed months, retried on the next run: {', '.join(sorted(failed))}")
+    return failed
+
 if __name__ == "__main__":
-    process_lichess_pgns('2013-01', output_dir=None, game_limit=3_000_000, single_output='chinchilla_optimal.pgn')
+    parser = argparse.ArgumentParser(description="Download Lichess games that carry engine evals.")
+    parser.add_argument('--start', default='2013-01')
+    parser.add_argument('--end', default=None)
+    parser.add_argument('--game-limit', type=int, default=3_000_000)
+    parser.add_argument('--single-output', default='chinchilla_optimal.pgn')
+    parser.add_argument('--ingest', action='store_true', help='resumable parallel ingest with per-month shards and a manifest')
+    parser.add_argument('--output-dir', default='lichess')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--month-game-limit', type=int, default=None)
+    parser.add_argument('--keep-compressed', action='store_true', help='also keep each month\'s .pgn.zst archive')
+    args = parser.parse_args()
+
+    if args.ingest:
+        ingest_lichess_pgns(args.start, args.output_dir, end_date=args.end, workers=args.workers, game_limit=args.game_limit,
+                            month_game_limit=args.month_game_limit, single_output=args.single_output,
+                            keep_compressed=args.keep_compressed)
+    else:
+        process_lichess_pgns(args.start, output_dir=None, game_limit=args.game_limit, single_output=args.single_output, end_date=args.end)
@@ -0,0 +1,156 @@
+import argparse
+import copy
+import os
+from itertools import islice
+
+import numpy as np
+import torch
+import torch.nn as nn
+from typing import List
+
+from dataloader import position_eval, read_mainline
+from codec import board_to_tokens, random_boards
+from metrics import timeit
+from model import load_model
+from puzzle_eval import batched, iter_puzzles, solve_batch
+from search import ModelEvaluator
+
+# Model with the board tokenizer folded in: (batch, 8, 8) PIECE_MAP codes in, one value per board out,
+# like Model in test_mode. Padding to the static input_length keeps the graph free of data-dependent
+# shapes, so it traces to TorchScript and exports to ONNX.
+class BoardModel(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        if model.input_length is None:
+            raise ValueError("only models with CLS pooling have a static input length and can be exported")
+        self.model = model
+        self.input_length = model.input_length
+
+    def forward(self, boards):
+        return self.model.forward_tokens(board_to_tokens(boards, self.input_length))[:, 0]
+
+# int8 weights for every nn.Linear (feed-forward layers and the head), activations quantized on the fly.
+# The attention projections are kept in fp32: nn.MultiheadAttention does not run them as nn.Linear modules.
+# The fused encoder kernels read linear1.weight as a float tensor, which a quantized Linear does not have,
+# so the quantized copy runs its layers block by block (Model.explicit_layers).
+def quantize(model):
+    model = torch.ao.quantization.quantize_dynamic(copy.deepcopy(model).eval(), {nn.Linear}, dtype=torch.qint8)
+    model.explicit_layers = True
+    return model
+
+def load_quantized_model(checkpoint_path, config_path="model_config.yaml", **overrides):
+    return quantize(load_model(checkpoint_path, config_path=config_path, device="cpu", **overrides))
+
+def trace(model, example_boards):
+    with torch.no_grad():
+        return torch.jit.freeze(torch.jit.trace(BoardModel(model).eval(), example_boards))
+
+def export_onnx(model, example_boards, path):
+    torch.onnx.export(BoardModel(model).eval(), (example_boards,), path, input_names=['boards'], output_names=['value'],
+                      dynamic_axes={'boards': {0: 'batch'}, 'value': {0: 'batch'}}, dynamo=False)
+
+# input: PGN path
+# output: up to `limit` (normalized FEN, eval) training positions from the start of the file
+def load_eval_positions(pgn_file_path, limit, alpha=0.1):
+    fens, evals = [], []
+    with open(pgn_file_path) as pgn:
+        while len(fens) < limit:
+            positions = read_mainline(pgn)
+            if positions is None:
+                break
+            for fen, turn, is_checkmate, comment in positions:
+                value = position_eval(turn, is_checkmate, comment, alpha)
+                if value is None:
+                    continue
+                fens.append(fen)
+                evals.append(value)
+    return fens[:limit], np.array(evals[:limit])
+
+def puzzle_solve_rate(evaluator, puzzles_path, limit, batch_puzzles=64):
+    solved = total = 0
+    for puzzles in batched(islice(iter_puzzles(puzzles_path), limit), batch_puzzles):
+        results, _, _ = solve_batch(evaluator, puzzles)
+        solved += sum(is_solved for _, is_solved in results)
+        total += len(results)
+    return solved / max(total, 1)
+
+# Accuracy of each variant: MSE against the standardized targets (train.py standardizes per batch),
+# MSE against the fp32 outputs, and puzzle solve rate.
+def accuracy_report(models, pgn_file_path=None, puzzles_path=None, positions=4096, puzzles=1000):
+    if pgn_file_path is not None:
+        fens, evals = load_eval_positions(pgn_file_path, positions)
+        targets = (evals - evals.mean()) / evals.std()
+        predictions = {name: np.array(ModelEvaluator(model, max_batch_size=256).evaluate_fens(fens)) for name, model in models.items()}
+    print(f"{'model':<8} {'mse vs targets':>15} {'mse vs fp32':>12} {'puzzles solved':>15}")
+    for name, model in models.items():
+        row = f"{name:<8}"
+        if pgn_file_path is not None:
+            row += f" {np.mean((predictions[name] - targets) ** 2):>15.5f} {np.mean((predictions[name] - predictions['fp32']) ** 2):>12.2e}"
+        else:
+            row += f" {'-':>15} {'-':>12}"
+        if puzzles_path is not None:
+            row += f" {puzzle_solve_rate(ModelEvaluator(model, max_batch_size=4096), puzzles_path, puzzles):>15.1%}"
+        print(row)
+
+def latency_table(variants, batch_sizes, repeat):
+    print(f"{'batch':>6} " + " ".join(f"{name + ' ms':>14}" for name in variants))
+    for batch_size in batch_sizes:
+        boards = random_boards(batch_size, seed=batch_size)
+        with torch.no_grad():
+            times = [timeit(lambda: fn(boards), repeat) for fn in variants.values()]
+        print(f"{batch_size:>6} " + " ".join(f"{seconds * 1e3:>14.2f}" for seconds in times))
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Quantize a checkpoint to int8, export TorchScript/ONNX and compare accuracy and latency.")
+    parser.add_argument('checkpoint')
+    parser.add_argument('--out-dir', default='export')
+    parser.add_argument('--pgn', default=None, help='PGN with [%%eval] comments for the MSE report')
+    parser.add_argument('--positions', type=int, default=4096)
+    parser.add_argument('--puzzles', default='mini_mate_puzzles.csv')
+    parser.add_argument('--puzzle-limit', type=int, default=1000)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 16, 64, 256])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    os.makedirs(args.out_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(args.checkpoint))[0]
+
+    fp32 = load_model(args.checkpoint, device="cpu")
+    int8 = quantize(fp32)
+    variants = {'fp32': lambda boards: fp32(boards), 'int8': lambda boards: int8(boards)}
+
+    if fp32.input_length is None:
+        print("checkpoint uses last-token pooling, skipping TorchScript and ONNX export")
+    else:
+        example = random_boards(8)
+        for label, model in (('fp32', fp32), ('int8', int8)):
+            path = os.path.join(args.out_dir, f'{name}_{label}.ts.pt')
+            scripted = trace(model, example)
+            with torch.no_grad():
+                torch.testing.assert_close(scripted(example), model(example), atol=1e-4, rtol=1e-4)
+            torch.jit.save(scripted, path)
+            variants[f'{label}-ts'] = scripted
+            print(f"TorchScript ({label}) saved to {path}")
+
+        # the ONNX exporter has no kernels for dynamically quantized linears, so only fp32 goes to ONNX
+        path = os.path.join(args.out_dir, f'{name}_fp32.onnx')
+        try:
+            export_onnx(fp32, example, path)
+            print(f"ONNX (fp32) saved to {path}")
+            import onnxruntime
+            session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+            variants['fp32-ort'] = lambda boards: session.run(None, {'boards': boards.numpy()})[0]
+        except (ImportError, torch.onnx.OnnxExporterError) as e:
+            print(f"ONNX export or onnxruntime unavailable ({e}), skipping")
+
+    accuracy_report({'fp32': fp32, 'int8': int8}, pgn_file_path=args.pgn, puzzles_path=args.puzzles,
+                    positions=args.positions, puzzles=args.puzzle_limit)
+    latency_table(variants, args.batch_sizes, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
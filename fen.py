@@ -0,0 +1,68 @@
+import re
+
+import chess
+from typing import List
+
+# The vocabularies, normalized FENs and encode(): the part of codec that needs no torch.
+
+# Board and castling characters are read with PIECE_TO_TOKEN, where 'b' is the black bishop; the en passant
+# square is read with TAIL_TO_TOKEN, where 'b' is file b. The two vocabularies differ in nothing else.
+PIECE_TO_TOKEN = {
+    '<PAD>': 0, 'P': 1, 'N': 2, 'B': 3, 'R': 4, 'Q': 5, 'K': 6,
+    'p': 7, 'n': 8, 'b': 9, 'r': 10, 'q': 11, 'k': 12,
+    '-': 13, 'a': 14, 'c': 16, 'd': 17,
+    'e': 18, 'f': 19, 'g': 20, 'h': 21,
+    '0': 22, '1': 23, '2': 24, '3': 25, '4': 26, '5': 27, '6': 28, '7': 29, '8': 30, '9': 31,
+    ' ': 32, '/': 33, '.': 34
+}
+FILE_TO_TOKEN = {file: PIECE_TO_TOKEN['a'] + index for index, file in enumerate(chess.FILE_NAMES)}
+TAIL_TO_TOKEN = {**PIECE_TO_TOKEN, **FILE_TO_TOKEN}
+
+# longest normalize_fen string in tokens
+MAX_FEN_LENGTH = 79
+
+# input: python-chess board
+# output: FEN from the side to move's point of view, without side to move and move counters
+def normalize_fen(b: chess.Board) -> str:
+    fen = b.fen()
+    if b.turn == chess.BLACK:
+        fen = fen.swapcase()
+    temp = fen.split(' ')[:-2]
+    del temp[-3]
+    if temp[-1] != "-" and b.turn == chess.BLACK:
+        temp[-1] = temp[-1][:1].swapcase() + str(6)
+    return ' '.join(temp)
+
+# 8 ranks, castling letters (swapcased when black is to move) and an en passant square, which is always on the
+# sixth rank from the side to move's point of view
+NORMALIZED_FEN = re.compile(r'([PNBRQKpnbrqk1-8]+(?:/[PNBRQKpnbrqk1-8]+){7}) (-|[KQkq]{1,4}) (-|[a-h]6)')
+
+# input: a string from outside the process, e.g. a server request
+# output: whether it has the shape normalize_fen writes; every such string encodes to at most MAX_FEN_LENGTH tokens
+def is_normalized_fen(fen: str) -> bool:
+    match = NORMALIZED_FEN.fullmatch(fen)
+    if match is None:
+        return False
+    board, castling, _ = match.groups()
+    if castling != '-' and len(set(castling)) != len(castling):
+        return False
+    return all(sum(int(char) if char.isdigit() else 1 for char in rank) == 8 for rank in board.split('/'))
+
+def encode(fen: str) -> List[int]:
+    tokens = []
+    parts = fen.split()
+    board = parts[0]
+
+    # Encode the board part
+    for char in board:
+        if char.isdigit():
+            tokens.extend([PIECE_TO_TOKEN['.']] * int(char))
+        else:
+            tokens.append(PIECE_TO_TOKEN[char])
+
+    tokens.append(PIECE_TO_TOKEN[' '])
+    # Encode the rest of the FEN
+    for char in ' '.join(parts[1:]):
+        tokens.append(TAIL_TO_TOKEN[char])
+
+    return tokens
@@ -0,0 +1,89 @@
+import json
+import os
+import resource
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import torch
+
+
+# Splits training time into named phases (data, forward, backward, optimizer).
+# Host phases are timed with perf_counter. On CUDA, device phases record a pair of events instead,
+# so timing never blocks the host; flush() must come after a synchronization (the loss readout).
+# Every phase is also a torch.profiler.record_function range, so it shows up by name in profiler traces.
+class PhaseTimer:
+    def __init__(self, device_type: str = 'cpu'):
+        self.cuda = device_type == 'cuda'
+        self.totals = defaultdict(float)
+        self.events = []
+        self.start_time = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name: str, host: bool = False):
+        with torch.profiler.record_function(name):
+            if self.cuda and not host:
+                start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+                start.record()
+                yield
+                end.record()
+                self.events.append((name, start, end))
+            else:
+                start = time.perf_counter()
+                yield
+                self.totals[name] += time.perf_counter() - start
+
+    # output: seconds per phase since the previous flush, plus the wall time of the interval
+    def flush(self) -> Dict[str, float]:
+        for name, start, end in self.events:
+            self.totals[name] += start.elapsed_time(end) / 1000
+        now = time.perf_counter()
+        seconds = dict(self.totals, wall=now - self.start_time)
+        self.totals.clear()
+        self.events.clear()
+        self.start_time = now
+        return seconds
+
+
+# number of batches the DataLoader workers have finished but the training loop has not taken yet,
+# or None for a single-process loader. Reads a private attribute of the DataLoader iterator.
+def queue_depth(batches) -> Optional[int]:
+    data_queue = getattr(batches, '_data_queue', None)
+    if data_queue is None:
+        return None
+    try:
+        return data_queue.qsize()
+    except NotImplementedError:
+        return None
+
+# peak memory in MB since the previous call on CUDA; peak resident set size of the process on CPU
+def peak_memory_mb(device_type: str = 'cpu') -> float:
+    if device_type == 'cuda':
+        peak = torch.cuda.max_memory_allocated() / 2 ** 20
+        torch.cuda.reset_peak_memory_stats()
+        return peak
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+# average seconds per call of fn over repeat calls
+def timeit(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+# Appends one JSON object per line, flushed after every record so the log can be tailed during a run.
+class MetricsLogger:
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.f = open(path, 'a')
+
+    def log(self, record: dict):
+        self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
@@ -1,154 +1,113 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import chess
+import yaml
 from typing import Tuple, List, Iterator
 
-ALPHA = 0.1
-
-PIECE_MAP = {1: "P", 2: "P", 3: "R", 4: "R", 5: "N", 6: "B", 7: "B", 8: "Q", 9: "K", 10: "K",
-             11: "p", 12: "p", 13: "r", 14: "r", 15: "n", 16: "b", 17: "b", 18: "q", 19: "k", 20: "k"}
-
-# input: 8x8 Torch tensor
-# output: FEN string
-def convert_torch_to_fen(tensor):
-    board = tensor.tolist()
-    fen = ""
-
-    en_passant_str = "-"
-    empty_count = 0
-    for row in range(8):
-        for col in range(8):
-            if board[row][col] == 0:
-                empty_count += 1
-                if col == 7:
-                    fen += str(empty_count)
-                    empty_count = 0
-            else:
-                if empty_count > 0:
-                    fen += str(empty_count)
-                    empty_count = 0
-                fen += PIECE_MAP[board[row][col]]
-            if board[row][col] == 12:
-                if col > 0 and board[row][col - 1] == 1:
-                    en_passant_str = chr(ord("a") + col) + "6"
-                elif col < 7 and board[row][col + 1] == 1:
-                    en_passant_str = chr(ord("a") + col) + "6"
-        if row != 7:
-            fen += "/"
-        else:
-            fen += " "
-    
-    castling_is_legal = False
-    if board[7][3] == 9:
-        # checking if "black" can castle
-        if board[7][0] == 3:
-            castling_is_legal = True
-            fen += "K"
-        if board[7][7] == 3:
-            castling_is_legal = True
-            fen += "Q"
-
-    if board[7][4] == 9:
-        # checking if white can castle
-        if board[7][7] == 3:
-            castling_is_legal = True
-            fen += "K"
-        if board[7][0] == 3:
-            castling_is_legal = True
-            fen += "Q"
-    
-    if board[0][3] == 9:
-        # checking if "white" can castle
-        if board[0][0] == 3:
-            castling_is_legal = True
-            fen += "k"
-        if board[0][7] == 3:
-            castling_is_legal = True
-            fen += "q"
-
-    if board[0][3] == 9:
-        # checking if black can castle
-        if board[0][7] == 3:
-            castling_is_legal = True
-            fen += "k"
-        if board[0][0] == 3:
-            castling_is_legal = True
-            fen += "q"
-    
-    if not castling_is_legal:
-        fen += "-"
+from codec import TOKENIZER_VERSION, FILE_TO_TOKEN, PIECE_TO_TOKEN, board_to_tokens
 
-    fen += " "
-    fen += en_passant_str
-    return fen
-
-PIECE_TO_TOKEN = {
-    '<PAD>': 0, 'P': 1, 'N': 2, 'B': 3, 'R': 4, 'Q': 5, 'K': 6,
-    'p': 7, 'n': 8, 'b': 9, 'r': 10, 'q': 11, 'k': 12,
-    '-': 13, 'a': 14, 'b': 15, 'c': 16, 'd': 17, 
-    'e': 18, 'f': 19, 'g': 20, 'h': 21,
-    '0': 22, '1': 23, '2': 24, '3': 25, '4': 26, '5': 27, '6': 28, '7': 29, '8': 30, '9': 31,
-    ' ': 32, '/': 33, '.': 34
-}
-
-def encode(fen):
-    tokens = []
-    parts = fen.split()
-    board = parts[0]
-    
-    # Encode the board part
-    for char in board:
-        if char.isdigit():
-            tokens.extend([PIECE_TO_TOKEN['.']] * int(char))
-        else:
-            tokens.append(PIECE_TO_TOKEN[char])
-
-    tokens.append(PIECE_TO_TOKEN[' '])
-    # Encode the rest of the FEN
-    for char in ' '.join(parts[1:]):
-        tokens.append(PIECE_TO_TOKEN[char])
-    
-    return tokens
-
-def pad_fens(fens):
-    encoded_fens = [encode(fen) for fen in fens]
-    
-    # Find the maximum length of encoded FENs
-    max_len = max(len(tokens) for tokens in encoded_fens)
-    
-    # Pad all encoded FENs to the maximum length
-    padded_fens = [tokens + [PIECE_TO_TOKEN['<PAD>']] * (max_len - len(tokens)) for tokens in encoded_fens]
-    
-    return torch.tensor(padded_fens)
+ALPHA = 0.1
 
+# Transformer encoder over FEN tokens, batch first.
+# pooling='cls' prepends a learned CLS token, reads the prediction from it and masks PAD tokens out of
+# attention, so the output does not depend on how far a row is padded and batches can use one static
+# max_seq_length. With the mask, the encoder takes the fused attention path while training and the
+# nested-tensor fast path (padding skipped) in eval mode under no_grad.
+# pooling='last' is the original model: no mask, prediction read from the last position; checkpoints
+# saved before the CLS token load into it.
 class Model(nn.Module):
-    def __init__(self, vocab_size=35, d_model=256, n_head=16, num_layers=16, dim_feedforward=256, max_seq_length=100, num_classes=1, test_mode=True):
+    def __init__(self, vocab_size=35, d_model=256, n_head=16, num_layers=16, dim_feedforward=256, max_seq_length=100, num_classes=1, test_mode=True, pooling='cls'):
         super(Model, self).__init__()
         
         self.embedding = nn.Embedding(vocab_size, d_model)
         self.pos_encoding = nn.Parameter(torch.zeros(max_seq_length, d_model))
+        self.pooling = pooling
+        if pooling == 'cls':
+            self.cls_token = nn.Parameter(torch.randn(1, 1, d_model) * 0.02)
         
-        transformer_layer = nn.TransformerEncoderLayer(d_model, n_head, dim_feedforward)
-        self.transformer = nn.TransformerEncoder(transformer_layer, num_layers)
+        transformer_layer = nn.TransformerEncoderLayer(d_model, n_head, dim_feedforward, batch_first=True)
+        self.transformer = nn.TransformerEncoder(transformer_layer, num_layers, enable_nested_tensor=(pooling == 'cls'))
         
         self.fc = nn.Linear(d_model, num_classes)
         self.test_mode = test_mode
+        # width of the token batches the model is fed: static for CLS pooling, the longest row of the batch for 'last'
+        self.input_length = max_seq_length if pooling == 'cls' else None
+        # run every encoder layer block by block through its public submodules instead of nn.TransformerEncoder,
+        # whose fused kernels need float nn.Linear weights; set on dynamically quantized copies (export.quantize)
+        self.explicit_layers = False
         
     def forward(self, x):
         if self.test_mode:
-            x = pad_fens([convert_torch_to_fen(x[i, :]) for i in range(x.shape[0])])
+            x = board_to_tokens(x, self.input_length)
 
+        x = self.forward_tokens(x)
+        if self.test_mode:
+            return x.reshape(x.shape[0],)
+        else:
+            return x[:, 0]
+
+    def forward_tokens(self, x):
         seq_length = x.size(1)
+        padding_mask = x == PIECE_TO_TOKEN['<PAD>']
         
         x = self.embedding(x)
         x = x + self.pos_encoding[:seq_length, :]
-        
-        x = x.permute(1, 0, 2)
-        x = self.transformer(x)
-        
-        x = x[-1, :, :]
-        x = self.fc(x)
-        if self.test_mode:
-            return x.reshape(x.shape[0],)
+
+        if self.pooling == 'cls':
+            x = torch.cat([self.cls_token.expand(x.size(0), -1, -1), x], dim=1)
+            padding_mask = F.pad(padding_mask, (1, 0), value=False)
+            x = self.encode(x, padding_mask)
+            x = x[:, 0, :]
         else:
-            return x[:, 0]
+            x = self.encode(x)
+            x = x[:, -1, :]
+        return self.fc(x)
+
+    def encode(self, x, padding_mask=None):
+        if not self.explicit_layers:
+            return self.transformer(x, src_key_padding_mask=padding_mask)
+        for layer in self.transformer.layers:
+            if layer.norm_first:
+                x = x + attention_block(layer, layer.norm1(x), padding_mask)
+                x = x + feed_forward_block(layer, layer.norm2(x))
+            else:
+                x = layer.norm1(x + attention_block(layer, x, padding_mask))
+                x = layer.norm2(x + feed_forward_block(layer, x))
+        return x
+
+# the two residual blocks of an nn.TransformerEncoderLayer, as its per-op path computes them
+def attention_block(layer, x, padding_mask):
+    return layer.dropout1(layer.self_attn(x, x, x, key_padding_mask=padding_mask, need_weights=False)[0])
+
+def feed_forward_block(layer, x):
+    return layer.dropout2(layer.linear2(layer.dropout(layer.activation(layer.linear1(x)))))
+
+# input: checkpoint dict written by train.py
+# output: its model state_dict for the current tokenizer
+# Checkpoints from before TOKENIZER_VERSION 2 read the black bishop as token 15 like file b, and never
+# trained the embedding of token 9 it is read as now; copying row 15 into row 9 makes them evaluate
+# every position exactly as they did.
+def upgrade_state_dict(checkpoint):
+    state_dict = dict(checkpoint["model"])
+    if checkpoint.get("tokenizer_version", 1) < TOKENIZER_VERSION:
+        embedding = state_dict["embedding.weight"].clone()
+        embedding[PIECE_TO_TOKEN["b"]] = embedding[FILE_TO_TOKEN["b"]]
+        state_dict["embedding.weight"] = embedding
+    return state_dict
+
+# input: checkpoint path written by train.py
+# output: Model in eval mode with the checkpoint weights
+def load_model(checkpoint_path, config_path="model_config.yaml", device="cpu", **overrides):
+    with open(config_path) as f:
+        model_config = yaml.safe_load(f)
+    model_config.update(overrides)
+    # mmap reads only the pages of the tensors used, so the optimizer state saved next to the weights is never
+    # read from disk; weights_only unpickles tensors and plain containers without running arbitrary code
+    checkpoint = torch.load(checkpoint_path, map_location=torch.device(device), mmap=True, weights_only=True)
+    # checkpoints from before the CLS token
+    if "cls_token" not in checkpoint["model"]:
+        model_config["pooling"] = "last"
+    model = Model(**model_config)
+    model.load_state_dict(upgrade_state_dict(checkpoint))
+    return model.to(device).eval()
@@ -0,0 +1,104 @@
+from typing import Dict, List, Optional, Tuple
+
+import chess
+import numpy as np
+
+from codec import BOARD_LENGTH, BOARD_LOOKUP, MAX_FEN_LENGTH, PIECE_TO_TOKEN, TAIL_LOOKUP, decode_fen
+
+EMPTY_TOKEN = PIECE_TO_TOKEN['.']
+PAD_TOKEN = PIECE_TO_TOKEN['<PAD>']
+
+# (piece type, color) -> token of the piece as written for white to move and for black to move (swapcased)
+PIECE_TOKENS = {(piece_type, color): (BOARD_LOOKUP[ord(chess.Piece(piece_type, color).symbol())],
+                                      BOARD_LOOKUP[ord(chess.Piece(piece_type, color).symbol().swapcase())])
+                for piece_type in chess.PIECE_TYPES for color in chess.COLORS}
+
+# token column of every square: rank 8 comes first in a FEN
+SQUARE_COLUMNS = [(7 - chess.square_rank(square)) * 9 + chess.square_file(square) for square in chess.SQUARES]
+
+# input: castling field of the FEN (chess.Board.castling_xfen), en passant file or None, side to move
+# output: tokens after the board as normalize_fen writes them: castling rights (or '-'), a space, then the en passant square (or '-')
+def tail_tokens(castling: str, ep_file: Optional[int], turn: chess.Color) -> Tuple[int, ...]:
+    if turn == chess.BLACK:
+        castling = castling.swapcase()
+    ep = '-' if ep_file is None else chess.FILE_NAMES[ep_file] + '6'
+    return tuple(TAIL_LOOKUP[ord(char)] for char in f"{castling} {ep}")
+
+
+# Wraps a chess.Board and keeps its tokenized normalized FEN (dataloader.encode of normalize_fen) up to date as
+# moves are made and unmade, so a search can hand child positions to the model as token rows without
+# building any strings. The board part is stored for both sides to move (plain and swapcased); a move
+# rewrites only the squares it changed in both, and the side to move picks which one is read. The
+# castling and en passant tail is looked up by (castling rights, en passant file, side to move).
+# views[1] is the board as written for white to move, views[0] for black to move, so views[board.turn] is current.
+# tokens() follows the moves made through push() and pop(); a move pushed on the board directly must be
+# popped again before the next tokens() call. The board is shared, not copied.
+class TokenPosition:
+    def __init__(self, board: chess.Board, max_seq_length: int = MAX_FEN_LENGTH):
+        if board.chess960:
+            raise ValueError("normalized FENs describe standard chess only")
+        self.board = board
+        self.max_seq_length = max_seq_length
+        self.views = np.empty((2, BOARD_LENGTH), dtype=np.int64)
+        self.views[:, 8:BOARD_LENGTH - 1:9] = PIECE_TO_TOKEN['/']
+        self.views[:, BOARD_LENGTH - 1] = PIECE_TO_TOKEN[' ']
+        self.update(chess.SQUARES)
+        self.changed: List[List[int]] = []
+        self.tails: Dict[Tuple[int, Optional[int], chess.Color], Tuple[int, ...]] = {}
+
+    def update(self, squares: List[int]):
+        for square in squares:
+            piece = self.board.piece_at(square)
+            white, black = PIECE_TOKENS[piece.piece_type, piece.color] if piece else (EMPTY_TOKEN, EMPTY_TOKEN)
+            self.views[1, SQUARE_COLUMNS[square]] = white
+            self.views[0, SQUARE_COLUMNS[square]] = black
+
+    def push(self, move: chess.Move):
+        board = self.board
+        if board.is_castling(move):
+            squares = [chess.square(file, chess.square_rank(move.from_square)) for file in range(8)]
+        elif board.is_en_passant(move):
+            squares = [move.from_square, move.to_square, chess.square(chess.square_file(move.to_square), chess.square_rank(move.from_square))]
+        else:
+            squares = [move.from_square, move.to_square]
+        board.push(move)
+        self.update(squares)
+        self.changed.append(squares)
+
+    def pop(self) -> chess.Move:
+        move = self.board.pop()
+        self.update(self.changed.pop())
+        return move
+
+    def tail(self) -> Tuple[int, ...]:
+        board = self.board
+        # FENs only show an en passant square when the capture is legal
+        ep_file = chess.square_file(board.ep_square) if board.ep_square is not None and board.has_legal_en_passant() else None
+        key = (board.clean_castling_rights(), ep_file, board.turn)
+        tail = self.tails.get(key)
+        if tail is None:
+            tail = self.tails[key] = tail_tokens(board.castling_xfen(), ep_file, board.turn)
+        return tail
+
+    # output: token row of the current position, padded with <PAD> to max_seq_length
+    def tokens(self, out: Optional[np.ndarray] = None) -> np.ndarray:
+        if out is None:
+            out = np.empty(self.max_seq_length, dtype=np.int64)
+        tail = self.tail()
+        out[:BOARD_LENGTH] = self.views[int(self.board.turn)]
+        out[BOARD_LENGTH:BOARD_LENGTH + len(tail)] = tail
+        out[BOARD_LENGTH + len(tail):] = PAD_TOKEN
+        return out
+
+    # output: (number of moves, max_seq_length) token rows of the positions after each move
+    def child_tokens(self, moves: List[chess.Move]) -> np.ndarray:
+        out = np.empty((len(moves), self.max_seq_length), dtype=np.int64)
+        for row, move in zip(out, moves):
+            self.push(move)
+            self.tokens(row)
+            self.pop()
+        return out
+
+    # normalized FEN of the current position, for checks against normalize_fen
+    def fen(self) -> str:
+        return decode_fen(self.tokens())
@@ -1,194 +1,206 @@
-import chess
-import chess.pgn
+import argparse
+import glob
+import io
+import json
+import mmap
+import os
 import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import islice
+
 import numpy as np
 import torch
+from typing import Dict, Iterator, List, NamedTuple
+
+from codec import MAX_FEN_LENGTH, TOKENIZER_VERSION, encode_batch, pack_fens
+from dataloader import PositionBuffer, position_eval, read_mainline
 
 ALPHA = 0.1
 
-PIECE_MAP = {1: "P", 2: "P", 3: "R", 4: "R", 5: "N", 6: "B", 7: "B", 8: "Q", 9: "K", 10: "K",
-             11: "p", 12: "p", 13: "r", 14: "r", 15: "n", 16: "b", 17: "b", 18: "q", 19: "k", 20: "k"}
-
-# input: 8x8 Torch tensor
-# output: FEN string
-def convert_torch_to_fen(tensor):
-    board = tensor.tolist()
-    fen = ""
-
-    en_passant_str = "-"
-    empty_count = 0
-    for row in range(8):
-        for col in range(8):
-            if board[row][col] == 0:
-                empty_count += 1
-                if col == 7:
-                    fen += str(empty_count)
-                    empty_count = 0
-            else:
-                if empty_count > 0:
-                    fen += str(empty_count)
-                    empty_count = 0
-                fen += PIECE_MAP[board[row][col]]
-            if board[row][col] == 12:
-                if col > 0 and board[row][col - 1] == 1:
-                    en_passant_str = chr(ord("a") + col) + "6"
-                elif col < 7 and board[row][col + 1] == 1:
-                    en_passant_str = chr(ord("a") + col) + "6"
-        if row != 7:
-            fen += "/"
-        else:
-            fen += " "
-    
-    castling_is_legal = False
-    if board[7][3] == 9:
-        # checking if "black" can castle
-        if board[7][0] == 3:
-            castling_is_legal = True
-            fen += "K"
-        if board[7][7] == 3:
-            castling_is_legal = True
-            fen += "Q"
-
-    if board[7][4] == 9:
-        # checking if white can castle
-        if board[7][7] == 3:
-            castling_is_legal = True
-            fen += "K"
-        if board[7][0] == 3:
-            castling_is_legal = True
-            fen += "Q"
-    
-    if board[0][3] == 9:
-        # checking if "white" can castle
-        if board[0][0] == 3:
-            castling_is_legal = True
-            fen += "k"
-        if board[0][7] == 3:
-            castling_is_legal = True
-            fen += "q"
-
-    if board[0][3] == 9:
-        # checking if black can castle
-        if board[0][7] == 3:
-            castling_is_legal = True
-            fen += "k"
-        if board[0][0] == 3:
-            castling_is_legal = True
-            fen += "q"
-    
-    if not castling_is_legal:
-        fen += "-"
-
-    fen += " "
-    fen += en_passant_str
-    return fen
-
-# input: LIST of pgn file paths
+# input: pgn file path
+# output: (normalized FEN, eval) for each position, one at a time, so the file is never held in memory
+# Positions without an eval comment are skipped, not the rest of their game, as in ChessPositionDataset.process_positions.
+def iter_pgn_to_fen(pgn_file_path):
+    with open(pgn_file_path) as pgn:
+        while (positions := read_mainline(pgn)) is not None:
+            for fen, turn, is_checkmate, comment in positions:
+                eval = position_eval(turn, is_checkmate, comment, ALPHA)
+                if eval is not None:
+                    yield fen, eval
+
+# input: pgn file path
 # output: LIST of TUPLES of positions with evaluations
 def convert_pgn_to_fen(pgn_file_path):
-    output = []
-    pgn = open(pgn_file_path)
-    game = chess.pgn.read_game(pgn)
-    while game is not None:
-        if not game.variations:
-            continue
-        node = game.variations[0]
-        while node is not None:
-            # print(f"Node: {node}")
-            # print(f"Next move: " + node.move.__str__())
-            b = node.board()
-            fen = b.fen()
-            if b.turn == chess.BLACK:
-                fen = fen.swapcase()
-            # fen = ' '.join(fen.split(' ')[:-2])
-            temp = fen.split(' ')[:-2]
-            del temp[-3]
-            if temp[-1] != "-" and b.turn == chess.BLACK:
-                temp[-1] = temp[-1][:1].swapcase() + str(6)
-                # print(' '.join(temp))
-            fen = ' '.join(temp)
-            # print(f"FEN: {fen}")
-
-            if b.is_checkmate():
-                # print("Checkmate!")
-                eval = -ALPHA
-
-            else:
-                if not node.comment:
-                    break
-                # print(node.comment)
-                score = node.comment.split(" ")[1][:-1]
-                if "#" in score:
-                    if '-' in score:
-                        winning_color = chess.BLACK
-                    else:
-                        winning_color = chess.WHITE
-                    moves_left = int(re.findall('\d+', score)[0])
-                    if winning_color == b.turn:
-                        eval = 1 + ALPHA / (moves_left + 1)
-                    else:
-                        eval = -ALPHA / (moves_left + 1)
-                    # eval = (1 + ALPHA / (moves_left + 1)) * (2 * (winning_color == b.turn) - 1)
-                    # print(f"Checkmate eval: {eval}")
-                else:
-                    eval = 1 / (1 + np.e ** (-0.00368208 * float(score) * 100))
-                    # print(f"Position eval: {score} => {eval} winning probability")
-                    if b.turn == chess.BLACK:
-                        eval = 1 - eval
-            
-
-
-            # if b.turn == chess.WHITE:
-
-            #     if b.is_checkmate():
-            #         eval = int(b.outcome().winner)
-            #         mate_score = -1
-            #     else:
-            #         score = 
-
-            # else:
-
-            
-            # eval = 
-
-
-            # if not node.comment:
-            #     if node.variations:
-            #         node = node.variations[0]
-            #     else:
-            #         node = None
-            #     continue
-            # b = node.board()
-
-            # if b.is_checkmate():
-            #     sc_board = node.board().fen()
-            #     eval = b.turn
-            #     mate_score = 1 / (int(re.findall('\d+', score)[0]) + 1) * (2 * b.turn - 1)
-            #     output.append((sc_board, eval, mate_score))
-            #     break
-            # sc_board = b.fen()
-            # # print(node.comment)
-            # score = node.comment.split(" ")[1][:-1]
-            # mate_score = 0
-            # if "#" in score:
-            #     eval = 1 - ("-" in score)
-            #     mate_score = 1 / (int(re.findall('\d+', score)[0]) + 1) * ("-" in score)
-            # else:
-            #     eval = 1 / (1 + np.e ** (-0.00368208 * float(score) * 100))
-            #     mate_score = 0
-
-
-            # print((fen, eval))
-            assert -ALPHA <= eval <= 1 + ALPHA
-            output.append((fen, eval))
-            # output.append((sc_board, eval, mate_score))
-            # print(output[-1])
-            if node.variations:
-                node = node.variations[0]
-            else:
-                node = None
-        game = chess.pgn.read_game(pgn)
-
-    return output
-
-
+    return list(iter_pgn_to_fen(pgn_file_path))
+
+# input: pgn file path
+# output: PACKED_POSITION array of the same positions as convert_pgn_to_fen, 38 bytes per position
+def convert_pgn_to_packed(pgn_file_path, pack_size=4096):
+    buffer = PositionBuffer()
+    positions = iter_pgn_to_fen(pgn_file_path)
+    while batch := list(islice(positions, pack_size)):
+        fens, evals = zip(*batch)
+        buffer.append(pack_fens(fens, evals))
+    return buffer.array()
+
+
+# a game starts at every line that opens with its Event tag
+GAME_START = re.compile(rb'^\[Event ', re.MULTILINE)
+# one row per game, its game id is the row number
+GAME_INDEX = np.dtype([('file', np.uint16), ('offset', np.int64)])
+
+# input: pgn file path
+# output: byte offset of the start of every game, from one linear scan of the memory-mapped file
+def index_games(pgn_file_path: str) -> np.ndarray:
+    if os.path.getsize(pgn_file_path) == 0:
+        return np.zeros(0, dtype=np.int64)
+    with open(pgn_file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        offsets = np.fromiter((match.start() for match in GAME_START.finditer(data)), dtype=np.int64)
+    if len(offsets) == 0:
+        raise ValueError(f"{pgn_file_path} has no [Event headers to index games by")
+    return offsets
+
+def build_game_index(pgn_file_paths: List[str]) -> np.ndarray:
+    index = [np.rec.fromarrays([np.full(len(offsets), file), offsets], dtype=GAME_INDEX)
+             for file, offsets in enumerate(map(index_games, pgn_file_paths))]
+    return np.concatenate(index) if index else np.zeros(0, dtype=GAME_INDEX)
+
+
+# a contiguous run of games of one file, converted into one shard
+class GameRange(NamedTuple):
+    shard: int
+    pgn_file_path: str
+    first_game: int
+    offsets: np.ndarray  # byte offset of each game, then the end of the last one
+
+def game_ranges(pgn_file_paths: List[str], index: np.ndarray, games_per_shard: int) -> List[GameRange]:
+    ranges = []
+    for file, pgn_file_path in enumerate(pgn_file_paths):
+        game_ids = np.flatnonzero(index['file'] == file)
+        ends = np.append(index['offset'][game_ids[1:]], os.path.getsize(pgn_file_path))
+        for start in range(0, len(game_ids), games_per_shard):
+            ids = game_ids[start:start + games_per_shard]
+            offsets = np.append(index['offset'][ids], ends[start + len(ids) - 1])
+            ranges.append(GameRange(len(ranges), pgn_file_path, int(ids[0]), offsets))
+    return ranges
+
+def shard_path(out_dir: str, shard: int) -> str:
+    return os.path.join(out_dir, f'shard_{shard:05d}.npz')
+
+# input: game range, output directory
+# output: number of indexed games, positions written to the range's shard, and games found without an [Event tag
+# Columns: tokens (uint8, PAD-filled to max_seq_length), eval (float32), game_id (row of games.npy) and
+# ply (half-moves played before the position). Positions and evals are those of iter_pgn_to_fen.
+# A game without an [Event tag of its own lies in the byte range of the game before it; it is read as well and
+# shares that game's id, with its plies counted from its own start.
+def convert_game_range(game_range: GameRange, out_dir: str, alpha: float = ALPHA,
+                       max_seq_length: int = MAX_FEN_LENGTH) -> tuple:
+    fens, evals, game_ids, plies = [], [], [], []
+    with open(game_range.pgn_file_path, 'rb') as f:
+        f.seek(game_range.offsets[0])
+        data = f.read(int(game_range.offsets[-1] - game_range.offsets[0]))
+    starts = game_range.offsets - game_range.offsets[0]
+    unindexed = 0
+    for game, (start, end) in enumerate(zip(starts[:-1], starts[1:])):
+        # each game is parsed from its own bytes, so a malformed game cannot shift the ids of the next ones
+        pgn = io.StringIO(data[start:end].decode('utf-8', errors='replace'))
+        games_read = 0
+        while (positions := read_mainline(pgn)) is not None:
+            unindexed += games_read > 0
+            games_read += 1
+            for ply, (fen, turn, is_checkmate, comment) in enumerate(positions, 1):
+                eval = position_eval(turn, is_checkmate, comment, alpha)
+                if eval is not None:
+                    fens.append(fen)
+                    evals.append(eval)
+                    game_ids.append(game_range.first_game + game)
+                    plies.append(ply)
+
+    tokens = encode_batch(fens, max_seq_length=max_seq_length, dtype=torch.uint8).numpy() if fens \
+        else np.zeros((0, max_seq_length), dtype=np.uint8)
+    path = shard_path(out_dir, game_range.shard)
+    # write under a temporary name first so a half-written shard is never read
+    tmp_path = path[:-len('.npz')] + '.tmp.npz'
+    np.savez_compressed(tmp_path, tokens=tokens, eval=np.array(evals, dtype=np.float32),
+                        game_id=np.array(game_ids, dtype=np.int64), ply=np.array(plies, dtype=np.uint16),
+                        tokenizer_version=np.array(TOKENIZER_VERSION))
+    os.replace(tmp_path, path)
+    return len(starts) - 1, len(fens), unindexed
+
+# input: pgn file paths, output directory
+# output: summary of the run, also written to out_dir/index.json
+# Builds the game index (out_dir/games.npy) in the parent, then converts runs of games_per_shard games into
+# compressed shards in a pool of worker processes; workers=0 converts in-process.
+def preprocess(pgn_file_paths: List[str], out_dir: str, workers: int = None, games_per_shard: int = 1000,
+               alpha: float = ALPHA, max_seq_length: int = MAX_FEN_LENGTH, verbose: bool = True) -> Dict:
+    os.makedirs(out_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(out_dir, 'shard_*.npz')):
+        os.remove(path)
+
+    start = time.perf_counter()
+    index = build_game_index(pgn_file_paths)
+    np.save(os.path.join(out_dir, 'games.npy'), index)
+    ranges = game_ranges(pgn_file_paths, index, games_per_shard)
+    indexed = time.perf_counter()
+
+    def tally(results):
+        num_games, num_positions, num_unindexed = 0, 0, 0
+        for games, positions, unindexed in results:
+            num_games += games
+            num_positions += positions
+            num_unindexed += unindexed
+            if verbose:
+                print(f"{num_games}/{len(index)} games, {num_positions} positions")
+        return num_games, num_positions, num_unindexed
+
+    workers = os.cpu_count() if workers is None else workers
+    if workers > 0:
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [executor.submit(convert_game_range, game_range, out_dir, alpha, max_seq_length) for game_range in ranges]
+            num_games, num_positions, num_unindexed = tally(future.result() for future in as_completed(futures))
+    else:
+        num_games, num_positions, num_unindexed = tally(convert_game_range(game_range, out_dir, alpha, max_seq_length)
+                                                        for game_range in ranges)
+    elapsed = time.perf_counter() - start
+
+    summary = {'pgn_file_paths': pgn_file_paths, 'games': num_games, 'unindexed_games': num_unindexed,
+               'positions': num_positions, 'shards': len(ranges),
+               'workers': workers, 'alpha': alpha, 'max_seq_length': max_seq_length, 'tokenizer_version': TOKENIZER_VERSION,
+               'index_seconds': indexed - start, 'seconds': elapsed}
+    with open(os.path.join(out_dir, 'index.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+# input: output directory of preprocess
+# output: the columns of every shard, in game order
+def iter_position_shards(out_dir: str) -> Iterator[Dict[str, np.ndarray]]:
+    for path in sorted(glob.glob(os.path.join(out_dir, 'shard_*.npz'))):
+        if '.tmp' not in path:
+            with np.load(path) as shard:
+                yield {key: shard[key] for key in shard.files}
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Convert PGN files into compressed columnar position shards in parallel.")
+    parser.add_argument('pgn_file_paths', nargs='+')
+    parser.add_argument('--out-dir', default='positions')
+    parser.add_argument('--workers', type=int, default=None, help='processes converting game ranges, 0 runs in-process; defaults to the core count')
+    parser.add_argument('--games-per-shard', type=int, default=1000)
+    parser.add_argument('--alpha', type=float, default=ALPHA)
+    parser.add_argument('--max-seq-length', type=int, default=MAX_FEN_LENGTH)
+    parser.add_argument('--quiet', action='store_true')
+    args = parser.parse_args(argv)
+
+    summary = preprocess(args.pgn_file_paths, args.out_dir, workers=args.workers, games_per_shard=args.games_per_shard,
+                         alpha=args.alpha, max_seq_length=args.max_seq_length, verbose=not args.quiet)
+    print(f"{summary['games']} games, {summary['positions']} positions in {summary['shards']} shards; "
+          f"index {summary['index_seconds']:.2f}s, total {summary['seconds']:.2f}s, "
+          f"{summary['positions'] / summary['seconds']:,.0f} positions/sec with {summary['workers']} workers")
+    if summary['unindexed_games']:
+        print(f"{summary['unindexed_games']} games had no [Event tag and were read with the game before them")
+    return summary
+
+
+if __name__ == "__main__":
+    main()
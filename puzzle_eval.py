@@ -1,24 +1,204 @@
-import pandas as pd
+import argparse
+import csv
+import io
 import random
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
+
 import chess
+import numpy as np
+from typing import Iterator, List, NamedTuple, Tuple
+
+from cache import position_key
 
-PUZZLES = pd.read_csv("puzzles.csv")
 eval_func = lambda fen: random.random()
 SAMPLE_PUZZLE = ['4r3/1k6/pp3r2/1b2P2p/3R1p2/P1R2P2/1P4PP/6K1 w - - 0 35', 'e5f6', 1.33, eval_func]
 
-def eval_mate(fen, sol, true_eval, eval_func):
+# eval_func scores a FEN for its side to move, so the best move is the one that leaves the opponent the lowest score
+# with an EvalCache, positions that were already scored (transpositions, repeated puzzles) skip eval_func
+def eval_mate(fen, sol, true_eval, eval_func, cache=None):
     eval_error = abs(eval_func(fen) - true_eval)
     b = chess.Board(fen)
-    legal_moves = b.legal_moves
-    max_eval = 0
+    legal_moves = list(b.legal_moves)
+    min_eval = float('inf')
     best_move = None
     for m in legal_moves:
-        diagram = b.copy()
-        diagram.push(m)
-        v = eval_func(diagram)
-        if v > max_eval:
-            max_eval = v
+        # make and unmake the move on one board instead of copying it for every candidate
+        b.push(m)
+        if cache is None:
+            v = eval_func(b.fen())
+        else:
+            key = position_key(b)
+            v = cache.get(key)
+            if v is None:
+                v = eval_func(b.fen())
+                cache.put(key, v)
+        b.pop()
+        if v < min_eval:
+            min_eval = v
             best_move = m
-    return eval_error, best_move == sol
+    return eval_error, best_move is not None and best_move.uci() == sol
+
+# eval_mate(*SAMPLE_PUZZLE)
+
+
+class Puzzle(NamedTuple):
+    fen: str
+    moves: List[str]
+    themes: List[str]
+
+# input: puzzle CSV with FEN, Moves and Themes columns (mini_mate_puzzles.csv or a Lichess dump, optionally .zst)
+# output: puzzles, read lazily so dumps with millions of rows never sit in memory
+def iter_puzzles(path: str) -> Iterator[Puzzle]:
+    if path.endswith('.zst'):
+        import zstandard
+        f = io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True), encoding='utf-8')
+    else:
+        f = open(path, newline='')
+    with f:
+        for row in csv.DictReader(f):
+            yield Puzzle(row['FEN'], row['Moves'].split(), row['Themes'].split())
+
+# Lichess puzzles start one move early: the FEN is the position before the opponent's move
+# (moves[0]) and the solver's answer is moves[1].
+def puzzle_board(puzzle: Puzzle) -> chess.Board:
+    board = chess.Board(puzzle.fen)
+    board.push_uci(puzzle.moves[0])
+    return board
+
+# input: evaluator with evaluate_fens (search.ModelEvaluator, server.EvalClient), list of puzzles
+# output: (themes, solved) per puzzle, seconds for the batch, number of positions evaluated
+# Every legal child of every puzzle goes through the model in one batch; a puzzle counts as
+# solved when the chosen move is the solution or any other move that mates. Evaluators with
+# evaluate_tokens get the children as token rows from a TokenPosition instead of FEN strings.
+def solve_batch(evaluator, puzzles: List[Puzzle]) -> Tuple[List[Tuple[List[str], bool]], float, int]:
+    # imported here so a parent process that only reads puzzles and hands them to workers never loads torch
+    from codec import normalize_fen
+    from position import TokenPosition
+
+    start = time.perf_counter()
+    use_tokens = hasattr(evaluator, 'evaluate_tokens')
+    boards, moves, children = [], [], []
+    for puzzle in puzzles:
+        board = puzzle_board(puzzle)
+        legal_moves = list(board.legal_moves)
+        if use_tokens:
+            children.append(TokenPosition(board, max_seq_length=evaluator.token_width).child_tokens(legal_moves))
+        else:
+            for move in legal_moves:
+                board.push(move)
+                children.append(normalize_fen(board))
+                board.pop()
+        boards.append(board)
+        moves.append(legal_moves)
+
+    values = evaluator.evaluate_tokens(np.concatenate(children)) if use_tokens else evaluator.evaluate_fens(children)
+    positions = len(values)
+
+    results, offset = [], 0
+    for puzzle, board, legal_moves in zip(puzzles, boards, moves):
+        child_values = values[offset:offset + len(legal_moves)]
+        offset += len(legal_moves)
+        best_move = legal_moves[int(np.argmin(child_values))]
+        board.push(best_move)
+        solved = best_move.uci() == puzzle.moves[1] or board.is_checkmate()
+        results.append((puzzle.themes, solved))
+    return results, time.perf_counter() - start, positions
+
+_worker_evaluator = None
+
+def init_worker(checkpoint: str, device: str, max_batch_size: int, threads: int):
+    global _worker_evaluator
+    import torch
+    from model import load_model
+    from search import ModelEvaluator
+
+    torch.set_num_threads(threads)
+    _worker_evaluator = ModelEvaluator(load_model(checkpoint, device=device), device=device, max_batch_size=max_batch_size)
+
+def solve_batch_in_worker(puzzles: List[Puzzle]):
+    return solve_batch(_worker_evaluator, puzzles)
+
+def batched(iterable, n):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, n)):
+        yield batch
+
+# like executor.map, but only keeps max_in_flight batches submitted so a large dump streams through
+def bounded_map(executor, fn, iterable, max_in_flight):
+    pending = set()
+    for item in iterable:
+        if len(pending) >= max_in_flight:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            yield from (future.result() for future in done)
+        pending.add(executor.submit(fn, item))
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        yield from (future.result() for future in done)
+
+def run_benchmark(checkpoint: str, puzzles_path: str, batch_puzzles: int = 64, workers: int = 0, limit: int = None,
+                  device: str = 'cpu', max_batch_size: int = 4096, threads: int = 1):
+    puzzles = islice(iter_puzzles(puzzles_path), limit)
+    batches = batched(puzzles, batch_puzzles)
+
+    if workers > 0:
+        executor = ProcessPoolExecutor(workers, initializer=init_worker, initargs=(checkpoint, device, max_batch_size, threads))
+        results = bounded_map(executor, solve_batch_in_worker, batches, 2 * workers)
+    else:
+        import torch
+        executor = None
+        init_worker(checkpoint, device, max_batch_size, torch.get_num_threads())
+        results = map(solve_batch_in_worker, batches)
+
+    solved_by_theme, total_by_theme = defaultdict(int), defaultdict(int)
+    batch_latencies, puzzle_latencies, num_puzzles, num_positions = [], [], 0, 0
+    start = time.perf_counter()
+    # the pool is shut down on errors too, dropping the batches it has not started
+    try:
+        for batch_results, latency, positions in results:
+            for themes, solved in batch_results:
+                for theme in ['all'] + themes:
+                    total_by_theme[theme] += 1
+                    solved_by_theme[theme] += solved
+            # a puzzle is answered with the rest of its batch, so its own cost is its share of the batch latency
+            batch_latencies.append(latency)
+            puzzle_latencies.extend([latency / len(batch_results)] * len(batch_results))
+            num_puzzles += len(batch_results)
+            num_positions += positions
+        elapsed = time.perf_counter() - start
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    print(f"{'theme':<20} {'solved':>8} {'total':>8} {'rate':>7}")
+    for theme in sorted(total_by_theme, key=lambda theme: (theme != 'all', -total_by_theme[theme], theme)):
+        print(f"{theme:<20} {solved_by_theme[theme]:>8} {total_by_theme[theme]:>8} {solved_by_theme[theme] / total_by_theme[theme]:>7.1%}")
+    print(f"throughput: {num_puzzles / elapsed:,.1f} puzzles/sec, {num_positions / elapsed:,.0f} positions/sec")
+    if batch_latencies:
+        p50, p90, p99 = np.percentile(batch_latencies, [50, 90, 99]) * 1e3
+        print(f"latency per batch of up to {batch_puzzles} puzzles: p50 {p50:.1f} ms, p90 {p90:.1f} ms, p99 {p99:.1f} ms")
+        p50, p90, p99 = np.percentile(puzzle_latencies, [50, 90, 99]) * 1e3
+        print(f"batch latency / puzzles in the batch: p50 {p50:.2f} ms, p90 {p90:.2f} ms, p99 {p99:.2f} ms")
+    return solved_by_theme, total_by_theme
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Batched puzzle benchmark: solve rate by theme, throughput and latency.")
+    parser.add_argument('checkpoint')
+    parser.add_argument('--puzzles', default='mini_mate_puzzles.csv')
+    parser.add_argument('--batch-puzzles', type=int, default=64, help='puzzles whose child positions share one model batch')
+    parser.add_argument('--workers', type=int, default=0, help='processes to spread batches over, 0 runs in-process')
+    parser.add_argument('--threads', type=int, default=1, help='torch threads per worker process')
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--max-batch-size', type=int, default=4096)
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args(argv)
+
+    return run_benchmark(args.checkpoint, args.puzzles, batch_puzzles=args.batch_puzzles, workers=args.workers, limit=args.limit,
+                         device=args.device, max_batch_size=args.max_batch_size, threads=args.threads)
+
 
-# eval_mate(*SAMPLE_PUZZLE)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
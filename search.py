@@ -0,0 +1,370 @@
+import argparse
+import time
+
+import chess
+import chess.polyglot
+import numpy as np
+import torch
+from typing import Dict, List, NamedTuple, Optional
+
+from cache import EvalCache, TranspositionTable, position_key, EXACT, LOWER_BOUND, UPPER_BOUND
+from codec import MAX_FEN_LENGTH, PIECE_TO_TOKEN, encode_batch, normalize_fen
+from model import load_model
+from position import TokenPosition
+
+# scores are centered so the opponent's score is the negation of ours; a mate outranks any network output
+MATE_SCORE = 100.0
+MATE_THRESHOLD = MATE_SCORE / 2
+DRAW_SCORE = 0.0
+PIECE_VALUES = {chess.PAWN: 1, chess.KNIGHT: 3, chess.BISHOP: 3, chess.ROOK: 5, chess.QUEEN: 9, chess.KING: 0}
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+# Runs Model on batches of positions. Outputs are returned relative to draw_value: train.py standardizes
+# its targets, so 0.0 is the average position; use 0.5 for a model trained on the raw [-alpha, 1 + alpha] evals.
+# Positions already in the optional EvalCache are not sent through the network again.
+class ModelEvaluator:
+    def __init__(self, model, device: str = 'cpu', max_batch_size: int = 512, draw_value: float = 0.0,
+                 cache: Optional[EvalCache] = None):
+        self.model = model.to(device).eval()
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.draw_value = draw_value
+        self.cache = cache
+
+    # width of the token rows this evaluator takes (see evaluate_tokens)
+    @property
+    def token_width(self) -> int:
+        return self.model.input_length or MAX_FEN_LENGTH
+
+    @torch.no_grad()
+    def evaluate_fens(self, fens: List[str]) -> List[float]:
+        values = []
+        for start in range(0, len(fens), self.max_batch_size):
+            tokens = encode_batch(fens[start:start + self.max_batch_size], max_seq_length=self.model.input_length)
+            tokens = tokens.to(self.device, non_blocking=True)
+            values.extend((self.model.forward_tokens(tokens)[:, 0] - self.draw_value).tolist())
+        return values
+
+    # input: (positions, token_width) token rows, e.g. from position.TokenPosition
+    # output: same values as evaluate_fens of the FENs the rows encode
+    @torch.no_grad()
+    def evaluate_tokens(self, tokens: np.ndarray) -> List[float]:
+        values = []
+        for start in range(0, len(tokens), self.max_batch_size):
+            batch = tokens[start:start + self.max_batch_size]
+            if self.model.input_length is None:
+                # a model without a static input length sees the batch padded only to its longest row
+                batch = batch[:, :int((batch != PIECE_TO_TOKEN['<PAD>']).sum(1).max())]
+            batch = torch.from_numpy(np.ascontiguousarray(batch)).to(self.device, non_blocking=True)
+            values.extend((self.model.forward_tokens(batch)[:, 0] - self.draw_value).tolist())
+        return values
+
+    def evaluate(self, boards: List[chess.Board]) -> List[float]:
+        if self.cache is None:
+            return self.evaluate_fens([normalize_fen(b) for b in boards])
+
+        keys = [position_key(b) for b in boards]
+        values = [self.cache.get(key) for key in keys]
+        missing = {}
+        for board, key, value in zip(boards, keys, values):
+            if value is None and key not in missing:
+                missing[key] = normalize_fen(board)
+        for key, value in zip(missing, self.evaluate_fens(list(missing.values()))):
+            self.cache.put(key, value)
+            missing[key] = value
+        return [missing[key] if value is None else value for key, value in zip(keys, values)]
+
+
+class SearchStats:
+    def __init__(self, max_batch_size: int):
+        self.max_batch_size = max_batch_size
+        self.start_time = time.perf_counter()
+        self.nodes = 0
+        self.leaf_evals = 0
+        self.batches = 0
+        self.eval_seconds = 0.0
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start_time
+
+    @property
+    def nodes_per_second(self) -> float:
+        return self.nodes / max(self.elapsed, 1e-9)
+
+    # fraction of the evaluator's batch capacity that was filled, averaged over all forward passes
+    @property
+    def batch_occupancy(self) -> float:
+        return self.leaf_evals / max(self.batches * self.max_batch_size, 1)
+
+    def __str__(self) -> str:
+        return (f"nodes {self.nodes} ({self.nodes_per_second:,.0f} nodes/sec), leaf evals {self.leaf_evals} "
+                f"in {self.batches} batches ({self.batch_occupancy:.1%} occupancy), {self.elapsed:.2f}s")
+
+
+class SearchResult(NamedTuple):
+    best_move: Optional[chess.Move]
+    score: float
+    depth: int
+    pv: List[chess.Move]
+    stats: SearchStats
+
+
+# Negamax alpha-beta with iterative deepening that uses Model as the static evaluator.
+# Once a node is within prefetch_depth plies of the horizon, every leaf below it is evaluated
+# up front in batches of at most max_batch_size, and the alpha-beta pass reads them back.
+# Leaves that are later pruned cost some extra evaluations, but each network call sees a full batch.
+# Leaf values live in a bounded EvalCache and search results in a TranspositionTable; both are
+# kept between searches, so positions that recur during a game are not evaluated twice.
+# Moves are made through a TokenPosition, so leaves reach the evaluator as token rows without any FEN
+# strings; evaluators that only take FENs (server.EvalClient) are sent normalized FENs instead.
+class Searcher:
+    def __init__(self, evaluator: ModelEvaluator, prefetch_depth: int = 2, cache_mb: float = 64, tt_mb: float = 64):
+        self.evaluator = evaluator
+        self.use_tokens = hasattr(evaluator, 'evaluate_tokens')
+        self.position = None
+        self.prefetch_depth = prefetch_depth
+        self.cache = evaluator.cache if evaluator.cache is not None else EvalCache(cache_mb)
+        self.tt = TranspositionTable(tt_mb)
+        self.killers: Dict[int, List[chess.Move]] = {}
+        self.pv: Dict[int, List[chess.Move]] = {}
+        self.deadline = None
+        self.stats = None
+
+    def search(self, board: chess.Board, max_depth: int = 4, time_limit: Optional[float] = None) -> SearchResult:
+        board = board.copy()
+        self.position = TokenPosition(board, max_seq_length=self.evaluator.token_width if self.use_tokens else MAX_FEN_LENGTH)
+        self.stats = SearchStats(self.evaluator.max_batch_size)
+        self.deadline = None if time_limit is None else time.perf_counter() + time_limit
+        self.killers = {}
+        self.pv = {}
+        self.tt.new_search()
+
+        result = SearchResult(None, DRAW_SCORE, 0, [], self.stats)
+        root_moves = list(board.legal_moves)
+        if not root_moves:
+            return result
+
+        for depth in range(1, max_depth + 1):
+            try:
+                scores = self.search_root(board, root_moves, depth)
+            except SearchTimeout:
+                break
+            # the next iteration searches the best moves of this one first
+            root_moves.sort(key=lambda move: scores[move], reverse=True)
+            best_move = root_moves[0]
+            result = SearchResult(best_move, scores[best_move], depth, self.pv[0], self.stats)
+        return result
+
+    def check_deadline(self):
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            raise SearchTimeout()
+
+    def search_root(self, board: chess.Board, moves: List[chess.Move], depth: int) -> Dict[chess.Move, float]:
+        if depth <= self.prefetch_depth:
+            self.prefetch(board, depth)
+
+        alpha, scores = -float('inf'), {}
+        for move in moves:
+            self.position.push(move)
+            scores[move] = -self.negamax(board, depth - 1, -float('inf'), -alpha, 1, depth <= self.prefetch_depth)
+            self.position.pop()
+            if scores[move] > alpha:
+                alpha = scores[move]
+                self.pv[0] = [move] + self.pv.get(1, [])
+        return scores
+
+    def negamax(self, board: chess.Board, depth: int, alpha: float, beta: float, ply: int, prefetched: bool) -> float:
+        self.stats.nodes += 1
+        self.pv[ply] = []
+        self.check_deadline()
+
+        if depth == 0:
+            if board.is_check() and board.is_checkmate():
+                return -MATE_SCORE + ply
+            return self.leaf_value(board)
+
+        moves = list(board.legal_moves)
+        if not moves:
+            return -MATE_SCORE + ply if board.is_check() else DRAW_SCORE
+        if board.is_insufficient_material():
+            return DRAW_SCORE
+
+        key = chess.polyglot.zobrist_hash(board)
+        entry = self.tt.probe(key)
+        hash_move = None
+        if entry is not None:
+            hash_move = entry.move
+            if entry.depth >= depth:
+                score = score_from_tt(entry.score, ply)
+                if entry.flag == EXACT or (entry.flag == LOWER_BOUND and score >= beta) or (entry.flag == UPPER_BOUND and score <= alpha):
+                    if entry.move is not None:
+                        self.pv[ply] = [entry.move]
+                    return score
+
+        if not prefetched and depth <= self.prefetch_depth:
+            self.prefetch(board, depth)
+            prefetched = True
+
+        original_alpha = alpha
+        best, best_move = -float('inf'), None
+        for move in self.order_moves(board, moves, depth, ply, hash_move):
+            self.position.push(move)
+            score = -self.negamax(board, depth - 1, -beta, -alpha, ply + 1, prefetched)
+            self.position.pop()
+
+            if score > best:
+                best, best_move = score, move
+            if best > alpha:
+                alpha = best
+                self.pv[ply] = [move] + self.pv.get(ply + 1, [])
+            if alpha >= beta:
+                if not board.is_capture(move):
+                    killers = self.killers.setdefault(ply, [])
+                    if move not in killers:
+                        killers.insert(0, move)
+                        del killers[2:]
+                break
+
+        flag = UPPER_BOUND if best <= original_alpha else LOWER_BOUND if best >= beta else EXACT
+        self.tt.store(key, depth, score_to_tt(best, ply), flag, best_move)
+        return best
+
+    def order_moves(self, board: chess.Board, moves: List[chess.Move], depth: int, ply: int,
+                    hash_move: Optional[chess.Move] = None) -> List[chess.Move]:
+        # one ply above the leaves the network values of the children are already known
+        if depth == 1:
+            def child_value(move):
+                board.push(move)
+                value = self.cache.peek(position_key(board), 0.0)
+                board.pop()
+                return value
+            return sorted(moves, key=child_value)
+
+        killers = self.killers.get(ply, [])
+        def priority(move):
+            if move == hash_move:
+                return -1000
+            if board.is_capture(move):
+                victim = board.piece_type_at(move.to_square) or chess.PAWN
+                attacker = board.piece_type_at(move.from_square)
+                return -(100 + 10 * PIECE_VALUES[victim] - PIECE_VALUES[attacker])
+            if move.promotion:
+                return -90
+            if move in killers:
+                return -80 + killers.index(move)
+            return 0
+        return sorted(moves, key=priority)
+
+    def leaf_value(self, board: chess.Board) -> float:
+        key = position_key(board)
+        value = self.cache.get(key)
+        if value is None:
+            value = self.evaluate({key: self.leaf_input()})[0]
+        return value
+
+    # the current position as the evaluator takes it: a token row, or a normalized FEN
+    def leaf_input(self):
+        return self.position.tokens() if self.use_tokens else normalize_fen(self.position.board)
+
+    # gather all non-terminal leaves `depth` plies below board and evaluate the ones not in the cache in batches
+    def prefetch(self, board: chess.Board, depth: int):
+        missing = {}
+
+        def collect(depth):
+            if depth == 0:
+                if not (board.is_check() and board.is_checkmate()):
+                    key = position_key(board)
+                    if key not in missing and key not in self.cache:
+                        missing[key] = self.leaf_input()
+                return
+            self.check_deadline()
+            for move in board.legal_moves:
+                self.position.push(move)
+                collect(depth - 1)
+                self.position.pop()
+
+        collect(depth)
+        self.evaluate(missing)
+
+    # input: position key -> leaf_input() of the position
+    # The deadline is checked before every model batch, and under a time limit a batch is cut to the leaves that the
+    # measured cost per leaf says fit in half the time left, so a large prefetch cannot run far past the limit.
+    # Batches evaluated before a timeout stay in the cache.
+    def evaluate(self, leaves: Dict) -> List[float]:
+        keys, inputs = list(leaves), list(leaves.values())
+        values = []
+        while len(values) < len(inputs):
+            self.check_deadline()
+            start = len(values)
+            batch = inputs[start:start + self.batch_size()]
+            eval_start = time.perf_counter()
+            batch_values = self.evaluator.evaluate_tokens(np.stack(batch)) if self.use_tokens else self.evaluator.evaluate_fens(batch)
+            self.stats.eval_seconds += time.perf_counter() - eval_start
+            for key, value in zip(keys[start:start + len(batch)], batch_values):
+                self.cache.put(key, value)
+            values.extend(batch_values)
+            self.stats.leaf_evals += len(batch)
+            self.stats.batches += 1
+        return values
+
+    def batch_size(self) -> int:
+        if self.deadline is None or self.stats.leaf_evals == 0:
+            return self.evaluator.max_batch_size
+        seconds_per_leaf = self.stats.eval_seconds / self.stats.leaf_evals
+        return max(1, min(self.evaluator.max_batch_size, int((self.deadline - time.perf_counter()) / 2 / seconds_per_leaf)))
+
+
+# mate scores are stored relative to the node so they stay correct when the position recurs at another ply
+def score_to_tt(score: float, ply: int) -> float:
+    if score > MATE_THRESHOLD:
+        return score + ply
+    if score < -MATE_THRESHOLD:
+        return score - ply
+    return score
+
+def score_from_tt(score: float, ply: int) -> float:
+    if score > MATE_THRESHOLD:
+        return score - ply
+    if score < -MATE_THRESHOLD:
+        return score + ply
+    return score
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Search a position with Model as the leaf evaluator.")
+    parser.add_argument('checkpoint')
+    parser.add_argument('--fen', default=chess.STARTING_FEN)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--time-limit', type=float, default=None)
+    parser.add_argument('--max-batch-size', type=int, default=512)
+    parser.add_argument('--prefetch-depth', type=int, default=2)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--cache-mb', type=float, default=64)
+    parser.add_argument('--tt-mb', type=float, default=64)
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    model = load_model(args.checkpoint, device=args.device)
+    evaluator = ModelEvaluator(model, device=args.device, max_batch_size=args.max_batch_size, cache=EvalCache(args.cache_mb))
+    searcher = Searcher(evaluator, prefetch_depth=args.prefetch_depth, tt_mb=args.tt_mb)
+    board = chess.Board(args.fen)
+    result = searcher.search(board, max_depth=args.depth, time_limit=args.time_limit)
+
+    print(f"best move {board.san(result.best_move) if result.best_move else None} score {result.score:.4f} depth {result.depth}")
+    print(f"pv {chess.Board(args.fen).variation_san(result.pv)}")
+    print(result.stats)
+    print(searcher.cache)
+    print(searcher.tt)
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import chess
+import numpy as np
+
+from fen import encode, is_normalized_fen, normalize_fen
+
+DEFAULT_SOCKET = '/tmp/chess_eval.sock'
+
+# Protocol: newline-delimited text. A client sends one normalized FEN (fen.normalize_fen) per
+# line and gets one line back per request, in request order: the model value, or "ERR <reason>".
+# Clients may pipeline any number of requests; the line "STATS" returns the server metrics as JSON.
+
+
+# Long-running evaluation service: one Model, shared by every client.
+# Requests from all connections go through one bounded queue and are gathered into micro-batches of at
+# most max_batch_size, waiting at most max_wait seconds for a batch to fill; one forward pass per batch.
+# When the queue is full the server stops reading from clients until there is room again (backpressure),
+# and a connection that does not read its answers stops being read after max_pending requests.
+class EvalServer:
+    def __init__(self, evaluator, max_batch_size: int = 256, max_wait: float = 0.002, max_queue: int = 4096,
+                 max_pending: int = 1024, stats_interval: float = 10.0):
+        self.evaluator = evaluator
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.max_pending = max_pending
+        self.stats_interval = stats_interval
+        # the model runs on its own thread so the event loop keeps accepting requests during a forward pass
+        self.executor = ThreadPoolExecutor(1)
+        self.latencies = deque(maxlen=100_000)
+        self.requests = 0
+        self.batches = 0
+        self.connections = set()
+        self.start_time = time.perf_counter()
+
+    async def serve(self, path: Optional[str] = DEFAULT_SOCKET, port: Optional[int] = None):
+        self.queue = asyncio.Queue(self.max_queue)
+        self.stopping = asyncio.Event()
+        if port is not None:
+            server = await asyncio.start_server(self.handle, '127.0.0.1', port)
+        else:
+            if os.path.exists(path):
+                os.remove(path)
+            server = await asyncio.start_unix_server(self.handle, path)
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stopping.set)
+        batcher = asyncio.create_task(self.batcher())
+        reporter = asyncio.create_task(self.report())
+        print(f"serving on {'127.0.0.1:' + str(port) if port is not None else path}", flush=True)
+
+        await self.stopping.wait()
+        # graceful shutdown: stop accepting, answer everything already queued, then close the connections
+        print("shutting down", flush=True)
+        server.close()
+        await self.queue.join()
+        batcher.cancel()
+        reporter.cancel()
+        for writer in list(self.connections):
+            writer.close()
+        self.executor.shutdown()
+        if port is None and os.path.exists(path):
+            os.remove(path)
+        print(self.stats(), flush=True)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        pending = asyncio.Queue(self.max_pending)
+        responder = asyncio.create_task(self.respond(pending, writer))
+        self.connections.add(writer)
+        try:
+            while not self.stopping.is_set():
+                line = await reader.readline()
+                if not line:
+                    break
+                fen = line.decode('ascii', errors='replace').strip()
+                future = loop.create_future()
+                if fen == 'STATS':
+                    future.set_result(json.dumps(self.stats()))
+                elif not is_normalized_fen(fen):
+                    future.set_exception(ValueError('not a normalized FEN'))
+                elif len(encode(fen)) > self.evaluator.token_width:
+                    future.set_exception(ValueError(f'FEN is longer than the model input of {self.evaluator.token_width} tokens'))
+                else:
+                    # waits while the queue is full, which stops reading from this client
+                    await self.queue.put((fen, future, time.perf_counter()))
+                await pending.put(future)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            await pending.put(None)
+            await responder
+            self.connections.discard(writer)
+            writer.close()
+
+    async def respond(self, pending: asyncio.Queue, writer: asyncio.StreamWriter):
+        while (future := await pending.get()) is not None:
+            try:
+                value = await future
+                line = value if isinstance(value, str) else f"{value:.6f}"
+            except Exception as e:
+                line = f"ERR {e}"
+            try:
+                writer.write(line.encode() + b'\n')
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                values = await loop.run_in_executor(self.executor, self.evaluate_batch, [fen for fen, _, _ in batch])
+                for (_, future, _), value in zip(batch, values):
+                    if future.done():
+                        continue
+                    if isinstance(value, Exception):
+                        future.set_exception(value)
+                    else:
+                        future.set_result(value)
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+            now = time.perf_counter()
+            self.latencies.extend(now - start for _, _, start in batch)
+            self.requests += len(batch)
+            self.batches += 1
+            for _ in batch:
+                self.queue.task_done()
+
+    # runs on the model thread: one forward pass for the batch, or one per request if the batch fails, so a request
+    # that gets past the checks in handle fails alone instead of failing every client in its batch
+    # output: a value or an exception per FEN
+    def evaluate_batch(self, fens: List[str]) -> list:
+        try:
+            return self.evaluator.evaluate_fens(fens)
+        except Exception:
+            results = []
+            for fen in fens:
+                try:
+                    results.append(self.evaluator.evaluate_fens([fen])[0])
+                except Exception as e:
+                    results.append(e)
+            return results
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            if self.requests:
+                print(json.dumps(self.stats()), flush=True)
+
+    def stats(self) -> dict:
+        elapsed = time.perf_counter() - self.start_time
+        stats = {
+            'requests': self.requests,
+            'batches': self.batches,
+            'mean_batch_size': self.requests / max(self.batches, 1),
+            'requests_per_sec': self.requests / max(elapsed, 1e-9),
+            'queue_depth': self.queue.qsize(),
+            'connections': len(self.connections),
+        }
+        if self.latencies:
+            p50, p90, p99 = (np.percentile(self.latencies, [50, 90, 99]) * 1e3).tolist()
+            stats.update(latency_p50_ms=p50, latency_p90_ms=p90, latency_p99_ms=p99)
+        return stats
+
+
+# Blocking client with the evaluator interface of search.ModelEvaluator (evaluate_fens, evaluate), so
+# Searcher and puzzle_eval.solve_batch can run against a shared server instead of their own Model.
+class EvalClient:
+    def __init__(self, path: Optional[str] = DEFAULT_SOCKET, port: Optional[int] = None, max_batch_size: int = 256):
+        if port is not None:
+            self.sock = socket.create_connection(('127.0.0.1', port))
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(path)
+        self.reader = self.sock.makefile('rb')
+        self.max_batch_size = max_batch_size
+        self.cache = None
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+    # All requests are sent before the first answer is read so the server can batch them together. The
+    # sending runs on its own thread: a long request list would otherwise fill the socket buffers while
+    # nobody reads the answers.
+    def evaluate_fens(self, fens: List[str]) -> List[float]:
+        payload = ''.join(fen + '\n' for fen in fens).encode('ascii')
+        sender = threading.Thread(target=self.sock.sendall, args=(payload,))
+        sender.start()
+        lines = [self.reader.readline().decode().strip() for _ in fens]
+        sender.join()
+
+        values = []
+        for fen, line in zip(fens, lines):
+            if not line or line.startswith('ERR'):
+                raise ValueError(f"{fen}: {line[4:] if line else 'connection closed'}")
+            values.append(float(line))
+        return values
+
+    def evaluate(self, boards: List[chess.Board]) -> List[float]:
+        return self.evaluate_fens([normalize_fen(board) for board in boards])
+
+    def stats(self) -> dict:
+        self.sock.sendall(b'STATS\n')
+        return json.loads(self.reader.readline())
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Serve Model evaluations to local clients with dynamic micro-batching.")
+    parser.add_argument('checkpoint')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='Unix socket path')
+    parser.add_argument('--port', type=int, default=None, help='listen on 127.0.0.1:PORT instead of a Unix socket')
+    parser.add_argument('--max-batch-size', type=int, default=256)
+    parser.add_argument('--max-wait-ms', type=float, default=2.0)
+    parser.add_argument('--max-queue', type=int, default=4096)
+    parser.add_argument('--stats-interval', type=float, default=10.0)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    # only the server loads the model; clients importing EvalClient skip it
+    import torch
+    from model import load_model
+    from search import ModelEvaluator
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    evaluator = ModelEvaluator(load_model(args.checkpoint, device=args.device), device=args.device, max_batch_size=args.max_batch_size)
+    server = EvalServer(evaluator, max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000,
+                        max_queue=args.max_queue, stats_interval=args.stats_interval)
+    asyncio.run(server.serve(args.socket, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import argparse
+import glob
+import os
+
+import numpy as np
+import torch
+import yaml
+from torch.utils.data import Dataset, DataLoader, DistributedSampler
+from typing import List, Tuple
+
+from codec import BOARD_LENGTH, FILE_TO_TOKEN, PIECE_TO_TOKEN, encode_batch
+from dataloader import position_eval, read_mainline
+
+TOKENS_SUFFIX = '.tokens.npy'
+EVALS_SUFFIX = '.evals.npy'
+
+
+def _shard_prefix(out_dir: str, shard_idx: int) -> str:
+    return os.path.join(out_dir, f'shard_{shard_idx:05d}')
+
+
+def _flush_shard(out_dir: str, shard_idx: int, tokens: np.ndarray, evals: np.ndarray, n: int):
+    prefix = _shard_prefix(out_dir, shard_idx)
+    # write under a temporary name first so a half-written shard is never picked up by the dataset
+    for suffix, array in ((TOKENS_SUFFIX, tokens), (EVALS_SUFFIX, evals)):
+        tmp_path = prefix + '.tmp' + suffix
+        np.save(tmp_path, array[:n])
+        os.replace(tmp_path, prefix + suffix)
+
+
+# tokenizes the pending FENs straight into the rows of tokens that end at row end, then clears them
+def _encode_block(tokens: np.ndarray, end: int, fens: List[str], max_seq_length: int):
+    if fens:
+        encode_batch(fens, max_seq_length=max_seq_length, dtype=torch.uint8, out=torch.from_numpy(tokens[end - len(fens):end]))
+        fens.clear()
+
+
+# input: pgn file path, output directory
+# output: number of positions written
+# One-time conversion of a PGN into fixed-width uint8 token shards plus float32 eval shards.
+# Positions and evals are exactly those of ChessPositionDataset.process_positions (dataloader.position_eval).
+def write_position_shards(pgn_file_path: str, out_dir: str, shard_size: int = 1_000_000,
+                          max_seq_length: int = 79, alpha: float = 0.1, encode_block_size: int = 4096) -> int:
+    os.makedirs(out_dir, exist_ok=True)
+
+    tokens = np.zeros((shard_size, max_seq_length), dtype=np.uint8)
+    evals = np.zeros(shard_size, dtype=np.float32)
+    fens = []  # positions in evals but not yet tokenized, which are tokenized a block at a time
+    n, shard_idx, total = 0, 0, 0
+
+    with open(pgn_file_path) as pgn:
+        game = read_mainline(pgn)
+        while game is not None:
+            for fen, turn, is_checkmate, comment in game:
+                eval = position_eval(turn, is_checkmate, comment, alpha)
+                if eval is None:
+                    continue
+                fens.append(fen)
+                evals[n] = eval
+                n += 1
+                if len(fens) == encode_block_size or n == shard_size:
+                    _encode_block(tokens, n, fens, max_seq_length)
+                if n == shard_size:
+                    _flush_shard(out_dir, shard_idx, tokens, evals, n)
+                    total += n
+                    n, shard_idx = 0, shard_idx + 1
+            game = read_mainline(pgn)
+
+    if n > 0:
+        _encode_block(tokens, n, fens, max_seq_length)
+        _flush_shard(out_dir, shard_idx, tokens, evals, n)
+        total += n
+    return total
+
+
+class PositionShardDataset(Dataset):
+    def __init__(self, shard_dir: str):
+        prefixes = sorted(path[:-len(TOKENS_SUFFIX)] for path in glob.glob(os.path.join(shard_dir, 'shard_*' + TOKENS_SUFFIX))
+                          if '.tmp' not in path)
+        if not prefixes:
+            raise FileNotFoundError(f"No position shards found in {shard_dir}")
+
+        self.tokens = [np.load(prefix + TOKENS_SUFFIX, mmap_mode='r') for prefix in prefixes]
+        self.evals = [np.load(prefix + EVALS_SUFFIX, mmap_mode='r') for prefix in prefixes]
+        self.offsets = np.cumsum([0] + [len(evals) for evals in self.evals])
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def __getitem__(self, idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        tokens, evals = self.__getitems__([idx])
+        return tokens[0], evals[0]
+
+    # DataLoader hands the whole list of batch indices to __getitems__, so a batch is
+    # gathered with one fancy-index per shard instead of one python call per position.
+    def __getitems__(self, indices: List[int]) -> Tuple[torch.Tensor, torch.Tensor]:
+        indices = np.sort(np.asarray(indices, dtype=np.int64))
+        shard_ids = np.searchsorted(self.offsets, indices, side='right') - 1
+
+        tokens, evals = [], []
+        for shard_id in np.unique(shard_ids):
+            local = indices[shard_ids == shard_id] - self.offsets[shard_id]
+            tokens.append(self.tokens[shard_id][local])
+            evals.append(self.evals[shard_id][local])
+
+        tokens = np.concatenate(tokens)
+        # shards written before codec.TOKENIZER_VERSION 2 hold the black bishop as token 15, which on the board
+        # cannot be file b
+        board = tokens[:, :BOARD_LENGTH]
+        board[board == FILE_TO_TOKEN['b']] = PIECE_TO_TOKEN['b']
+        return torch.from_numpy(tokens).long(), torch.from_numpy(np.concatenate(evals))
+
+
+def shard_collate_fn(batch: Tuple[torch.Tensor, torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+    return batch
+
+
+# Under distributed training every rank passes its rank and the world size and gets a disjoint
+# DistributedSampler share of the positions; call loader.sampler.set_epoch() before each new epoch.
+def get_shard_dataloader(shard_dir: str, batch_size: int = 32, shuffle: bool = True, num_workers: int = 0,
+                         rank: int = 0, world_size: int = 1, seed: int = 0) -> DataLoader:
+    dataset = PositionShardDataset(shard_dir)
+    sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=shuffle, seed=seed) if world_size > 1 else None
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle and sampler is None, sampler=sampler, num_workers=num_workers,
+                      collate_fn=shard_collate_fn, pin_memory=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a PGN file into memory-mappable position shards.")
+    parser.add_argument('pgn_file_path')
+    parser.add_argument('out_dir')
+    parser.add_argument('--shard-size', type=int, default=1_000_000)
+    parser.add_argument('--alpha', type=float, default=0.1)
+    args = parser.parse_args()
+
+    with open('model_config.yaml', 'r') as f:
+        config = yaml.safe_load(f)
+
+    total = write_position_shards(args.pgn_file_path, args.out_dir, shard_size=args.shard_size,
+                                  max_seq_length=config['max_seq_length'], alpha=args.alpha)
+    print(f"Wrote {total} positions to {args.out_dir}")
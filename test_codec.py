@@ -0,0 +1,103 @@
+from collections import Counter
+
+import chess
+import pytest
+import torch
+
+from codec import (BOARD_LENGTH, FILE_TO_TOKEN, MAX_FEN_LENGTH, PIECE_TO_TOKEN, board_to_tokens, convert_torch_to_fen,
+                   decode, decode_batch, decode_fen, encode, encode_batch, encode_fen_buffer, is_normalized_fen,
+                   normalize_fen, pack_fens, random_boards, random_playout_boards, unpack_fens, unpack_tokens)
+from model import Model, upgrade_state_dict
+from position import TokenPosition
+
+# Property checks of the codec over random legal positions (run with pytest); bench_codec.py times it.
+
+
+@pytest.fixture(scope='module')
+def boards():
+    return random_playout_boards(2000)
+
+@pytest.fixture(scope='module')
+def fens(boards):
+    return [normalize_fen(board) for board in boards]
+
+# tokens of a position built from python-chess directly, without going through a FEN string
+def expected_tokens(board):
+    flip = board.turn == chess.BLACK
+    tokens = []
+    for rank in range(7, -1, -1):
+        for file in range(8):
+            piece = board.piece_at(chess.square(file, rank))
+            symbol = '.' if piece is None else piece.symbol().swapcase() if flip else piece.symbol()
+            tokens.append(PIECE_TO_TOKEN[symbol])
+        tokens.append(PIECE_TO_TOKEN['/' if rank else ' '])
+    castling = board.castling_xfen()
+    tokens += [PIECE_TO_TOKEN[char] for char in (castling.swapcase() if flip else castling)]
+    tokens.append(PIECE_TO_TOKEN[' '])
+    if board.ep_square is not None and board.has_legal_en_passant():
+        tokens += [FILE_TO_TOKEN[chess.FILE_NAMES[chess.square_file(board.ep_square)]], PIECE_TO_TOKEN['6']]
+    else:
+        tokens.append(PIECE_TO_TOKEN['-'])
+    return tokens
+
+def test_legal_positions(boards, fens):
+    batch = encode_batch(fens)
+    fixed = encode_batch(fens, max_seq_length=MAX_FEN_LENGTH)
+    for board, fen, row, fixed_row in zip(boards, fens, batch.tolist(), fixed.tolist()):
+        tokens = expected_tokens(board)
+        assert encode(fen) == tokens, fen
+        assert row[:len(tokens)] == tokens and not any(row[len(tokens):]), fen
+        assert fixed_row[:len(tokens)] == tokens and not any(fixed_row[len(tokens):]), fen
+        assert TokenPosition(board).tokens().tolist() == fixed_row, fen
+        assert decode_fen(row) == fen
+        assert decode(row).split(' ')[1:] == fen.split(' ')[1:]
+        assert is_normalized_fen(fen), fen
+
+def test_bishop_and_file_b_tokens(fens):
+    fixed = encode_batch(fens, max_seq_length=MAX_FEN_LENGTH)
+    assert not (fixed[:, :BOARD_LENGTH] == FILE_TO_TOKEN['b']).any()
+    assert not (fixed[:, BOARD_LENGTH:] == PIECE_TO_TOKEN['b']).any()
+    assert int(fixed.max()) < len(set(PIECE_TO_TOKEN.values()) | set(FILE_TO_TOKEN.values()))
+
+def test_batch_round_trips(fens):
+    batch = encode_batch(fens)
+    assert decode_batch(batch) == fens
+    assert decode_batch(encode_batch(fens, max_seq_length=MAX_FEN_LENGTH)) == fens
+    assert torch.equal(encode_fen_buffer('\n'.join(fens).encode('ascii')), batch)
+    packed = pack_fens(fens)
+    assert unpack_fens(packed) == fens
+    assert torch.equal(unpack_tokens(packed), batch)
+
+@pytest.mark.parametrize('fen', [chess.Board().fen(), 'abc', 'k', '', '9/8/8/8/8/8/8/8 - -',
+                                 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR KKQq -',
+                                 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR KQkq e3',
+                                 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR  KQkq -'])
+def test_not_normalized(fen):
+    assert not is_normalized_fen(fen)
+
+# 8x8 code boards: board_to_tokens agrees with the FEN path, and mirroring the ranks swaps the castling letters
+def test_code_boards():
+    boards = random_boards(2000)
+    fens = [convert_torch_to_fen(board) for board in boards]
+    assert torch.equal(board_to_tokens(boards), encode_batch(fens))
+    # code boards need not be legal positions: eight castling letters, a space and an en passant square at most
+    width = BOARD_LENGTH + 11
+    assert torch.equal(board_to_tokens(boards, width), encode_batch(fens, max_seq_length=width))
+    for board, fen in zip(boards, fens):
+        castling = fen.split(' ')[1].replace('-', '')
+        mirrored = convert_torch_to_fen(board.flip(0)).split(' ')[1].replace('-', '')
+        assert Counter(mirrored) == Counter(castling.swapcase()), (castling, mirrored)
+
+# a checkpoint trained before the fix, where the black bishop was token 15 like file b, gives the same
+# values after upgrade_state_dict on the new tokens as it did on the old ones
+@torch.no_grad()
+def test_legacy_checkpoint(fens):
+    torch.manual_seed(0)
+    model = Model(num_layers=1, max_seq_length=MAX_FEN_LENGTH, test_mode=False).eval()
+    new_tokens = encode_batch(fens[:256], max_seq_length=MAX_FEN_LENGTH)
+    old_tokens = new_tokens.clone()
+    old_tokens[old_tokens == PIECE_TO_TOKEN['b']] = FILE_TO_TOKEN['b']
+    old_values = model.forward_tokens(old_tokens)
+
+    model.load_state_dict(upgrade_state_dict({'model': model.state_dict()}))
+    assert torch.allclose(model.forward_tokens(new_tokens), old_values, atol=1e-6)
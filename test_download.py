@@ -0,0 +1,242 @@
+import contextlib
+import functools
+import http.server
+import json
+import math
+import os
+import random
+import re
+import threading
+
+import chess
+import chess.pgn
+import pytest
+import zstandard
+
+import download_games
+from download_games import (LICHESS_URL, MANIFEST_NAME, archive_lines, ingest_lichess_pgns, ingest_month,
+                            process_lichess_pgns, split_games, stream_games)
+
+# The download pipeline against archives served from a local HTTP server (run with pytest); bench_download.py times it.
+
+MONTHS = ['2013-01', '2013-02']
+
+
+# input: random generator, whether the moves carry [%eval] comments, game number
+# output: one game as Lichess writes it, headers then the movetext on a single line
+def random_game(rng, with_eval, number):
+    game = chess.pgn.Game()
+    game.headers['Event'] = f'Rated Blitz game {number}'
+    game.headers['Site'] = f'https://lichess.org/{number:08d}'
+    node, board = game, chess.Board()
+    for _ in range(rng.randint(1, 60)):
+        moves = list(board.legal_moves)
+        if not moves:
+            break
+        move = rng.choice(moves)
+        board.push(move)
+        node = node.add_variation(move)
+        node.comment = (f'[%eval {rng.uniform(-3, 3):.2f}] ' if with_eval else '') + '[%clk 0:03:00]'
+    game.headers['Result'] = board.result(claim_draw=True)
+    return game.accept(chess.pgn.StringExporter(columns=None)).rstrip('\n') + '\n\n'
+
+# input: months, games per month, fraction of games with evals
+# output: month -> [(game text, has_eval)]
+def random_months(months, games_per_month, eval_fraction=0.3, seed=0):
+    rng = random.Random(seed)
+    return {month: [(random_game(rng, has_eval, number), has_eval) for number, has_eval in
+                    enumerate(rng.random() < eval_fraction for _ in range(games_per_month))] for month in months}
+
+def archive_path(directory, month):
+    return os.path.join(directory, os.path.basename(LICHESS_URL.format(month)))
+
+# every `frame_games` games go into their own zstd frame, so resume points fall inside the archive
+def write_archives(directory, month_games, frame_games=20):
+    compressor = zstandard.ZstdCompressor(level=3)
+    for month, games in month_games.items():
+        with open(archive_path(directory, month), 'wb') as f:
+            for i in range(0, len(games), frame_games):
+                f.write(compressor.compress(''.join(game for game, _ in games[i:i + frame_games]).encode('utf-8')))
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+# answers Range requests with a 206 from `shift` bytes before the requested start, which is honest when shift is 0,
+# drops the connection after `limit` bytes of the body, and records the start of every request in `starts`
+class RangeHandler(QuietHandler):
+    shift, limit, starts = 0, None, None
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return super().do_GET()
+        match = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        with open(path, 'rb') as f:
+            data = f.read()
+        start = max(int(match.group(1)) - self.shift, 0) if match else 0
+        if self.starts is not None:
+            self.starts.append(start)
+        if start >= len(data):
+            return self.send_error(416)
+        self.send_response(206 if match else 200)
+        if match:
+            self.send_header('Content-Range', f'bytes {start}-{len(data) - 1}/{len(data)}')
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:] if self.limit is None else data[start:start + self.limit])
+
+# input: directory, request handler class, attributes to set on it
+# output: base URL of an HTTP server on localhost serving the directory, for as long as the context is open
+@contextlib.contextmanager
+def serve_directory(directory, handler=QuietHandler, **attributes):
+    handler = type(handler.__name__, (handler,), attributes)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(handler, directory=directory))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}/' + os.path.basename(LICHESS_URL)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def read_text(path):
+    with open(path) as f:
+        return f.read()
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def kept_games(games):
+    return [game for game, has_eval in games if has_eval]
+
+def next_free_month(months):
+    year, month = map(int, months[-1].split('-'))
+    return f'{year + month // 12}-{month % 12 + 1:02d}'
+
+
+@pytest.fixture(scope='module')
+def month_games():
+    return random_months(MONTHS, 150)
+
+@pytest.fixture(scope='module')
+def archive_dir(tmp_path_factory, month_games):
+    directory = str(tmp_path_factory.mktemp('archives'))
+    write_archives(directory, month_games)
+    return directory
+
+@pytest.fixture(scope='module')
+def base_url(archive_dir):
+    with serve_directory(archive_dir) as base_url:
+        yield base_url
+
+@pytest.fixture(autouse=True)
+def no_retry_wait(monkeypatch):
+    monkeypatch.setattr(download_games.time, 'sleep', lambda seconds: None)
+
+
+# the stream holds every game with its eval flag
+def test_stream_games(month_games, base_url):
+    for month, games in month_games.items():
+        assert list(stream_games(base_url.format(month))) == games, month
+        assert list(split_games(''.join(game for game, _ in games).splitlines(keepends=True))) == games, month
+
+# a stream restarted at any resume point with the game in progress there gives the rest of the archive
+def test_archive_lines_resume_points(month_games, archive_dir):
+    archive = read_bytes(archive_path(archive_dir, MONTHS[0]))
+    text = ''.join(game for game, _ in month_games[MONTHS[0]])
+    resume_points = []
+    assert ''.join(archive_lines([archive], checkpoint=lambda *point: resume_points.append(point))) == text
+    # one per frame, the last at the end of the archive with the last game still in progress
+    assert len(resume_points) == math.ceil(len(month_games[MONTHS[0]]) / 20)
+    for offset, carry in resume_points:
+        rest = ''.join(archive_lines([archive[offset:]], offset, carry))
+        assert rest and text.endswith(rest) and rest.startswith('[Event '), offset
+    with pytest.raises(EOFError):
+        list(archive_lines([archive[:-10]]))
+
+# only the games with evals are written, per month or into one file
+def test_process_lichess_pgns(month_games, base_url, tmp_path):
+    missing = next_free_month(MONTHS)
+    process_lichess_pgns(MONTHS[0], str(tmp_path), game_limit=10 ** 9, base_url=base_url, end_date=missing)
+    for month, games in month_games.items():
+        assert read_text(tmp_path / f'lichess_{month}.pgn') == ''.join(kept_games(games)), month
+    # a month the server does not have yields no games
+    assert read_text(tmp_path / f'lichess_{missing}.pgn') == ''
+
+# one output file: months are appended in order, and the run stops at the game limit in the middle of a month
+def test_process_single_output(month_games, base_url, tmp_path):
+    kept = [game for month in MONTHS for game in kept_games(month_games[month])]
+    limit = len(kept) - len(kept_games(month_games[MONTHS[-1]])) // 2
+    single_output = str(tmp_path / 'single.pgn')
+    process_lichess_pgns(MONTHS[0], None, game_limit=limit, single_output=single_output, base_url=base_url,
+                         end_date=next_free_month(MONTHS))
+    assert read_text(single_output) == ''.join(kept[:limit])
+
+def test_ingest_month(month_games, archive_dir, base_url, tmp_path):
+    games = month_games[MONTHS[0]]
+    assert ingest_month(MONTHS[0], str(tmp_path), base_url) == (MONTHS[0], len(kept_games(games)), os.path.getsize(tmp_path / f'lichess_{MONTHS[0]}.pgn'))
+    assert read_text(tmp_path / f'lichess_{MONTHS[0]}.pgn') == ''.join(kept_games(games))
+    assert sorted(os.listdir(tmp_path)) == [f'lichess_{MONTHS[0]}.pgn']
+
+    assert ingest_month(MONTHS[0], str(tmp_path), base_url, month_game_limit=5)[1] == 5
+    assert read_text(tmp_path / f'lichess_{MONTHS[0]}.pgn') == ''.join(kept_games(games)[:5])
+
+    assert ingest_month(MONTHS[0], str(tmp_path), base_url, keep_compressed=True)[1] == len(kept_games(games))
+    assert read_bytes(tmp_path / f'lichess_{MONTHS[0]}.pgn.zst') == read_bytes(archive_path(archive_dir, MONTHS[0]))
+
+    assert ingest_month(next_free_month(MONTHS), str(tmp_path), base_url) is None
+
+# a connection that keeps dropping still gets through, each request starting from the last resume point
+def test_ingest_month_dropped_connections(month_games, archive_dir, tmp_path):
+    starts = []
+    with serve_directory(archive_dir, RangeHandler, limit=12000, starts=starts) as base_url:
+        result = ingest_month(MONTHS[0], str(tmp_path), base_url, keep_compressed=True, max_retries=100, chunk_size=512)
+    assert result[1] == len(kept_games(month_games[MONTHS[0]]))
+    assert read_text(tmp_path / f'lichess_{MONTHS[0]}.pgn') == ''.join(kept_games(month_games[MONTHS[0]]))
+    assert read_bytes(tmp_path / f'lichess_{MONTHS[0]}.pgn.zst') == read_bytes(archive_path(archive_dir, MONTHS[0]))
+    assert len(starts) > 2 and starts == sorted(starts) and starts[0] == 0
+
+# a run that gave up resumes from its resume point with a Range request, or starts over if the server sends the wrong range
+@pytest.mark.parametrize('shift', [0, 100])
+def test_ingest_month_range_resume(month_games, archive_dir, tmp_path, shift):
+    with serve_directory(archive_dir, RangeHandler, limit=12000) as base_url:
+        assert ingest_month(MONTHS[0], str(tmp_path), base_url, max_retries=1, chunk_size=512) is None
+    with open(tmp_path / f'lichess_{MONTHS[0]}.pgn.resume') as f:
+        offset = json.load(f)['offset']
+    assert offset > 0
+
+    starts = []
+    with serve_directory(archive_dir, RangeHandler, shift=shift, starts=starts) as base_url:
+        assert ingest_month(MONTHS[0], str(tmp_path), base_url)[1] == len(kept_games(month_games[MONTHS[0]]))
+    assert read_text(tmp_path / f'lichess_{MONTHS[0]}.pgn') == ''.join(kept_games(month_games[MONTHS[0]]))
+    assert starts == ([offset] if shift == 0 else [offset - shift, 0])
+    assert sorted(os.listdir(tmp_path)) == [f'lichess_{MONTHS[0]}.pgn']
+
+# a month whose archive is corrupt is logged and left out of the manifest while the others go through into single_output
+def test_ingest_skips_corrupt_month(month_games, archive_dir, tmp_path):
+    corrupt = next_free_month(MONTHS)
+    with open(archive_path(tmp_path, corrupt), 'wb') as f:
+        f.write(b'not a zstd frame' * 100)
+    for month in MONTHS:
+        os.symlink(archive_path(archive_dir, month), archive_path(tmp_path, month))
+
+    out_dir = str(tmp_path / 'ingest')
+    single_output = str(tmp_path / 'corpus.pgn')
+    with serve_directory(str(tmp_path)) as base_url:
+        failed = ingest_lichess_pgns(MONTHS[0], out_dir, end_date=corrupt, workers=2, single_output=single_output,
+                                     base_url=base_url)
+    assert failed == [corrupt]
+    with open(os.path.join(out_dir, MANIFEST_NAME)) as f:
+        assert sorted(json.load(f)['months']) == MONTHS
+    assert read_text(single_output) == ''.join(game for month in MONTHS for game in kept_games(month_games[month]))
+
+# an existing output file the manifest does not know about is refused instead of truncated
+def test_ingest_refuses_unknown_single_output(month_games, base_url, tmp_path):
+    existing = tmp_path / 'existing.pgn'
+    existing.write_text(month_games[MONTHS[0]][0][0])
+    with pytest.raises(FileExistsError):
+        ingest_lichess_pgns(MONTHS[0], str(tmp_path / 'ingest'), end_date=MONTHS[-1], single_output=str(existing),
+                            base_url=base_url)
+    assert existing.read_text() == month_games[MONTHS[0]][0][0]
@@ -0,0 +1,91 @@
+import random
+
+import chess
+import numpy as np
+import pytest
+
+from codec import MAX_FEN_LENGTH, encode_batch, normalize_fen
+from position import TokenPosition
+
+# TokenPosition against the FEN path, normalize_fen then encode_batch (run with pytest); bench_search.py times it.
+
+
+def fen_tokens(boards, max_seq_length=MAX_FEN_LENGTH):
+    return encode_batch([normalize_fen(board) for board in boards], max_seq_length=max_seq_length).numpy()
+
+# input: number of playouts, seed
+# output: the random moves of each playout
+def random_playouts(n, seed=0):
+    rng = random.Random(seed)
+    playouts = []
+    for _ in range(n):
+        board, moves = chess.Board(), []
+        for _ in range(rng.randint(0, 150)):
+            legal = list(board.legal_moves)
+            if not legal:
+                break
+            # prefer the moves that change more than two squares, so every playout has some
+            special = [move for move in legal if board.is_castling(move) or board.is_en_passant(move) or move.promotion]
+            move = rng.choice(special if special and rng.random() < 0.5 else legal)
+            board.push(move)
+            moves.append(move)
+        playouts.append(moves)
+    return playouts
+
+@pytest.fixture(scope='module')
+def playouts():
+    return random_playouts(100)
+
+
+# the tokens follow every push and every pop, including castling, en passant and promotions
+def test_push_pop(playouts):
+    kinds = set()
+    for moves in playouts:
+        board = chess.Board()
+        position = TokenPosition(board)
+        expected = [fen_tokens([board])[0]]
+        for move in moves:
+            kinds.update(kind for kind, special in (('castling', board.is_castling(move)), ('en passant', board.is_en_passant(move)),
+                                                     ('promotion', move.promotion)) if special)
+            position.push(move)
+            expected.append(fen_tokens([board])[0])
+            assert np.array_equal(position.tokens(), expected[-1]), board.fen()
+        for tokens in reversed(expected[:-1]):
+            position.pop()
+            assert np.array_equal(position.tokens(), tokens), board.fen()
+        assert board == chess.Board()
+    assert kinds == {'castling', 'en passant', 'promotion'}
+
+# the children of every position on the way, at the default width and at a wider model input
+@pytest.mark.parametrize('max_seq_length', [MAX_FEN_LENGTH, MAX_FEN_LENGTH + 8])
+def test_child_tokens(playouts, max_seq_length):
+    for moves in playouts[:20]:
+        board = chess.Board()
+        position = TokenPosition(board, max_seq_length=max_seq_length)
+        for move in moves:
+            position.push(move)
+            fen, legal = board.fen(), list(board.legal_moves)
+            children = []
+            for child in legal:
+                board.push(child)
+                children.append(board.copy(stack=False))
+                board.pop()
+            if legal:
+                assert np.array_equal(position.child_tokens(legal), fen_tokens(children, max_seq_length)), fen
+            # child_tokens leaves the position where it was
+            assert board.fen() == fen
+            assert np.array_equal(position.tokens(), fen_tokens([board], max_seq_length)[0]), fen
+
+# a TokenPosition built in the middle of a game starts from that position, and fen() reads back normalize_fen
+def test_from_position(playouts):
+    for moves in playouts[:20]:
+        board = chess.Board()
+        for move in moves:
+            board.push(move)
+        position = TokenPosition(board)
+        assert np.array_equal(position.tokens(), fen_tokens([board])[0])
+        assert position.fen() == normalize_fen(board)
+
+def test_chess960():
+    with pytest.raises(ValueError):
+        TokenPosition(chess.Board(chess960=True))
@@ -0,0 +1,87 @@
+import random
+import re
+
+import numpy as np
+import pytest
+import torch
+
+from codec import decode_batch
+from dataloader import position_eval, read_mainline
+from preprocessing import ALPHA, iter_pgn_to_fen, iter_position_shards, preprocess
+from test_download import random_game
+
+# The parallel PGN conversion against the serial reading of the file (run with pytest); bench_preprocess.py times it.
+
+NUM_GAMES = 120
+# every UNTAGGED-th game loses its [Event tag
+UNTAGGED = 10
+
+
+def write_pgn(path, games):
+    with open(path, 'w') as f:
+        f.write(''.join(games))
+    return str(path)
+
+# input: PGN path, which games have an [Event tag
+# output: (FEN, eval, game id, ply) of every position with an eval, reading the games one at a time; a game
+# without an [Event tag has the id of the game before it
+def expected_positions(pgn_file_path, tagged):
+    output, game_id = [], -1
+    with open(pgn_file_path) as pgn:
+        for has_tag in tagged:
+            game_id += has_tag
+            positions = read_mainline(pgn)
+            for ply, (fen, turn, is_checkmate, comment) in enumerate(positions, 1):
+                eval = position_eval(turn, is_checkmate, comment, ALPHA)
+                if eval is not None:
+                    output.append((fen, eval, game_id, ply))
+        assert read_mainline(pgn) is None
+    return output
+
+def read_columns(out_dir):
+    shards = list(iter_position_shards(out_dir))
+    columns = {key: np.concatenate([shard[key] for shard in shards]) for key in ('tokens', 'eval', 'game_id', 'ply')}
+    columns['fen'] = decode_batch(torch.from_numpy(columns['tokens']))
+    return columns
+
+def check_columns(columns, expected):
+    fens, evals, game_ids, plies = zip(*expected)
+    assert columns['fen'] == list(fens)
+    assert np.array_equal(columns['eval'], np.array(evals, dtype=np.float32))
+    assert np.array_equal(columns['game_id'], np.array(game_ids))
+    assert np.array_equal(columns['ply'], np.array(plies))
+
+@pytest.fixture(scope='module')
+def games():
+    # the corpus holds only games with evals, as download_games writes it
+    rng = random.Random(0)
+    return [random_game(rng, True, number) for number in range(NUM_GAMES)]
+
+@pytest.fixture(scope='module')
+def pgn_path(tmp_path_factory, games):
+    return write_pgn(tmp_path_factory.mktemp('pgn') / 'games.pgn', games)
+
+
+# the shards hold the positions of iter_pgn_to_fen in file order, with the right game ids and plies, for any split into shards
+@pytest.mark.parametrize('workers, games_per_shard', [(0, 1000), (0, 7), (2, 7), (2, 40)])
+def test_shards(pgn_path, tmp_path, workers, games_per_shard):
+    summary = preprocess([pgn_path], str(tmp_path), workers=workers, games_per_shard=games_per_shard, verbose=False)
+    expected = expected_positions(pgn_path, [True] * NUM_GAMES)
+    assert summary['games'] == NUM_GAMES and summary['positions'] == len(expected) and summary['unindexed_games'] == 0
+    assert len(np.load(tmp_path / 'games.npy')) == NUM_GAMES
+    columns = read_columns(str(tmp_path))
+    check_columns(columns, expected)
+    assert columns['fen'] == [fen for fen, _ in iter_pgn_to_fen(pgn_path)]
+
+# games whose [Event tag is missing are read exactly once, with the game before them, instead of being dropped
+@pytest.mark.parametrize('workers', [0, 2])
+def test_untagged_games(games, tmp_path, workers):
+    tagged = [i % UNTAGGED != UNTAGGED - 1 for i in range(NUM_GAMES)]
+    untagged = [game if has_tag else re.sub(r'(?m)^\[Event [^\n]*\n', '', game, count=1) for game, has_tag in zip(games, tagged)]
+    path = write_pgn(tmp_path / 'untagged.pgn', untagged)
+    summary = preprocess([path], str(tmp_path / 'out'), workers=workers, games_per_shard=9, verbose=False)
+    expected = expected_positions(path, tagged)
+    assert summary['unindexed_games'] == NUM_GAMES // UNTAGGED
+    assert summary['games'] == sum(tagged) and summary['positions'] == len(expected)
+    check_columns(read_columns(str(tmp_path / 'out')), expected)
+    assert [fen for fen, *_ in expected] == [fen for fen, _ in iter_pgn_to_fen(path)]
@@ -0,0 +1,105 @@
+import asyncio
+import os
+import socket
+
+import chess
+import pytest
+
+from codec import random_fens
+from fen import MAX_FEN_LENGTH
+from server import EvalClient, EvalServer
+
+# The batching server against an evaluator that needs no checkpoint (run with pytest); bench_server.py times it.
+
+
+# a stand-in for search.ModelEvaluator whose value is a function of the FEN, and which fails every batch
+# holding a poisoned FEN, as a request that gets past the checks in EvalServer.handle would
+class FakeEvaluator:
+    token_width = MAX_FEN_LENGTH
+
+    def __init__(self, poisoned=()):
+        self.poisoned = set(poisoned)
+        self.batch_sizes = []
+
+    def evaluate_fens(self, fens):
+        self.batch_sizes.append(len(fens))
+        if self.poisoned.intersection(fens):
+            raise ValueError('poisoned')
+        return [value(fen) for fen in fens]
+
+def value(fen):
+    return len(fen) / 100
+
+# input: socket path, request lines
+# output: the server's answer lines, with every request sent before the first answer is read
+def raw_answers(path, lines):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(''.join(line + '\n' for line in lines).encode())
+        with sock.makefile('rb') as reader:
+            return [reader.readline().decode().strip() for _ in lines]
+
+# input: server, socket path, function of the socket path run on a client thread
+# output: what the function returns, after the server shut down as it does on SIGTERM
+def run_with_server(server, path, client):
+    async def scenario():
+        serving = asyncio.create_task(server.serve(path))
+        while not os.path.exists(path):
+            await asyncio.sleep(0.01)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, client, path)
+        finally:
+            server.stopping.set()
+            await serving
+    return asyncio.run(scenario())
+
+@pytest.fixture
+def socket_path(tmp_path):
+    return str(tmp_path / 'eval.sock')
+
+
+# a batch that fails is evaluated again one request at a time, so only the poisoned request fails
+def test_evaluate_batch_isolation():
+    fens = random_fens(8, seed=11)
+    evaluator = FakeEvaluator(poisoned=[fens[3]])
+    results = EvalServer(evaluator).evaluate_batch(fens)
+    assert isinstance(results[3], ValueError)
+    assert results[:3] + results[4:] == [value(fen) for fen in fens[:3] + fens[4:]]
+    assert evaluator.batch_sizes == [8] + [1] * 8
+
+    assert EvalServer(FakeEvaluator()).evaluate_batch(fens) == [value(fen) for fen in fens]
+
+# malformed requests pipelined between valid ones get ERR, and the valid ones around them still get their values
+def test_bad_requests(socket_path):
+    fens = random_fens(4, seed=7)
+    bad = [chess.Board().fen(), 'abc', 'k', '9/8/8/8/8/8/8/8 - -']
+    lines = [line for pair in zip(fens, bad) for line in pair]
+    answers = run_with_server(EvalServer(FakeEvaluator(), max_wait=0.05), socket_path, lambda path: raw_answers(path, lines))
+    assert all(answer.startswith('ERR') for answer in answers[1::2]), answers
+    assert [float(answer) for answer in answers[::2]] == pytest.approx([value(fen) for fen in fens], abs=1e-6)
+
+# a poisoned request fails alone while the requests batched with it get their values
+def test_batch_isolation(socket_path):
+    fens = random_fens(16, seed=11)
+    evaluator = FakeEvaluator(poisoned=[fens[5]])
+    answers = run_with_server(EvalServer(evaluator, max_wait=0.05), socket_path, lambda path: raw_answers(path, fens))
+    assert answers[5] == 'ERR poisoned'
+    assert [float(answer) for answer in answers[:5] + answers[6:]] == pytest.approx([value(fen) for fen in fens[:5] + fens[6:]], abs=1e-6)
+    assert max(evaluator.batch_sizes) > 1
+
+def test_client(socket_path):
+    fens = random_fens(32, seed=3)
+
+    def client(path):
+        client = EvalClient(path)
+        try:
+            values = client.evaluate_fens(fens)
+            with pytest.raises(ValueError):
+                client.evaluate_fens(['abc'])
+            return values, client.stats()
+        finally:
+            client.close()
+
+    values, stats = run_with_server(EvalServer(FakeEvaluator()), socket_path, client)
+    assert values == pytest.approx([value(fen) for fen in fens], abs=1e-6)
+    assert stats['requests'] == len(fens)
@@ -1,42 +1,125 @@
-# imports
-import torch
-import yaml
-import time
-from model import Model
-from utils.chess_gameplay import Agent, play_game
-
-checkpoints = [0, 1000, 2000, 4000, 8000]
-points = [0 for _ in range(len(checkpoints))]
-total_points = [0 for _ in range(len(checkpoints))]
-model_config = yaml.safe_load(open("model_config.yaml"))
-models = []
-for ckpt in checkpoints:
-    model = Model(**model_config)
-    checkpoint = torch.load(f"out/checkpoint_{ckpt}.pt", map_location=torch.device('cpu'))
-    model.load_state_dict(checkpoint["model"])
-    models.append(model)
-
-while True:
-    for model_0_idx in range(len(checkpoints)):
-        for model_1_idx in range(len(checkpoints)):
-            if model_0_idx != model_1_idx:
-                agent0, agent1 = Agent(models[model_0_idx]), Agent(models[model_1_idx])
-                gameplay_kwargs = {
-                    "table": 1,
-                    "agents": {'white': agent0, 'black': agent1},
-                    "max_moves": 50,
-                    "min_seconds_per_move": 0.0,
-                    "verbose": True,
-                    "poseval": True
-                }
-                print(f'White: ckpt-{checkpoints[model_0_idx]}')
-                print(f'Black: ckpt-{checkpoints[model_1_idx]}')
-                game_result = play_game(**gameplay_kwargs)
-                points[model_0_idx] += (game_result['white']['points'] + 1)/2
-                points[model_1_idx] += (game_result['black']['points'] + 1)/2
-                total_points[model_0_idx] += 1
-                total_points[model_1_idx] += 1
-
-                print('Tournament Scoreboard')
-                for ckpt, point, num_games in zip(checkpoints, points, total_points):
-                    print(f'checkpoint_{ckpt}.pt: {round(point, 2)}/{num_games}')
+import argparse
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from typing import List, Tuple
+
+# (white checkpoint index, black checkpoint index, white score in [0, 1])
+GameRecord = Tuple[int, int, float]
+
+GAMEPLAY_KWARGS = {
+    "table": 1,
+    "max_moves": 50,
+    "min_seconds_per_move": 0.0,
+    "verbose": False,
+    "poseval": True
+}
+
+# models are loaded the first time a worker process needs them and then reused for every game it plays;
+# the parent process only schedules games and fits ratings, so it never imports torch
+_models = {}
+
+def get_model(checkpoint_path: str):
+    if checkpoint_path not in _models:
+        from model import load_model
+        _models[checkpoint_path] = load_model(checkpoint_path, device="cpu")
+    return _models[checkpoint_path]
+
+def init_worker(threads: int):
+    import torch
+    torch.set_num_threads(threads)
+
+def play_pairing(white: int, black: int, white_path: str, black_path: str) -> GameRecord:
+    from utils.chess_gameplay import Agent, play_game
+
+    agents = {'white': Agent(get_model(white_path)), 'black': Agent(get_model(black_path))}
+    game_result = play_game(agents=agents, **GAMEPLAY_KWARGS)
+    return white, black, (game_result['white']['points'] + 1) / 2
+
+# input: games, number of players
+# output: Elo ratings with player 0 anchored at 0
+# Bradley-Terry maximum likelihood via minorization-maximization, draws counted as half a win.
+# Every pair also gets one virtual draw so a player who won or lost everything keeps a finite rating.
+def fit_elo(games: List[GameRecord], num_players: int, iterations: int = 200) -> np.ndarray:
+    played = np.ones((num_players, num_players)) - np.eye(num_players)
+    scores = np.full(num_players, 0.5 * (num_players - 1))
+    for white, black, white_score in games:
+        played[white, black] += 1
+        played[black, white] += 1
+        scores[white] += white_score
+        scores[black] += 1 - white_score
+
+    strength = np.ones(num_players)
+    for _ in range(iterations):
+        strength = scores / (played / (strength[:, None] + strength[None, :])).sum(axis=1)
+        strength /= strength[0]
+    return 400 * np.log10(strength)
+
+# 95% bootstrap interval of each rating, resampling whole games
+def elo_intervals(games: List[GameRecord], num_players: int, samples: int = 200, seed: int = 0) -> np.ndarray:
+    rng = random.Random(seed)
+    ratings = np.array([fit_elo(rng.choices(games, k=len(games)), num_players) for _ in range(samples)])
+    return np.percentile(ratings, [2.5, 97.5], axis=0).T
+
+def print_scoreboard(checkpoints: List[int], games: List[GameRecord]):
+    num_players = len(checkpoints)
+    ratings = fit_elo(games, num_players)
+    intervals = elo_intervals(games, num_players)
+    points, played = np.zeros(num_players), np.zeros(num_players)
+    for white, black, white_score in games:
+        points[white] += white_score
+        points[black] += 1 - white_score
+        played[white] += 1
+        played[black] += 1
+
+    print('Tournament Scoreboard')
+    for idx in np.argsort(-ratings):
+        low, high = intervals[idx]
+        print(f'checkpoint_{checkpoints[idx]}.pt: Elo {ratings[idx]:+7.1f} [{low:+7.1f}, {high:+7.1f}]  {round(points[idx], 2)}/{int(played[idx])}')
+    return ratings, intervals
+
+# Round robin where every round plays each ordered pairing once (both colors), spread over worker
+# processes. Stops after max_rounds, or once every rating's 95% interval is at most
+# +/- target_error Elo (the anchor, checkpoint 0, is fixed at 0 and excluded).
+def run_tournament(checkpoints: List[int], out_dir: str = 'out', max_rounds: int = 10, target_error: float = 50.0,
+                   min_rounds: int = 2, workers: int = None, threads: int = 1) -> List[GameRecord]:
+    paths = [os.path.join(out_dir, f'checkpoint_{ckpt}.pt') for ckpt in checkpoints]
+    pairings = [(white, black) for white in range(len(checkpoints)) for black in range(len(checkpoints)) if white != black]
+    workers = workers or os.cpu_count()
+    games = []
+
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(threads,)) as executor:
+        for round_num in range(1, max_rounds + 1):
+            futures = [executor.submit(play_pairing, white, black, paths[white], paths[black]) for white, black in pairings]
+            for future in as_completed(futures):
+                white, black, white_score = future.result()
+                games.append((white, black, white_score))
+                print(f'round {round_num}: ckpt-{checkpoints[white]} (white) vs ckpt-{checkpoints[black]} (black): {white_score}')
+
+            ratings, intervals = print_scoreboard(checkpoints, games)
+            error = max((high - low) / 2 for low, high in intervals[1:]) if len(checkpoints) > 1 else 0.0
+            print(f'round {round_num}: {len(games)} games, largest Elo error +/- {error:.1f}')
+            if round_num >= min_rounds and error <= target_error:
+                break
+    return games
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Parallel round-robin tournament between training checkpoints.")
+    parser.add_argument('--checkpoints', type=int, nargs='+', default=[0, 1000, 2000, 4000, 8000])
+    parser.add_argument('--out-dir', default='out')
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--target-error', type=float, default=50.0, help='stop once every 95%% interval is within +/- this many Elo')
+    parser.add_argument('--min-rounds', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--threads', type=int, default=1, help='torch threads per worker process')
+    args = parser.parse_args(argv)
+
+    return run_tournament(args.checkpoints, out_dir=args.out_dir, max_rounds=args.rounds, target_error=args.target_error,
+                          min_rounds=args.min_rounds, workers=args.workers, threads=args.threads)
+
+
+if __name__ == "__main__":
+    main()
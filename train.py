@@ -1,99 +1,275 @@
 import os
 import time
 import math
+from contextlib import nullcontext
 import torch
 import torch.nn as nn
+import torch.distributed as dist
 import yaml
 
 from torch.nn import functional as F
+from torch.nn.parallel import DistributedDataParallel as DDP
 
-from model import *
-from dataloader import get_chess_position_dataloader, PIECE_TO_TOKEN
+from codec import TOKENIZER_VERSION
+from model import Model, upgrade_state_dict
+from dataloader import get_chess_position_dataloader
+from shards import get_shard_dataloader
+from dedup import get_dedup_dataloader
+from checkpoint import AsyncCheckpointer, latest_checkpoint
+from metrics import MetricsLogger, PhaseTimer, peak_memory_mb, queue_depth
 
 with open('model_config.yaml', 'r') as f:
     config = yaml.safe_load(f)
 
 out_dir = 'out'
-log_interval = 1
+log_interval = 100 # the only host-device sync in the loop is the loss readout every log_interval iterations
 save_interval = 1000
+keep_last = 5 # checkpoints older than the newest keep_last are deleted, except every keep_every iterations
+keep_every = 10000
+resume = True # continue from the newest checkpoint in out_dir: model, optimizer, iter_num and position in the data
 learning_rate = 1e-5
 max_iters = float('inf')
 weight_decay=0.0
 beta1 = 0.9
 beta2 = 0.95
 grad_clip = 1.0
-batch_size = 1024
-device = 'cuda' 
-dtype = 'float32'
+batch_size = 1024 # micro-batch size per rank; the optimizer sees batch_size * gradient_accumulation_steps * world_size positions per step
+gradient_accumulation_steps = 1
+num_workers = min(8, os.cpu_count() or 1)
+shuffle_window = 100_000 # positions each worker shuffles together before emitting them
+num_cursors = 16 # places in the data each worker reads from at once, so a window mixes games from all over the files
+seed = 1337 # fixes the order of the positions; the same seed, data and num_workers replay the same batches
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+# 'float32', 'bfloat16' or 'float16'; the reduced-precision types run the forward pass under autocast
+dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' if torch.cuda.is_available() else 'float32'
+compile = False # torch.compile the model
+metrics_file = 'metrics.jsonl' # per-log_interval metrics, one JSON object per line in out_dir
+profile = False # record a torch.profiler trace of iterations [profile_start, profile_start + profile_steps) to out_dir/profile
+profile_start = 10
+profile_steps = 5
+shard_dir = None # output directory of `python shards.py`; when set, training reads pre-tokenized shards instead of the PGN
+dedup_dir = None # output directory of `python dedup.py`; when set, training samples distinct positions from that index
+frequency_cap = 8 # with dedup_dir, a position seen n times is sampled min(n, frequency_cap) times per epoch
+pgn_file_paths = 'chinchilla_optimal.pgn' # one PGN or a list of them, read when neither shard_dir nor dedup_dir is set
+# Distributed data parallel: launch with `torchrun --nproc_per_node=N train.py`. Every rank reads its own part
+# of the data; rank 0 alone writes checkpoints, metrics and logs.
+backend = 'nccl' if torch.cuda.is_available() else 'gloo' # gloo runs on CPU-only machines
 
-model_args = dict(
-    vocab_size=config['vocab_size'],
-    d_model=config['d_model'],
-    n_head=config['n_head'],
-    num_layers=config['num_layers'],
-    dim_feedforward=config['dim_feedforward'],
-    max_seq_length=config['max_seq_length'],
-    num_classes=config['num_classes'],
-    test_mode=False
-)
+# importing train only reads the config above; building the model and data and training happen in main()
+def main():
+    ddp = int(os.environ.get('RANK', -1)) != -1
+    if ddp:
+        dist.init_process_group(backend=backend)
+        rank = dist.get_rank()
+        world_size = dist.get_world_size()
+        local_rank = int(os.environ['LOCAL_RANK'])
+        if device.startswith('cuda'):
+            # 'cuda' now means this rank's GPU
+            torch.cuda.set_device(local_rank)
+    else:
+        rank, world_size = 0, 1
+    master_process = rank == 0
 
-model = Model(**model_args).to(device)
+    model_args = dict(
+        vocab_size=config['vocab_size'],
+        d_model=config['d_model'],
+        n_head=config['n_head'],
+        num_layers=config['num_layers'],
+        dim_feedforward=config['dim_feedforward'],
+        max_seq_length=config['max_seq_length'],
+        num_classes=config['num_classes'],
+        pooling=config['pooling'],
+        test_mode=False
+    )
 
-total_params = sum(p.numel() for p in model.parameters())
-print(f"Total number of parameters: {total_params:,}")
+    device_type = 'cuda' if 'cuda' in device else 'cpu'
+    ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+    ctx = nullcontext() if dtype == 'float32' else torch.autocast(device_type=device_type, dtype=ptdtype)
+    # float16 gradients underflow without loss scaling; for the other dtypes the scaler is a no-op
+    scaler = torch.amp.GradScaler(device_type, enabled=(dtype == 'float16'))
 
-optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, betas=(beta1, beta2), weight_decay=weight_decay)
+    model = Model(**model_args).to(device)
+    raw_model = model
+    if compile:
+        print("compiling the model...")
+        model = torch.compile(model)
+    if ddp:
+        # DDP broadcasts rank 0's initial weights, so every rank starts from the same model
+        model = DDP(model, device_ids=[local_rank] if device.startswith('cuda') else None)
 
-criterion = nn.MSELoss()
+    total_params = sum(p.numel() for p in model.parameters())
+    if master_process:
+        print(f"Total number of parameters: {total_params:,}")
 
-dataloader = get_chess_position_dataloader('chinchilla_optimal.pgn', batch_size=batch_size, alpha=0.1, chunk_size=10000)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, betas=(beta1, beta2), weight_decay=weight_decay)
 
-iter_num = 0
+    criterion = nn.MSELoss()
 
-def save_checkpoint(filename):
-    checkpoint = {
-        'model': model.state_dict(),
-        'optimizer': optimizer.state_dict(),
-        'model_args': model_args,
-        'iter_num': iter_num,
-    }
-    torch.save(checkpoint, filename)
-    print(f"Checkpoint saved to {filename}")
+    if shard_dir is not None:
+        dataloader = get_shard_dataloader(shard_dir, batch_size=batch_size, num_workers=num_workers, rank=rank, world_size=world_size, seed=seed)
+    elif dedup_dir is not None:
+        dataloader = get_dedup_dataloader(dedup_dir, batch_size=batch_size, frequency_cap=frequency_cap, num_workers=num_workers, max_seq_length=config['max_seq_length'],
+                                          rank=rank, world_size=world_size, seed=seed)
+    else:
+        dataloader = get_chess_position_dataloader(pgn_file_paths, batch_size=batch_size, alpha=0.1, chunk_size=shuffle_window, num_workers=num_workers,
+                                                   max_seq_length=config['max_seq_length'], num_cursors=num_cursors, seed=seed,
+                                                   rank=rank, world_size=world_size)
 
+    iter_num = 0
+    checkpointer = AsyncCheckpointer(out_dir, keep_last=keep_last, keep_every=keep_every) if master_process else None
 
-while True:
-    model.train()
-    total_loss = 0
-    for tokens, scores in dataloader:
-        tokens, scores = tokens.to(device), scores.to(device).float().unsqueeze(1)
+    # called on every rank: under DDP the dataset positions of all ranks are gathered into rank 0's checkpoint
+    def save_checkpoint():
+        dataset_state = dataloader.dataset.state_dict() if hasattr(dataloader.dataset, 'state_dict') else None
+        if ddp and dataset_state is not None:
+            dataset_states = [None] * world_size
+            dist.all_gather_object(dataset_states, dataset_state)
+            dataset_state = dataset_states
+        if not master_process:
+            return
+        checkpoint = {
+            'model': raw_model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'scaler': scaler.state_dict(),
+            'model_args': model_args,
+            'iter_num': iter_num,
+            'tokenizer_version': TOKENIZER_VERSION,
+        }
+        if dataset_state is not None:
+            checkpoint['dataset'] = dataset_state
+        checkpointer.save(checkpoint, iter_num)
+
+    resume_path = latest_checkpoint(out_dir) if resume else None
+    if resume_path is not None:
+        checkpoint = torch.load(resume_path, map_location=device, weights_only=True)
+        raw_model.load_state_dict(upgrade_state_dict(checkpoint))
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        if 'scaler' in checkpoint:
+            scaler.load_state_dict(checkpoint['scaler'])
+        if 'dataset' in checkpoint and hasattr(dataloader.dataset, 'load_state_dict'):
+            # a list holds one state per rank; with a different world size the data starts over
+            dataset_state = checkpoint['dataset']
+            if isinstance(dataset_state, list):
+                dataset_state = dataset_state[rank] if len(dataset_state) == world_size else None
+            elif world_size > 1:
+                dataset_state = None
+            dataloader.dataset.load_state_dict(dataset_state)
+        iter_num = checkpoint['iter_num'] + 1
+        if master_process:
+            print(f"Resuming from {resume_path} at iter {iter_num}")
+        del checkpoint
+
+    # input: dataloader iterator
+    # output: next (tokens, scores) batch already queued for the device, starting a new pass over the data when one ends
+    def get_batch():
+        nonlocal batches
+        try:
+            tokens, scores = next(batches)
+        except StopIteration:
+            # a resumed run only starts mid-file for its first epoch
+            if hasattr(dataloader.dataset, 'load_state_dict'):
+                dataloader.dataset.load_state_dict(None)
+            if hasattr(dataloader.dataset, 'set_epoch'):
+                dataloader.dataset.set_epoch(dataloader.dataset.epoch + 1)
+            if hasattr(dataloader.sampler, 'set_epoch'):
+                epoch = getattr(dataloader.sampler, 'epoch', 0) + 1
+                dataloader.sampler.set_epoch(epoch)
+            batches = iter(dataloader)
+            tokens, scores = next(batches)
+        # with pinned batches these copies are asynchronous and overlap with the running step
+        tokens = tokens.to(device, non_blocking=True)
+        # Model returns one value per position, so the targets stay 1-d (a [B, 1] target would broadcast against [B])
+        scores = scores.to(device, non_blocking=True).float()
         scores -= scores.mean()
         scores /= scores.std()
+        return tokens, scores
+
+    if profile and master_process:
+        profiler = torch.profiler.profile(
+            schedule=torch.profiler.schedule(wait=max(profile_start - 1, 0), warmup=1, active=profile_steps, repeat=1),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(os.path.join(out_dir, 'profile')),
+            record_shapes=True, profile_memory=True)
+    else:
+        profiler = nullcontext()
+
+    metrics = MetricsLogger(os.path.join(out_dir, metrics_file)) if master_process else None
+    timer = PhaseTimer(device_type)
+    model.train()
+    batches = iter(dataloader)
+    tokens, scores = get_batch()
+    # losses are summed on the device and only read back when they are logged
+    running_loss = torch.zeros((), device=device)
+    total_loss = torch.zeros((), device=device)
+    iters_since_log = 0
+    with profiler:
+        while True:
+            for micro_step in range(gradient_accumulation_steps):
+                if ddp:
+                    # gradients are averaged across ranks only on the last micro-step
+                    model.require_backward_grad_sync = micro_step == gradient_accumulation_steps - 1
+                with timer.phase('forward'), ctx:
+                    logits = model(tokens)
+                    loss = criterion(logits.float(), scores) / gradient_accumulation_steps
+                # fetch the next batch while the device works through this one
+                with timer.phase('data', host=True):
+                    tokens, scores = get_batch()
+                with timer.phase('backward'):
+                    scaler.scale(loss).backward()
+                running_loss += loss.detach()
+                total_loss += loss.detach()
+
+            with timer.phase('optimizer'):
+                if grad_clip != 0.0:
+                    scaler.unscale_(optimizer)
+                    nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
+            if profile and master_process:
+                profiler.step()
+
+            iters_since_log += 1
+            if (iter_num + 1) % log_interval == 0:
+                if ddp:
+                    # the logged loss is the mean over ranks; gloo has no AVG reduction
+                    dist.all_reduce(running_loss)
+                    running_loss /= world_size
+                loss_value = running_loss.item() / iters_since_log
+                running_loss.zero_()
+                seconds = timer.flush()
+                positions_per_sec = iters_since_log * gradient_accumulation_steps * batch_size * world_size / seconds['wall']
+                iters_since_log = 0
+                record = {
+                    'iter': iter_num,
+                    'loss': loss_value,
+                    'positions_per_sec': positions_per_sec,
+                    'seconds': seconds,
+                    'queue_depth': queue_depth(batches),
+                    'peak_memory_mb': peak_memory_mb(device_type),
+                }
+                if hasattr(dataloader.dataset, 'throughput'):
+                    record['dataset_games_per_sec'], record['dataset_positions_per_sec'] = dataloader.dataset.throughput()
+                if master_process:
+                    metrics.log(record)
+                    print(f"iter {iter_num}: loss {loss_value:.4f}, {positions_per_sec:,.0f} positions/sec, "
+                          f"data {seconds.get('data', 0.0) / seconds['wall']:.0%} of step time")
+
+            if iter_num % save_interval == 0:
+                save_checkpoint()
+                if master_process:
+                    print(f"iter {iter_num}: Total Loss {total_loss.item():.4f}")
+                total_loss.zero_()
+
+            iter_num += 1
+            if iter_num >= max_iters:
+                break
+
+    if master_process:
+        checkpointer.wait()
+        metrics.close()
+    if ddp:
+        dist.destroy_process_group()
+
 
-        for param_group in optimizer.param_groups:
-            param_group['lr'] = learning_rate
-        
-        logits = model(tokens)
-        loss = criterion(logits, scores)
-        total_loss += loss
-
-        optimizer.zero_grad()
-        loss.backward()
-        if grad_clip != 0.0:
-            nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
-        optimizer.step()
-        
-        if iter_num % log_interval == 0:
-            print(f"iter {iter_num}: loss {loss.item():.4f}")
-
-        if iter_num % save_interval == 0:
-            save_checkpoint(os.path.join(out_dir, f'checkpoint_{iter_num}.pt'))
-            print(f"iter {iter_num}: Total Loss {total_loss.item():.4f}")
-            total_loss = 0
-
-
-        iter_num += 1
-        if iter_num >= max_iters:
-            break
-    
-    if iter_num >= max_iters:
-        break
+if __name__ == "__main__":
+    main()